@@ -4,140 +4,649 @@ Youtubeに自動で動画投稿を行います。
 @author: Yuta Tanimura
 """
 import json
+import math
+import multiprocessing
 import os
 import pickle
+import re
+import shutil
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 
 import win10toast
 from moviepy.editor import VideoFileClip
-from pydub import AudioSegment
 from tqdm import tqdm
 
-from ChatGPT import ChatGPT
-from Movie_maker import Movie_maker
-from VoiceVox import generate_voice
+from Audio_processor import process_voices, read_wav_info, write_narration_track
+from ChatGPT import ChatGPT, split_json_items
+from Encoder import resolve_encoder
+from Job_scheduler import Job_journal, Job_scheduler
+from Metrics import bind, end_run, get_memory_budget, get_metrics, set_memory_budget, start_job, start_run
+from Movie_maker import Movie_maker, Recipe_recorder, get_image_cache
+from Pipeline import Pipeline
+from Story_queue import Story_queue
+from Subtitle_renderer import Subtitle_track, render_slideshow
+from Timeline import Timeline, get_segment_cache, slide_key
+from VoiceVox import MAX_WORKERS as VOICE_WORKERS
+from VoiceVox import generate_voice_retry, generate_voices, generate_voices_batch, get_voice_cache, sync_user_dict
+from VoiceVox import set_max_concurrency as set_voice_concurrency
 from Youtube_uploader import Youtube_uploader
 
 story_title = ""
+story_queue = None # 生成済みの物語のキュー（mainで作成します）
+render_workers = 1 # 動画のスライドを並列に描画・エンコードするプロセスの数（mainで設定します）
 
-def main():
-    toast = win10toast.ToastNotifier()
-    while True: # 毎日繰り返す
-        save_path = f"resources/output/movie_{datetime.now().strftime('%Y%m%d%H%M')}.mp4"
-        if os.path.exists("resources/param/date.pickle"):
-            with open("resources/param/date.pickle", "rb") as f:
-                date = pickle.load(f)
-            if date >= datetime.now().strftime('%Y%m%d'):
-                print("日付が変わり朝７時になると投稿プロセスが開始されます。")
-            while True:  # 日付が変わった朝の7時以降まで待機
-                now = datetime.now()
-                if now.strftime('%Y%m%d') > date and now.hour >= 7:
-                    break
-                time.sleep(60)  # 1分ごとにチェック
-        toast.show_toast("動画投稿プロセス進行中", "語りのずんだチャンネルの動画投稿プロセスが始まります。", duration=10)
-        print("物語を生成しています...")
-        retry_count = 0
-        while True: # 物語生成が成功するまでリトライする
+STORY_PROMPT = """
+    6000文字程度の長い物語を作成してください。
+    最初の行は物語のタイトルにしてください。「タイトル」という必要はありません。
+
+    物語は1文ずつ、「通常バージョン」（kanji）と「ひらがなとカタカナのバージョン」（kana）の組にして出力してください。
+    「ひらがなとカタカナのバージョン」は、通常バージョンをひらがなとカタカナのみの表記に変換したものです。
+    タイトル以外の組には、「。」で終わる1文だけを入れてください。
+    また、いかなるマークダウン記法も使用しないでください。この文章は読み上げソフトによって読み上げられるので、その際に変になることは避けなければなりません。
+    出力は次の形式のJSONだけにしてください。
+    {"lines": [{"kanji": "(タイトル)", "kana": "(タイトルのひらがなとカタカナのバージョン)"}, {"kanji": "(1文目)", "kana": "(1文目のひらがなとカタカナのバージョン)"}, ...]}
+    """
+
+# 不正な行だけを作り直すときのプロンプト
+STORY_REPAIR_PROMPT = """
+    以下は物語の一部の行で、それぞれ「通常バージョン」（kanji）と「ひらがなとカタカナのバージョン」（kana）の組が不正です。
+    「ひらがなとカタカナのバージョン」は、通常バージョンをひらがなとカタカナのみの表記に変換したものです。
+    前後の行（before, after）につながるように、各行を「。」で終わる1文の組として作り直してください。
+    マークダウン記法は使用せず、次の形式のJSONだけを出力してください。indexは入力と同じ値にしてください。
+    {{"lines": [{{"index": (行の番号), "kanji": "(通常バージョン)", "kana": "(ひらがなとカタカナのバージョン)"}}, ...]}}
+
+    {lines}
+    """
+
+# 通常バージョンだけを生成させるプロンプト。読みはVOICEVOXエンジンが解析するので、出力のトークン数が約半分になる
+STORY_KANJI_PROMPT = """
+    6000文字程度の長い物語を作成してください。
+    最初の行は物語のタイトルにしてください。「タイトル」という必要はありません。
+
+    物語は1文ずつ出力してください。タイトル以外の行には、「。」で終わる1文だけを入れてください。
+    また、いかなるマークダウン記法も使用しないでください。この文章は読み上げソフトによって読み上げられるので、その際に変になることは避けなければなりません。
+    出力は次の形式のJSONだけにしてください。
+    {"lines": [{"kanji": "(タイトル)"}, {"kanji": "(1文目)"}, {"kanji": "(2文目)"}, ...]}
+    """
+
+STORY_KANJI_REPAIR_PROMPT = """
+    以下は物語の一部の行で、それぞれの行（kanji）が不正です。
+    前後の行（before, after）につながるように、各行を「。」で終わる1文として作り直してください。
+    マークダウン記法は使用せず、次の形式のJSONだけを出力してください。indexは入力と同じ値にしてください。
+    {{"lines": [{{"index": (行の番号), "kanji": "(作り直した行)"}}, ...]}}
+
+    {lines}
+    """
+
+def _lines_format(name: str, with_index: bool = False, with_kana: bool = True) -> dict:
+    """
+    物語の行（{kanji, kana}の組、またはkanjiだけ）の配列を返させるためのresponse_formatを作成します。
+    """
+    properties = {"kanji": {"type": "string"}, "kana": {"type": "string"}} if with_kana else {"kanji": {"type": "string"}}
+    if with_index:
+        properties = {"index": {"type": "integer"}, **properties}
+    line = {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+    schema = {"type": "object", "properties": {"lines": {"type": "array", "items": line}}, "required": ["lines"], "additionalProperties": False}
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+STORY_FORMAT = _lines_format("story")
+STORY_REPAIR_FORMAT = _lines_format("story_repair", with_index=True)
+# 物語の生成方法
+#   "pair": 通常バージョンとひらがなとカタカナのバージョンの組を生成します
+#   "kanji": 通常バージョンだけを生成し、読みはVOICEVOXエンジンの解析（とユーザー辞書）に任せます
+STORY_MODES = {
+    "pair": {"prompt": STORY_PROMPT, "format": STORY_FORMAT, "repair_prompt": STORY_REPAIR_PROMPT, "repair_format": STORY_REPAIR_FORMAT},
+    "kanji": {"prompt": STORY_KANJI_PROMPT, "format": _lines_format("story", with_kana=False),
+              "repair_prompt": STORY_KANJI_REPAIR_PROMPT, "repair_format": _lines_format("story_repair", with_index=True, with_kana=False)},
+}
+STORY_MODE = "kanji"
+MAX_REPAIR_ROUNDS = 2 # 不正な行を作り直す回数の上限
+KANJI_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff々〆]")
+
+# 動画の素材
+IMG_ZUNDA_PATH = "resources/image/立ち絵.png"
+IMG_BG_PATH = "resources/image/background.png"
+IMG_TITLE_BG_PATH = "resources/image/title_bg.jpg"
+FONT_PATH = "fonts/HGRGY.TTC"
+
+# 前口上とエンディングの読み上げ
+INTRO_TEXT = """
+    語りのずんだへようこそなのだ。この動画では、ぼくがあなたにいろんなものがたりを、よみきかせるのだ。こんかいのものがたりはこれなのだ。
+    """
+ENDING_TEXT = """
+    これでこのものがたりはおわりなのだ。ぜひほかのものがたりもきいていってもらえるとうれしいのだ。それでは、べつのものがたりでまたあおうなのだ。ばいばい。
+    """
+
+# スライドの長さ（秒）。タイトル以外はボイスの長さに余白を足す
+TITLE_DURATION = 2.5
+SLIDE_PADDING = {"intro": 2.5, "story_title": 1.5, "story": 1, "ending": 1.5}
+
+# 映像のエンコード設定。エンコーダーはこのホストで使えるものの中から一番速いプロファイルを自動で選ぶ（Encoder.py）
+VIDEO_SETTINGS = {
+    "profile": "auto",
+    "fps": 10,
+}
+# スライドを並列に描画・エンコードするプロセスの数の既定値。1プロセスが1枚のスライドの合成結果を持つ
+RENDER_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))
+# ボイスの後処理の設定（Audio_processor.process_voices）。前後の無音を切り詰めた長さがスライドの長さになる
+AUDIO_SETTINGS = {
+    "sample_rate": 44100, # 動画の音声のサンプリングレート（リサンプリングはここで1回だけ行う）
+    "silence_threshold_db": -40, # 行の中で一番大きい区間からこれ以上小さい区間を無音とみなす
+    "target_dbfs": -20, # 声のある区間の平均の音量
+    "padding": 0.05, # 切り詰めた後に前後に残す無音（秒）
+}
+
+# チャンネルとジョブの設定。ファイルがない場合はDEFAULT_CONFIGを使う
+CONFIG_PATH = "resources/param/channels.json"
+DEFAULT_CHANNEL = {
+    "name": "zunda",
+    "cron": "0 7 * * *", # 毎朝7時
+    "client_secret": "keys/client_secret_170252295818-u0p1ncb82ou8otmkv0q7hvlpc72hq22b.apps.googleusercontent.com.json",
+    "token": "token.pickle",
+    "speaker": 22,
+    "speed": 0.75,
+    "story_mode": STORY_MODE, # 物語の生成方法（STORY_MODES）
+    "upload": True,
+    "title": "【睡眠導入】ずんだもんがささやき声で物語を読み聞かせるのだ【{story_title}】",
+    "description": "こんばんは。ずんだもんなのだ。このチャンネルでは僕が毎日いろんな物語をささやき声で読み聞かせる動画を投稿しているのだ。気に入ったらぜひ高評価とチャンネル登録をしていただけるとうれしいのだ。のだ。",
+    "tags": ["語りのずんだ", "ずんだもん", "物語", "読み聞かせ", "ささやき声", "ささやき声で物語を読み聞かせるのだ", "ささやき声で物語を読み聞かせるのだ【{story_title}】"],
+}
+DEFAULT_CONFIG = {
+    "max_jobs": 2, # 同時に実行するジョブの数
+    "stage_limits": {"llm": 2, "tts": VOICE_WORKERS, "render": 1, "upload": 1}, # 段階ごとに同時に実行できる数
+    "memory_budget_mb": 2048, # 動画の描画中のメモリ使用量の予算（MB）。超えている間は次のスライドの描画を待ちます
+    "render_workers": RENDER_WORKERS, # 1本の動画のスライドを並列に描画・エンコードするプロセスの数
+    # 物語を前もって生成しておくキュー。sizeを0にするとジョブの中で物語を生成します
+    "story_queue": {"size": 7, "batch": 3, "max_concurrency": 3, "requests_per_minute": None, "mode": STORY_MODE},
+    "channels": [DEFAULT_CHANNEL],
+}
+MAX_STORY_RETRIES = 5 # 物語の生成をやり直す回数の上限
+
+def load_config(path: str = CONFIG_PATH) -> dict:
+    """
+    チャンネルとジョブの設定を読み込みます。チャンネルの設定で省略した項目は、DEFAULT_CHANNELの値を使います。
+
+    Args:
+        path (str, optional): 設定ファイルのパス. Defaults to CONFIG_PATH.
+
+    Returns:
+        dict: max_jobs, stage_limits, channelsをもつ設定
+    """
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+    config["stage_limits"] = {**DEFAULT_CONFIG["stage_limits"], **config["stage_limits"]}
+    config["story_queue"] = {**DEFAULT_CONFIG["story_queue"], **config["story_queue"]}
+    config["channels"] = [{**DEFAULT_CHANNEL, **channel} for channel in config["channels"]]
+    return config
+
+def notify(title: str, message: str):
+    """
+    Windowsの通知を表示します。ジョブを止めないよう、通知は別のスレッドで表示します。
+    """
+    try:
+        win10toast.ToastNotifier().show_toast(title, message, duration=10, threaded=True)
+    except Exception as e:
+        print(f"[Error]: 通知を表示できませんでした。 > {e}")
+
+def resume_voices(job: dict, channel: dict, journal: Job_journal, story_kana_lines: list) -> list:
+    """
+    ジャーナルに記録された物語のボイスのうち、まだ生成が完了していない行だけを生成し直します。
+    ボイスは1行ずつジャーナルに記録するので、ボイスの生成中に止まった場合も、完了した行は生成し直しません。
+
+    Args:
+        job (dict): 実行するジョブ
+        channel (dict): チャンネルの設定
+        journal (Job_journal): ジョブのジャーナル
+        story_kana_lines (list): ひらがなバージョンの行のリスト
+
+    Returns:
+        list: ボイスファイルのパスのリスト
+    """
+    voice_dir = os.path.join(job["work_dir"], "voice")
+    os.makedirs(voice_dir, exist_ok=True)
+    voice_paths = [os.path.join(voice_dir, f"{10 + i}.wav") for i in range(len(story_kana_lines))]
+    missing = [i for i, path in enumerate(voice_paths) if not journal.done("voices", i) or not os.path.exists(path)]
+    on_voice = lambda i, path: journal.mark("voices", unit=i, path=path)
+    if len(missing) == len(voice_paths):
+        # ボイスが1行も記録されていない場合は、まとめて合成する（合成済みの行はキャッシュから取り出される）
+        return generate_voices_batch(story_kana_lines, speaker=channel["speaker"], speed=channel["speed"], out_dir=voice_dir, start_index=10,
+                                     on_voice=on_voice)
+    if missing:
+        print(f"[ジョブ{job['id']}] 未完了の{len(missing)}行のボイスを生成し直します。")
+        paths = generate_voices(story_kana_lines, speaker=channel["speaker"], speed=channel["speed"], out_dir=voice_dir, start_index=10,
+                                max_workers=VOICE_WORKERS, indices=missing, on_voice=on_voice)
+        for i, path in zip(missing, paths):
+            voice_paths[i] = path
+    return voice_paths
+
+def prepare_story(job: dict, channel: dict, scheduler: Job_scheduler, journal: Job_journal) -> tuple:
+    """
+    ジョブの作業フォルダに物語のテキストとボイスを用意します。
+    ジャーナルに物語が記録されていればそれを使い、キューに生成済みの物語があればそれを使い、
+    どちらもなければ物語をストリーミングで生成しながらボイスを生成します。
+
+    Args:
+        job (dict): 実行するジョブ
+        channel (dict): チャンネルの設定
+        scheduler (Job_scheduler): 段階ごとの同時実行数を制限するスケジューラー
+        journal (Job_journal): ジョブのジャーナル
+
+    Returns:
+        tuple: (通常バージョンの行のリスト, ボイスファイルのパスのリスト)
+    """
+    metrics = get_metrics()
+    work_dir = job["work_dir"]
+    voice_dir = os.path.join(work_dir, "voice")
+    if journal.done("story"):
+        # 前回の実行で物語が完成していれば、物語を生成し直さずに続きから再開する
+        story = journal.get("story")
+        print(f"[ジョブ{job['id']}] 前回の実行で生成した物語を使います。")
+        os.makedirs(os.path.join(work_dir, "text"), exist_ok=True)
+        with scheduler.stage("tts", job), metrics.timer("stage.story", job=job["id"], source="journal"):
+            story_kanji_lines = story["kanji"]
+            voice_paths = resume_voices(job, channel, journal, story["kana"])
+        return story_kanji_lines, voice_paths
+
+    story = story_queue.pop() if story_queue is not None else None
+    if story is not None:
+        print(f"[ジョブ{job['id']}] 生成済みの物語を使います。（キューの残り: {len(story_queue)}件）")
+        clear_resources(work_dir)
+        journal.clear("voices")
+        # キューから取り出した物語は他のジョブに使われないので、ボイスを生成する前に記録しておく
+        journal.mark("story", kanji=story["kanji"], kana=story["kana"])
+        with scheduler.stage("tts", job), metrics.timer("stage.story", job=job["id"], source="queue"):
+            story_kanji_lines = story["kanji"]
+            # 物語の全行が揃っているので、/multi_synthesisでまとめて合成する
+            voice_paths = generate_voices_batch(story["kana"], speaker=channel["speaker"], speed=channel["speed"], out_dir=voice_dir, start_index=10,
+                                                on_voice=lambda i, path: journal.mark("voices", unit=i, path=path))
+    else:
+        print(f"[ジョブ{job['id']}] 物語を生成しています...")
+        for retry_count in range(MAX_STORY_RETRIES + 1): # 物語生成が成功するまでリトライする
+            # 前回の試行のファイルとボイスの記録が残らないよう、作業フォルダのtextフォルダとvoiceフォルダの中にあるファイルを削除
+            clear_resources(work_dir)
+            journal.clear("voices")
             try:
-                stories = create_story()
-                print(stories)
-                story_kanji_lines = stories[0].split('\n')
-                story_hiragana_lines = stories[1].split('\n')
-                
-                # 空の要素を削除
-                story_kanji_lines = [line for line in story_kanji_lines if line.strip()]
-                story_hiragana_lines = [line for line in story_hiragana_lines if line.strip()]
-                
-                assert len(story_kanji_lines) == len(story_hiragana_lines), "通常バージョンとひらがなとカタカナのバージョンの行数が一致しません。"
-            except AssertionError as e:
-                retry_count += 1
-                print("ChatGPTが不正な物語を生成しました。リトライします。リトライ回数：", retry_count)
-                if retry_count > 5:
-                    toast.show_toast("物語生成エラー", "ChatGPTが不正な物語を生成しました。リトライ回数が5回を超えたため、プログラムを終了します。", duration=10)
-                    exit()
-                else:
-                    continue
-            break
-        
-        print("\nボイスを生成しています...")
-        # resources/textフォルダとvoiceフォルダの中にあるファイルを削除
-        for folder in ["resources/text", "resources/voice"]:
-            for file in os.listdir(folder):
-                file_path = os.path.join(folder, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-        print("既存のファイルを削除しました。")
-        
+                # 物語を受け取りながら、完成した行から順にボイスを生成する
+                # ボイスの生成中に止まっても物語を生成し直さないよう、物語が完成した時点で記録する
+                # "llm"の枠は物語を書き終えた時点で返し、残りのボイスは"tts"の枠で待つ
+                with metrics.timer("stage.story", job=job["id"], source="stream"):
+                    story_kanji_lines, _, voice_paths = create_story_stream(
+                        voice_dir=voice_dir, speaker=channel["speaker"], speed=channel["speed"], start_index=10, mode=channel["story_mode"],
+                        on_story=lambda story: journal.mark("story", kanji=story["kanji"], kana=story["kana"]),
+                        on_voice=lambda i, path: journal.mark("voices", unit=i, path=path),
+                        llm_stage=lambda: scheduler.stage("llm", job), voice_stage=lambda: scheduler.stage("tts", job))
+                break
+            except (AssertionError, ValueError, ConnectionError) as e:
+                # 不正な物語や、途中で途切れた回答（配列が閉じていない）はやり直す
+                print(f"[ジョブ{job['id']}] ChatGPTが不正な物語を生成しました。リトライします。リトライ回数：", retry_count + 1, f"> {e}")
+        else:
+            notify("物語生成エラー", f"ChatGPTが不正な物語を生成しました。リトライ回数が{MAX_STORY_RETRIES}回を超えました。")
+            raise RuntimeError("ChatGPTが不正な物語を生成しました。")
+    return story_kanji_lines, voice_paths
+
+def run_job(job: dict, channel: dict, scheduler: Job_scheduler) -> str:
+    """
+    1本の動画を生成して投稿するジョブを実行します。ジョブごとの作業フォルダを使うので、複数のジョブを並列に実行できます。
+    完了した段階は作業フォルダのジャーナルに記録するので、失敗したジョブを再実行すると最後に完了した段階の続きから再開します。
+
+    Args:
+        job (dict): 実行するジョブ（id, work_dirなど）
+        channel (dict): チャンネルの設定
+        scheduler (Job_scheduler): 段階ごとの同時実行数を制限するスケジューラー
+
+    Returns:
+        str: アップロードした動画のID（アップロードしない場合は動画のパス）
+    """
+    # ジョブの計測結果は、実行の計測結果とは別のファイルに記録する
+    with start_job(job["id"]):
+        return _run_job(job, channel, scheduler)
+
+def _run_job(job, channel, scheduler):
+    """
+    run_jobの本体です。
+    """
+    metrics = get_metrics()
+    work_dir = job["work_dir"]
+    journal = Job_journal(work_dir)
+    if not journal.done("start"):
+        # 再実行しても同じ動画のパスを使うように記録する（アップロードのセッションも動画のパスに紐づいている）
+        journal.mark("start", save_path=f"resources/output/movie_{channel['name']}_{datetime.now().strftime('%Y%m%d%H%M')}_{job['id']}.mp4")
+    save_path = journal.get("start")["save_path"]
+    os.makedirs("resources/output", exist_ok=True)
+    notify("動画投稿プロセス進行中", f"{channel['name']}チャンネルの動画投稿プロセスが始まります。")
+
+    with metrics.profile():
+        story_kanji_lines, voice_paths = prepare_story(job, channel, scheduler, journal)
+
         # ファイルに書き出し
-        for i in tqdm(range(len(story_hiragana_lines))):
-            with open("resources/text/"+str(i)+".txt", "w", encoding="utf-8") as f:
+        for i in range(len(story_kanji_lines)):
+            with open(os.path.join(work_dir, "text", f"{i}.txt"), "w", encoding="utf-8") as f:
                 f.write(story_kanji_lines[i])
-            try:
-                generate_voice(story_hiragana_lines[i], output_path="resources/voice/"+str(i+10)+".wav", speaker=22, speed=0.75)
-            except:
-                print("ボイス生成エラーです。VOICEVOXXエンジンを起動してください。")
-                toast.show_toast("ボイス生成エラー", "ボイスを生成できませんでした。VOICEVOXXエンジンが起動されていない可能性があります。プログラムを終了します。", duration=10)
-                exit()
-        print("ボイスを生成しました。")
-        print("動画を生成しています...")
-        
-        # 動画を生成
-        toast.show_toast("動画プロセス進行中", "動画の書き出しが開始されます。", duration=10)
-        create_movie(save_path=save_path)
-        print("動画を生成しました。")
-        break
-        # print("動画をアップロードしています...")
-
-        動画をアップロード
-        uploader = Youtube_uploader("keys/client_secret_170252295818-u0p1ncb82ou8otmkv0q7hvlpc72hq22b.apps.googleusercontent.com.json")
-        uploader.upload_video(video_path=save_path,
-                            title=f"【睡眠導入】ずんだもんがささやき声で物語を読み聞かせるのだ【{story_title}】",
-                            description=f"こんばんは。ずんだもんなのだ。このチャンネルでは僕が毎日いろんな物語をささやき声で読み聞かせる動画を投稿しているのだ。気に入ったらぜひ高評価とチャンネル登録をしていただけるとうれしいのだ。のだ。",
-                            tags=["語りのずんだ", "ずんだもん", "物語", "読み聞かせ", "ささやき声", "ささやき声で物語を読み聞かせるのだ", "ささやき声で物語を読み聞かせるのだ【{story_title}】"])
-        print("動画をアップロードしました。")
-        toast.show_toast("動画投稿プロセス完了", "語りのずんだチャンネルの動画投稿プロセスが完了しました。", duration=10)
-        with open("resources/param/date.pickle", "wb") as f:
-            pickle.dump(datetime.now().strftime('%Y%m%d'), f) # 投稿したので日付を保存
+        if None in voice_paths:
+            notify("ボイス生成エラー", "ボイスを生成できませんでした。VOICEVOXXエンジンが起動されていない可能性があります。")
+            raise RuntimeError("ボイスを生成できませんでした。VOICEVOXXエンジンを起動してください。")
+        cache = get_voice_cache()
+        print(f"[ジョブ{job['id']}] ボイスを生成しました。（キャッシュ ヒット: {cache.hits}件, ミス: {cache.misses}件）")
+
+        # 動画を生成（途中で止まった場合も、エンコード済みのスライドはセグメントのキャッシュから再利用される）
+        if journal.done("movie") and os.path.exists(save_path):
+            print(f"[ジョブ{job['id']}] 前回の実行で生成した動画を使います。 > {save_path}")
+        else:
+            with scheduler.stage("render", job), metrics.timer("stage.movie", job=job["id"]):
+                create_movie(save_path=save_path, workers=render_workers, work_dir=work_dir, speaker=channel["speaker"], speed=channel["speed"])
+            journal.mark("movie", path=save_path)
+            print(f"[ジョブ{job['id']}] 動画を生成しました。 > {save_path}")
+        if not channel["upload"]:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return save_path
+
+        # 動画をアップロード（途中で止まった場合は、Youtube_uploaderが保存したセッションから続きを送る）
+        if journal.done("upload"):
+            # アップロードが完了した後に止まった場合は、同じ動画を二重に投稿しない
+            video_id = journal.get("upload")["video_id"]
+        else:
+            story_title = story_kanji_lines[0]
+            with scheduler.stage("upload", job), metrics.timer("stage.upload", job=job["id"]):
+                uploader = Youtube_uploader(channel["client_secret"], token_path=channel["token"])
+                video_id = uploader.upload_video(video_path=save_path,
+                                                 title=channel["title"].format(story_title=story_title),
+                                                 description=channel["description"].format(story_title=story_title),
+                                                 tags=[tag.format(story_title=story_title) for tag in channel["tags"]])
+            if video_id is None:
+                raise RuntimeError("動画をアップロードできませんでした。")
+            journal.mark("upload", video_id=video_id)
+        print(f"[ジョブ{job['id']}] 動画をアップロードしました。")
+        notify("動画投稿プロセス完了", f"{channel['name']}チャンネルの動画投稿プロセスが完了しました。")
+    shutil.rmtree(work_dir, ignore_errors=True) # 動画はresources/outputに残す
+    return video_id
+
+def main():
+    config = load_config()
+    set_voice_concurrency(config["stage_limits"]["tts"])
+    set_memory_budget(config["memory_budget_mb"] * 1024 ** 2 if config["memory_budget_mb"] is not None else None)
+    global render_workers
+    render_workers = max(1, config["render_workers"])
+    # 通常バージョンだけを読み上げるときの読み間違いを、ユーザー辞書で直す
+    changed = sync_user_dict()
+    if changed is not None:
+        print(f"VOICEVOXのユーザー辞書を登録しました。（追加・更新: {changed}件）")
+    scheduler = Job_scheduler(config["channels"], run_job, stage_limits=config["stage_limits"], max_jobs=config["max_jobs"])
+
+    # 以前の1日1本の投稿日（date.pickle）を、最初のチャンネルのスケジュールに引き継ぐ
+    first_channel = config["channels"][0]["name"]
+    if os.path.exists("resources/param/date.pickle") and scheduler.queue.last_scheduled(first_channel) is None:
+        with open("resources/param/date.pickle", "rb") as f:
+            date = pickle.load(f)
+        scheduler.queue.set_last_scheduled(first_channel, datetime.strptime(date, "%Y%m%d").replace(hour=23, minute=59))
+
+    # 実行全体の各段階の処理時間とリソースの使用量を記録する（ジョブごとのファイルにも記録し、AI_YOUTUBER_PROFILE=1でジョブごとにcProfileも有効）
+    metrics = start_run()
+    global story_queue
+    queue_config = config["story_queue"]
+    if queue_config["size"] > 0:
+        # 毎日のジョブがLLMを待たないよう、裏で物語をまとめて生成しておく
+        story_queue = Story_queue(target_size=queue_config["size"])
+        story_queue.start_prefetch(lambda n: generate_stories_async(n, queue_config["max_concurrency"], queue_config["requests_per_minute"],
+                                                                    queue_config["mode"]),
+                                   story_from_lines, batch_size=queue_config["batch"], stage=lambda: scheduler.stage("llm"))
+    print(f"ジョブのスケジューラーを開始します。（チャンネル: {', '.join(channel['name'] for channel in config['channels'])}）")
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        scheduler.stop()
+    finally:
+        if story_queue is not None:
+            story_queue.stop_prefetch()
+        summary = end_run()
+        print(f"計測結果を保存しました。 > {metrics.path}（合計{summary['total_sec']:.1f}秒）")
     
-def create_story() -> str:
+def is_valid_line(line: dict, is_title: bool = False) -> bool:
+    """
+    物語の1行（{kanji, kana}の組、またはkanjiだけ）が正しいかを返します。
+    kanjiが空でなく、タイトル以外は「。」の数が1つ以下の場合に正しいとします。
+    kanaがある場合は、kanaも空でなく、漢字を含まず、「。」の数がkanjiと一致する必要があります。
+
+    Args:
+        line (dict): 物語の1行
+        is_title (bool, optional): タイトルの行. Defaults to False.
+    """
+    if not isinstance(line, dict) or not isinstance(line.get("kanji"), str) or not isinstance(line.get("kana", ""), str):
+        return False
+    kanji = line["kanji"].strip()
+    if kanji == "":
+        return False
+    if "kana" not in line:
+        return is_title or kanji.count("。") <= 1
+    kana = line["kana"].strip()
+    if kana == "" or KANJI_PATTERN.search(kana):
+        return False
+    return is_title or (kanji.count("。") <= 1 and kanji.count("。") == kana.count("。"))
+
+def find_broken_lines(lines: list) -> list:
     """
-    物語を作成します。
+    物語の行のうち、不正な行の番号を返します。
 
     Args:
-        description (str): 物語の説明
+        lines (list): 物語の行のリスト。最初の行はタイトル
 
     Returns:
-        str: 物語
+        list: 不正な行の番号のリスト
     """
-    prompt="""
-    6000文字程度の長い物語を作成してください。
-    最初に物語のタイトルを読み上げてください。「タイトル」という必要はありません。
-    
-    出力は「通常バージョン」と「ひらがなとカタカナのバージョン」の２つを作成してください。
-    「ひらがなとカタカナのバージョン」は、通常バージョンをひらがなとカタカナのみの表記に変換したものです。
-    また、どちらのバージョンにおいても必ず「。」のあとで改行するようにしてください。それ以外の箇所では改行しないてください。
-    なお、「通常バージョン」と「ひらがなとカタカナのバージョン」で改行する位置は揃えてください。つまり、両バージョンの行数が同じになるはずです。
-    また、いかなるマークダウン記法も使用しないでください。この文章は読み上げソフトによって読み上げられるので、その際に変になることは避けなければなりません。
-    また、以下の書式を守りなさい。なお、()は、その中身は、出力しないこと。また、「通常バージョン」と「ひらがなとカタカナのバージョン」の間の行には、「;」を入れてください。これがこれらを隔てる合図になります。
+    return [i for i, line in enumerate(lines) if not is_valid_line(line, is_title=i == 0)]
 
-    
-    
-    (通常バージョンの物語)
-    ;
-    (ひらがなとカタカナのバージョンの物語)
+def build_repair_prompt(lines: list, broken: list, mode: str = STORY_MODE) -> str:
+    """
+    不正な行だけを前後の行とあわせて送り、作り直させるプロンプトを作成します。
+    """
+    def kanji_at(i):
+        return lines[i]["kanji"] if 0 <= i < len(lines) and i not in broken and is_valid_line(lines[i], i == 0) else ""
+    targets = []
+    for i in broken:
+        line = lines[i] if isinstance(lines[i], dict) else {}
+        target = {"index": i, "kanji": line.get("kanji", "")}
+        if mode == "pair":
+            target["kana"] = line.get("kana", "")
+        targets.append({**target, "before": kanji_at(i - 1), "after": kanji_at(i + 1)})
+    return STORY_MODES[mode]["repair_prompt"].format(lines=json.dumps(targets, ensure_ascii=False, indent=1))
+
+def parse_items(reply: str) -> list:
+    """
+    1回で受け取った回答のJSONの配列の要素を返します。回答が途中で途切れている場合や、空の場合は空のリストを返します。
+
+    Args:
+        reply (str): ChatGPTの回答
+
+    Returns:
+        list: 配列の要素のリスト
+    """
+    try:
+        return list(split_json_items([reply or ""]))
+    except ValueError:
+        return []
+
+def apply_repair(lines: list, broken: list, reply: str) -> list:
+    """
+    作り直させた行で不正な行を置き換えます。
+
+    Args:
+        lines (list): 物語の行のリスト（置き換えられます）
+        broken (list): 作り直させた行の番号のリスト
+        reply (str): build_repair_promptに対する回答
+
+    Returns:
+        list: 置き換えたあとも不正な行の番号のリスト
+    """
+    for item in parse_items(reply):
+        if isinstance(item, dict) and item.get("index") in broken:
+            lines[item["index"]] = {name: item.get(name) for name in ("kanji", "kana") if name in item}
+    return find_broken_lines(lines)
+
+def repair_story(lines: list, gpt: ChatGPT, mode: str = STORY_MODE) -> list:
+    """
+    物語の不正な行だけをChatGPTに作り直させます。物語全体を生成し直すより、トークン数も時間も少なく済みます。
+
+    Args:
+        lines (list): 物語の行のリスト（置き換えられます）
+        gpt (ChatGPT): 作り直しに使うChatGPT
+        mode (str, optional): 物語の生成方法（STORY_MODES）. Defaults to STORY_MODE.
+
+    Returns:
+        list: MAX_REPAIR_ROUNDS回作り直しても不正な行の番号のリスト
+    """
+    broken = find_broken_lines(lines)
+    for _ in range(MAX_REPAIR_ROUNDS):
+        if not broken:
+            break
+        print(f"不正な{len(broken)}行を作り直しています...")
+        get_metrics().count("story.repair_lines", len(broken))
+        reply = gpt.send_message(build_repair_prompt(lines, broken, mode), response_format=STORY_MODES[mode]["repair_format"])
+        broken = apply_repair(lines, broken, reply)
+    return broken
+
+def story_from_lines(lines: list) -> dict:
+    """
+    物語の行を検証し、バージョンごとの行のリストにします。
 
+    Args:
+        lines (list): 物語の行のリスト
+
+    Returns:
+        dict: kanji（通常バージョンの行のリスト）とkana（音声合成に使う行のリスト）。不正な場合はNone
+            kanaのない行は、通常バージョンをそのまま音声合成に使います（読みはVOICEVOXエンジンが解析します）。
+    """
+    if lines is None or len(lines) < 2 or find_broken_lines(lines):
+        return None
+    return {"kanji": [line["kanji"].strip() for line in lines], "kana": [line.get("kana", line["kanji"]).strip() for line in lines]}
 
+def _story_gpt(n_memorise: int = 1) -> ChatGPT:
+    """
+    物語の生成に使うChatGPTを作成します（クライアントはChatGPTの中で使い回されます）。
     """
     with open("keys/ChatGPT_params.json", "r") as f:
         params = json.load(f)
-    gpt = ChatGPT(params["api_key"], params["model"], n_memorise=2)
-    story = gpt.send_message(prompt)
-    stories = story.split(';')
-    
-    assert len(stories) == 2, "物語のバージョンが2つではありません。"
+    return ChatGPT(params["api_key"], params["model"], n_memorise=n_memorise, base_url=params.get("base_url"))
+
+def create_story(mode: str = STORY_MODE) -> dict:
+    """
+    物語を作成します。不正な行は作り直します。
+
+    Args:
+        mode (str, optional): 物語の生成方法（STORY_MODES）. Defaults to STORY_MODE.
+
+    Returns:
+        dict: kanji（通常バージョンの行のリスト）とkana（音声合成に使う行のリスト）
+    """
+    gpt = _story_gpt(n_memorise=2)
+    lines = parse_items(gpt.send_message(STORY_MODES[mode]["prompt"], response_format=STORY_MODES[mode]["format"]))
+    repair_story(lines, _story_gpt(), mode)
+    story = story_from_lines(lines)
+    assert story is not None, "物語の不正な行を作り直せませんでした。"
+    return story
+
+async def generate_stories_async(n: int, max_concurrency: int = 3, requests_per_minute: float = None, mode: str = STORY_MODE) -> list:
+    """
+    物語をn件まとめて非同期で生成し、不正な行は物語ごとに作り直します。
+
+    Args:
+        n (int): 生成する物語の数
+        max_concurrency (int, optional): 同時に送るリクエストの数. Defaults to 3.
+        requests_per_minute (float, optional): 1分あたりに送るリクエストの数の上限. Defaults to None.
+        mode (str, optional): 物語の生成方法（STORY_MODES）. Defaults to STORY_MODE.
+
+    Returns:
+        list: 物語ごとの行のリストのリスト（story_from_linesで検証します）
+    """
+    gpt = _story_gpt()
+    replies = await gpt.send_messages_async([STORY_MODES[mode]["prompt"]] * n, max_concurrency=max_concurrency,
+                                            requests_per_minute=requests_per_minute, response_format=STORY_MODES[mode]["format"])
+    stories = [parse_items(reply) for reply in replies]
+    for _ in range(MAX_REPAIR_ROUNDS):
+        targets = [(lines, find_broken_lines(lines)) for lines in stories if len(lines) >= 2]
+        targets = [(lines, broken) for lines, broken in targets if broken]
+        if not targets:
+            break
+        get_metrics().count("story.repair_lines", sum(len(broken) for _, broken in targets))
+        replies = await gpt.send_messages_async([build_repair_prompt(lines, broken, mode) for lines, broken in targets], max_concurrency=max_concurrency,
+                                                requests_per_minute=requests_per_minute, response_format=STORY_MODES[mode]["repair_format"])
+        for (lines, broken), reply in zip(targets, replies):
+            apply_repair(lines, broken, reply)
     return stories
 
+def create_story_stream(voice_dir: str = "resources/voice", speaker: int = 22, speed: float = 0.75, start_index: int = 10,
+                        mode: str = STORY_MODE, on_story=None, on_voice=None, llm_stage=None, voice_stage=None) -> tuple:
+    """
+    物語をストリーミングで生成し、行が1つ届くたびにボイスの生成を始めます。
+    モデルが物語を書き終える前にボイスの生成が進みます。不正な行は、書き終えたあとでその行だけを作り直します。
+    物語の生成と作り直しはllm_stageの中で行い、残りのボイスの完成はvoice_stageの中で待つので、
+    ボイスを待っている間にほかのジョブが物語を生成できます。
+
+    Args:
+        voice_dir (str, optional): ボイスの出力先のフォルダ. Defaults to "resources/voice".
+        speaker (int, optional): 声の種類. Defaults to 22.
+        speed (float, optional): 話す速さ. Defaults to 0.75.
+        start_index (int, optional): 最初の行のボイスのファイル名の番号. Defaults to 10.
+        mode (str, optional): 物語の生成方法（STORY_MODES）. Defaults to STORY_MODE.
+        on_story (callable, optional): 物語が完成したとき（ボイスの完成を待つ前）に、story_from_linesの結果を渡して呼ぶ関数. Defaults to None.
+        on_voice (callable, optional): 1行のボイスができるたびに、(行の番号, パス)を渡して呼ぶ関数. Defaults to None.
+        llm_stage (callable, optional): 物語の生成の間withで囲む、同時実行数を制限するコンテキストマネージャーを返す関数. Defaults to None.
+        voice_stage (callable, optional): ボイスの完成を待つ間withで囲む、同時実行数を制限するコンテキストマネージャーを返す関数. Defaults to None.
+
+    Returns:
+        tuple: (通常バージョンの行のリスト, 音声合成に使った行のリスト, ボイスファイルのパスのリスト)
+    """
+    gpt = _story_gpt(n_memorise=2)
+    lines = []
+    futures = {} # 行の番号 → ボイスの生成
+    with ThreadPoolExecutor(max_workers=VOICE_WORKERS) as executor:
+        def synthesize(i, text, output_path):
+            path = generate_voice_retry(text, speaker=speaker, output_path=output_path, speed=speed)
+            if path is not None and on_voice is not None:
+                on_voice(i, path)
+            return path
+
+        def submit(i):
+            output_path = os.path.join(voice_dir, f"{start_index + i}.wav")
+            futures[i] = executor.submit(bind(synthesize), i, lines[i].get("kana", lines[i]["kanji"]).strip(), output_path)
+
+        with llm_stage() if llm_stage is not None else nullcontext():
+            for line in split_json_items(gpt.send_message_stream(STORY_MODES[mode]["prompt"], response_format=STORY_MODES[mode]["format"])):
+                lines.append(line)
+                if is_valid_line(line, is_title=len(lines) == 1): # 完成した行から順にボイスを生成する
+                    submit(len(lines) - 1)
+            assert len(lines) >= 2, "物語を生成できませんでした。"
+            # 会話の履歴を送らないよう、作り直しには別のインスタンスを使う
+            broken = repair_story(lines, _story_gpt(), mode)
+        assert not broken, f"物語の不正な{len(broken)}行を作り直せませんでした。"
+        story = story_from_lines(lines)
+        if on_story is not None:
+            on_story(story)
+        with voice_stage() if voice_stage is not None else nullcontext():
+            for i in range(len(lines)):
+                if i not in futures:
+                    submit(i)
+            voice_paths = [futures[i].result() for i in range(len(lines))]
+    return story["kanji"], story["kana"], voice_paths
+
+def clear_resources(work_dir: str = "resources"):
+    """
+    作業フォルダのtextフォルダとvoiceフォルダの中にあるファイルを削除します。フォルダがない場合は作成します。
+
+    Args:
+        work_dir (str, optional): 作業フォルダ. Defaults to "resources".
+    """
+    for folder in [os.path.join(work_dir, "text"), os.path.join(work_dir, "voice")]:
+        os.makedirs(folder, exist_ok=True)
+        for file in os.listdir(folder):
+            file_path = os.path.join(folder, file)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
 def split_text_by_length(text: str, length: int) -> str:
     """
     指定された文字数で改行で区切る関数
@@ -156,95 +665,345 @@ def split_text_by_length(text: str, length: int) -> str:
 
 
 
-def create_movie(save_path: str):
+def plan_slides(story_lines: list, story_voices: list, voice_dir: str = "resources/voice") -> list:
+    """
+    動画を構成するスライドの一覧を作成します。
+
+    Args:
+        story_lines (list): 物語の行のリスト（最初の行はタイトル）
+        story_voices (list): 物語の行ごとのボイスファイルのパスのリスト
+        voice_dir (str, optional): 前口上とエンディングのボイスの保存先のフォルダ. Defaults to "resources/voice".
+
+    Returns:
+        list: スライドの辞書のリスト。kind（種類）, text（表示するテキスト）, voice（ボイスファイルのパス）,
+            reading（ボイスを生成する場合の読み上げるテキスト）を持ちます。
+    """
+    slides = [{"kind": "title", "text": story_lines[0], "voice": None, "reading": None},
+              {"kind": "intro", "text": "", "voice": os.path.join(voice_dir, "0.wav"), "reading": INTRO_TEXT},
+              {"kind": "story_title", "text": story_lines[0], "voice": story_voices[0], "reading": None}]
+    for line, voice in zip(story_lines[1:], story_voices[1:]):
+        slides.append({"kind": "story", "text": line, "voice": voice, "reading": None})
+    slides.append({"kind": "ending", "text": "", "voice": os.path.join(voice_dir, "1000.wav"), "reading": ENDING_TEXT})
+    return slides
+
+def processed_voice_path(voice_path: str) -> str:
+    """
+    後処理したボイスの保存先を返します。元のボイスは残すので、何度作り直しても同じ結果になります。
+    """
+    return os.path.join(os.path.dirname(voice_path), "processed", os.path.basename(voice_path))
+
+def process_slide_voices(slides: list, audio_settings: dict = AUDIO_SETTINGS):
+    """
+    スライドのボイスをまとめて後処理し（無音の切り詰め、音量の正規化、リサンプリング）、
+    スライドのボイスを後処理したものに置き換えて、その長さをvoice_durationに記録します。
+
+    Args:
+        slides (list): ボイスが用意されたスライドのリスト
+        audio_settings (dict, optional): Audio_processor.process_voicesの設定. Defaults to AUDIO_SETTINGS.
+    """
+    slides = [slide for slide in slides if slide["voice"] is not None]
+    if not slides:
+        return
+    output_paths = [processed_voice_path(slide["voice"]) for slide in slides]
+    for folder in {os.path.dirname(path) for path in output_paths}:
+        os.makedirs(folder, exist_ok=True)
+    durations = process_voices([slide["voice"] for slide in slides], output_paths, **audio_settings)
+    for slide, output_path, duration in zip(slides, output_paths, durations):
+        slide["voice"], slide["voice_duration"] = output_path, duration
+
+def prepare_slide_voice(slide: dict, speaker: int = 22, speed: float = 0.75, audio_settings: dict = None) -> dict:
+    """
+    スライドのボイスを用意し、スライドの長さを求めます。
+
+    Args:
+        slide (dict): plan_slidesで作成したスライド
+        speaker (int, optional): 声の種類. Defaults to 22.
+        speed (float, optional): 話す速さ. Defaults to 0.75.
+        audio_settings (dict, optional): ここで生成したボイスの後処理の設定. Defaults to None（後処理しない）.
+
+    Returns:
+        dict: durationを追加したスライド
+    """
+    if slide["reading"] is not None:
+        if generate_voice_retry(slide["reading"], speaker=speaker, speed=speed, output_path=slide["voice"]) is None:
+            raise RuntimeError(f"ボイスを生成できませんでした。 > {slide['voice']}")
+        if audio_settings is not None:
+            process_slide_voices([slide], audio_settings)
+    if slide["voice"] is None:
+        slide["duration"] = TITLE_DURATION
+    else:
+        # 後処理で求めた長さがあればそれを使い、なければ音声の長さをヘッダーから取得する
+        voice_duration = slide["voice_duration"] if "voice_duration" in slide else read_wav_info(slide["voice"])["duration"]
+        slide["duration"] = voice_duration + SLIDE_PADDING[slide["kind"]]
+    # セグメントはフレーム単位の長さになるので、音声とずれないようにスライドの長さをフレームの境界に揃える
+    slide["duration"] = math.ceil(slide["duration"] * VIDEO_SETTINGS["fps"] - 1e-6) / VIDEO_SETTINGS["fps"]
+    return slide
+
+def build_slide(slide: dict, maker=Movie_maker) -> Movie_maker:
+    """
+    スライドのクリップを構成します。
+
+    Args:
+        slide (dict): prepare_slide_voiceでdurationを求めたスライド
+        maker (type, optional): クリップのクラス。Recipe_recorderを渡すと、描画せずにレイヤーの構成だけを記録します. Defaults to Movie_maker.
+
+    Returns:
+        Movie_maker: スライドのクリップ
+    """
+    clip = maker(duration=slide["duration"])
+    if slide["kind"] == "title": # タイトル
+        clip.add_image(IMG_TITLE_BG_PATH, position=(0, 0), resize_ratio_x=1, resize_ratio_y=1)
+        clip.add_rectangle(position=(0, 0), size=(1920, 1080), color=(0, 0, 0), alpha=150)
+        clip.add_image(IMG_ZUNDA_PATH, position=(850, 200), resize_ratio_x=2.3, resize_ratio_y=2.3)
+        clip.add_text("ずんだもんが囁き声で\n読み聞かせる物語", position=(380, 100), fontsize=130, color="white", stroke_color="black", stroke_width=2, font=FONT_PATH, weight="bold")
+        clip.add_text(f"『{slide['text']}』", position="center", fontsize=170, color="white", stroke_color="black", stroke_width=4, font=FONT_PATH, weight="bold")
+        return clip
+
+    clip.add_image(IMG_BG_PATH, position=(0, 0), resize_ratio_x=1, resize_ratio_y=1)
+    clip.add_image(IMG_ZUNDA_PATH, position=(1250, 400), resize_ratio_x=1.2, resize_ratio_y=1.2)
+    if slide["kind"] == "intro": # 動画説明
+        clip.add_text("「語りのずんだ」へようこそなのだ。", start_time=0, end_time=3.5, position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=FONT_PATH)
+        clip.add_text("この動画では、僕があなたにいろんな物語を読み聞かせるのだ。", start_time=3.5, end_time=11, position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=FONT_PATH)
+        clip.add_text("今回の物語はこれなのだ。", start_time=11, position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=FONT_PATH)
+    elif slide["kind"] == "story_title": # 物語タイトル
+        clip.add_text(slide["text"], position="center", fontsize=100, color="white", stroke_color="black", stroke_width=2, font=FONT_PATH)
+    elif slide["kind"] == "story": # 物語本文
+        clip.add_text(split_text_by_length(slide["text"], 36), position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=FONT_PATH)
+    return clip
+
+def slide_recipe(slide: dict) -> dict:
+    """
+    build_slideが追加するレイヤーの構成を、描画せずに返します。タイムラインのマニフェストと、セグメントのキャッシュのキーに使います。
+    テキストの大きさや色、表示する時間、フォントも含むので、build_slideの配置を変えるとキーも変わります。
+    """
+    return build_slide(slide, maker=Recipe_recorder).recipe()
+
+def encode_slide(slide: dict, segment_path: str, video_settings: dict) -> dict:
+    """
+    スライドを構成し、映像をセグメントとしてエンコードします。エンコードが終わったクリップは解放されます。
+    ワーカーのプロセスでも実行できるよう、必要な値はすべて引数で受け取ります。
+
+    Args:
+        slide (dict): prepare_slide_voiceでdurationを求めたスライド
+        segment_path (str): セグメントの保存先
+        video_settings (dict): エンコードの設定（VIDEO_SETTINGS）
+
+    Returns:
+        dict: compose_sec（構成にかかった時間）, encode_sec（エンコードにかかった時間）
+    """
+    start = time.perf_counter()
+    clip = build_slide(slide)
+    composed = time.perf_counter()
+    try:
+        clip.encode_segment(segment_path, **video_settings)
+    finally:
+        clip.close() # 次のスライドを構成する前に、このスライドのレイヤーを解放する
+    return {"compose_sec": composed - start, "encode_sec": time.perf_counter() - composed}
+
+def render_slide(slide: dict, segment_dir: str, settings: dict = None, cache=None, budget=None, pool=None) -> dict:
+    """
+    スライドを構成し、映像をセグメントとしてエンコードします（encode_slide）。
+    キャッシュを指定した場合は、同じ内容のスライドのセグメントがあればエンコードせずに使います。
+    予算を指定した場合は、メモリ使用量が予算を超えていれば画像のキャッシュを解放し、予算に収まるまでスライドの構成を始めずに待ちます。
+    プロセスプールを指定した場合は、構成とエンコードをワーカーのプロセスで行います。
+    ワーカーのメモリ使用量は予算に含まれないので、その場合のメモリ使用量はプロセスの数で抑えます。
+
+    Args:
+        slide (dict): prepare_slide_voiceでdurationを求めたスライド
+        segment_dir (str): セグメントの保存先のフォルダ
+        settings (dict, optional): エンコードの設定（キャッシュのキーに含めます）. Defaults to None.
+        cache (Segment_cache, optional): セグメントのキャッシュ. Defaults to None（キャッシュを使わない）.
+        budget (Memory_budget, optional): メモリ使用量の予算. Defaults to None（制限しない）.
+        pool (ProcessPoolExecutor, optional): 構成とエンコードを行うプロセスプール. Defaults to None（このプロセスで行う）.
+
+    Returns:
+        dict: segment（セグメントのパス）を追加したスライド
+    """
+    metrics = get_metrics()
+    slide["segment"] = os.path.join(segment_dir, f"{slide['index']}.mp4")
+    if cache is not None:
+        key = slide_key(slide["kind"], slide["text"], slide["duration"], slide_recipe(slide), settings)
+        if cache.get(key, slide["segment"]):
+            metrics.count("movie.segment_cache_hit")
+            return slide
+        metrics.count("movie.segment_cache_miss")
+    with budget.reserve(release=get_image_cache().clear) if budget is not None else nullcontext():
+        if pool is not None:
+            timings = pool.submit(encode_slide, slide, slide["segment"], VIDEO_SETTINGS).result()
+        else:
+            timings = encode_slide(slide, slide["segment"], VIDEO_SETTINGS)
+    frames = round(slide["duration"] * VIDEO_SETTINGS["fps"])
+    metrics.record("movie.compose", sec=timings["compose_sec"], kind=slide["kind"])
+    metrics.record("movie.encode", sec=timings["encode_sec"], kind=slide["kind"], frames=frames,
+                   fps=frames / max(timings["encode_sec"], 1e-9))
+    if cache is not None:
+        cache.put(key, slide["segment"])
+    return slide
+
+def build_scene(slide: dict) -> dict:
+    """
+    字幕以外の背景のレイヤーを、Subtitle_renderer.render_slideshowの場面として構成します。build_slideと同じ配置です。
+
+    Args:
+        slide (dict): prepare_slide_voiceでdurationを求めたスライド
+
+    Returns:
+        dict: duration（長さ）とlayers（レイヤーのリスト）をもつ場面
+    """
+    if slide["kind"] == "title":
+        layers = [{"image": IMG_TITLE_BG_PATH, "position": (0, 0), "size": (1920, 1080)},
+                  {"color": (0, 0, 0), "alpha": 150, "position": (0, 0), "size": (1920, 1080)},
+                  {"image": IMG_ZUNDA_PATH, "position": (850, 200), "size": (round(1920 * 2.3), round(1080 * 2.3))}]
+    else:
+        layers = [{"image": IMG_BG_PATH, "position": (0, 0), "size": (1920, 1080)},
+                  {"image": IMG_ZUNDA_PATH, "position": (1250, 400), "size": (round(1920 * 1.2), round(1080 * 1.2))}]
+    return {"duration": slide["duration"], "layers": layers}
+
+def add_slide_subtitles(track: Subtitle_track, slide: dict, start_time: float):
+    """
+    スライドのテキストを字幕として追加します。build_slideと同じ配置です。
+
+    Args:
+        track (Subtitle_track): 字幕を追加するトラック
+        slide (dict): prepare_slide_voiceでdurationを求めたスライド
+        start_time (float): スライドの開始時刻
+    """
+    end_time = start_time + slide["duration"]
+    if slide["kind"] == "title": # タイトル
+        track.add_event(start_time, end_time, "ずんだもんが囁き声で\n読み聞かせる物語", "title_header", position=(380, 100))
+        track.add_event(start_time, end_time, f"『{slide['text']}』", "title")
+    elif slide["kind"] == "intro": # 動画説明
+        track.add_event(start_time, start_time + 3.5, "「語りのずんだ」へようこそなのだ。", "story")
+        track.add_event(start_time + 3.5, start_time + 11, "この動画では、僕があなたにいろんな物語を読み聞かせるのだ。", "story")
+        track.add_event(start_time + 11, end_time, "今回の物語はこれなのだ。", "story")
+    elif slide["kind"] == "story_title": # 物語タイトル
+        track.add_event(start_time, end_time, slide["text"], "story_title")
+    elif slide["kind"] == "story": # 物語本文
+        track.add_event(start_time, end_time, split_text_by_length(slide["text"], 36), "story")
+
+def render_subtitled_movie(slides: list, save_path: str, audio_path: str):
+    """
+    スライドを背景の場面と字幕に変換し、ffmpegを1回だけ実行して動画を作成します。
+
+    Args:
+        slides (list): prepare_slide_voiceでdurationを求めたスライドのリスト
+        save_path (str): 動画の保存先
+        audio_path (str): ナレーションの音声ファイルのパス
+    """
+    track = Subtitle_track()
+    track.add_style("title_header", FONT_PATH, fontsize=130, stroke_width=2, bold=True)
+    track.add_style("title", FONT_PATH, fontsize=170, stroke_width=4, bold=True)
+    track.add_style("story_title", FONT_PATH, fontsize=100, stroke_width=2)
+    track.add_style("story", FONT_PATH, fontsize=50, stroke_width=1)
+    start_time = 0
+    for slide in slides:
+        add_slide_subtitles(track, slide, start_time)
+        start_time += slide["duration"]
+    render_slideshow([build_scene(slide) for slide in slides], track, save_path, audio_path=audio_path, **VIDEO_SETTINGS)
+
+def create_movie(save_path: str, workers: int = 1, voice_workers: int = VOICE_WORKERS, renderer: str = "movie_maker",
+                 work_dir: str = "resources", speaker: int = 22, speed: float = 0.75, use_segment_cache: bool = True, memory_budget=None,
+                 audio_settings: dict = AUDIO_SETTINGS):
     """
     物語の読み聞かせ動画を生成します。
+    ボイスの準備、スライドの構成とエンコードをパイプラインで流すため、ボイスができたスライドから順に描画・エンコードが始まります。
+    スライドは1枚ずつ構成してエンコードし、すぐに解放します。音声トラックもスライドごとに書き出すので、物語が長くてもメモリ使用量は増えません。
+    物語のボイスは最初にまとめて後処理し（無音の切り詰め、音量の正規化、リサンプリング）、切り詰めた長さをスライドの長さに使います。
+    描画中のピークメモリ使用量と開いているファイルの数の最大値を計測して表示します。
+    スライドごとのテキスト・音声・長さ・開始時刻・レイヤーの構成は、動画の横にタイムラインのマニフェスト（.timeline.json）として保存します。
+
+    Args:
+        save_path (str): 動画の保存先
+        workers (int, optional): スライドを並列に描画・エンコードするプロセスの数（2以上でプロセスプールを使います）. Defaults to 1.
+        voice_workers (int, optional): ボイスを並列に準備するワーカーの数. Defaults to VOICE_WORKERS.
+        renderer (str, optional): 映像の作り方. Defaults to "movie_maker".
+            "movie_maker": スライドごとにMovie_makerで合成してエンコードし、連結します。
+            "ffmpeg": 背景と字幕（ASS）と音声から、ffmpegを1回だけ実行して作成します（Subtitle_renderer）。
+        work_dir (str, optional): 物語のテキスト（text）とボイス（voice）のフォルダがある作業フォルダ. Defaults to "resources".
+        speaker (int, optional): 前口上とエンディングの声の種類. Defaults to 22.
+        speed (float, optional): 前口上とエンディングの話す速さ. Defaults to 0.75.
+        use_segment_cache (bool, optional): 内容が同じスライドは、キャッシュしたセグメントを使います（"movie_maker"のみ）。
+            1行だけ直して作り直す場合は、その行のスライドだけがエンコードされます. Defaults to True.
+        memory_budget (Memory_budget, optional): メモリ使用量の予算. Defaults to None（プロセス全体で共有する予算を使う）.
+        audio_settings (dict, optional): ボイスの後処理の設定. Defaults to AUDIO_SETTINGS. Noneの場合は後処理しません。
     """
-    text = """
-    語りのずんだへようこそなのだ。この動画では、ぼくがあなたにいろんなものがたりを、よみきかせるのだ。こんかいのものがたりはこれなのだ。
+    global story_title
+    metrics = get_metrics()
+    # 物語の行と、行ごとのボイスファイル（10.wavから順番）を読み込む
+    text_dir, voice_dir = os.path.join(work_dir, "text"), os.path.join(work_dir, "voice")
+    story_lines = []
+    for i in range(len([f for f in os.listdir(text_dir) if f.endswith(".txt")])):
+        with open(os.path.join(text_dir, f"{i}.txt"), "r", encoding="utf-8") as f:
+            story_lines.append(f.read())
+    story_voices = [os.path.join(voice_dir, f"{i + 10}.wav") for i in range(len(story_lines))]
+    story_title = story_lines[0]
+
+    slides = plan_slides(story_lines, story_voices, voice_dir=voice_dir)
+    for i, slide in enumerate(slides):
+        slide["index"] = i
+    if audio_settings is not None:
+        # 生成済みの物語のボイスは、全行をまとめて後処理する（前口上とエンディングはボイスの生成後に処理する）
+        with metrics.timer("movie.audio", voices=len(story_voices)):
+            process_slide_voices([slide for slide in slides if slide["reading"] is None], audio_settings)
+    print(f"合計{len(slides)}枚のスライドを構成しています...")
+
+    segment_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(save_path)))
+    budget = memory_budget if memory_budget is not None else get_memory_budget()
+    with budget.monitor() as usage:
+        _render_movie(slides, save_path, segment_dir, workers, voice_workers, renderer, speaker, speed, use_segment_cache, budget, audio_settings)
+    metrics.record("movie.memory", **usage)
+    if usage["peak_rss"] is not None:
+        limit = f"{budget.max_bytes / 1024 ** 2:.0f}MB" if budget.max_bytes is not None else "なし"
+        print(f"描画中のピークメモリ使用量: {usage['peak_rss'] / 1024 ** 2:.0f}MB（予算: {limit}, 予算を超えて待った回数: {usage['waits']}回, 解放した回数: {usage['releases']}回）, "
+              f"開いているファイルの数の最大値: {usage['peak_handles']}")
+    print(f"クリップをエクスポートしました。 > {save_path}")
+
+def _render_movie(slides, save_path, segment_dir, workers, voice_workers, renderer, speaker, speed, use_segment_cache, budget, audio_settings):
     """
-    generate_voice(text, speaker=22, speed=0.75, output_path="resources/voice/0.wav")
-    text_end = """
-    これでこのものがたりはおわりなのだ。ぜひほかのものがたりもきいていってもらえるとうれしいのだ。それでは、べつのものがたりでまたあおうなのだ。ばいばい。
+    create_movieの本体です。スライドのボイスの準備から動画の書き出しまでを行い、最後にsegment_dirを削除します。
     """
-    generate_voice(text_end, speaker=22, speed=0.75, output_path="resources/voice/1000.wav")
-    # ボイスファイルのリストを生成
-    voice_path = [f for f in os.listdir("resources/voice") if f.endswith(".wav")]
-    voice_path.sort(key=lambda x: int(x.split('.')[0]))  # ファイル名の数字順にソート
-    voice_path = [f"resources/voice/{f}" for f in voice_path]
-    
-    print(f"合計{len(voice_path)}個のボイスファイルが見つかりました。")
+    metrics = get_metrics()
+    pool = None
+    if renderer == "movie_maker" and workers > 1:
+        # 合成はPythonの処理が多いので、スライドごとに別のプロセスで構成・エンコードし、ストリームコピーで連結する
+        # Windowsと同じく、スレッドを動かしているプロセスをforkしないようspawnで起動する
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        # ボイスの準備 → スライドの構成とエンコード の順に、段階ごとに並列に処理する
+        pipeline = Pipeline(maxsize=max(2, 2 * workers))
+        pipeline.add_stage("voice", lambda slide: prepare_slide_voice(slide, speaker=speaker, speed=speed, audio_settings=audio_settings), workers=voice_workers)
+        if renderer == "movie_maker":
+            settings = resolve_encoder(**VIDEO_SETTINGS)
+            cache = get_segment_cache() if use_segment_cache else None
+            pipeline.add_stage("render", lambda slide: render_slide(slide, segment_dir, settings, cache, budget, pool), workers=workers)
+        slides = pipeline.run(tqdm(slides))
+        for name, stats in pipeline.stats.items():
+            metrics.record(f"pipeline.{name}", **stats)
 
-    img_zunda_path = "resources/image/立ち絵.png"
-    img_gb_path = "resources/image/background.png"
-    img_title_bg_path = "resources/image/title_bg.jpg"
-    text_path = "resources/text/"
-    font_path = "fonts/HGRGY.TTC"
-    
-    clips = [] # クリップのリスト    
-    print("クリップを構成しています...")
-    
-    
-    n_voices = len(voice_path)
-    for i in tqdm(range(n_voices)):
-        if i!=0:
-            audio = AudioSegment.from_wav(voice_path[i-1]) # 音声ファイルを読み込む
-            duration_sec = audio.duration_seconds # 音声の長さを取得
-        if i==0 or 2 < i < n_voices-1: # 物語本体（タイトルから）
-            with open(text_path+str(i)+".txt", "r", encoding="utf-8") as f:
-                text = f.read()
-        if i == 0: # タイトル
-            global story_title
-            story_title = text
-            clips.append(Movie_maker(duration=2.5)) # タイトルのClipを作成
-            clips[i].add_image(img_title_bg_path, position=(0, 0), resize_ratio_x=1, resize_ratio_y=1)
-            clips[i].add_rectangle(position=(0, 0), size=(1920, 1080), color=(0, 0, 0), alpha=150)
-            clips[i].add_image(img_zunda_path, position=(850, 200), resize_ratio_x=2.3, resize_ratio_y=2.3)
-            clips[i].add_text("ずんだもんが囁き声で\n読み聞かせる物語", position=(380, 100), fontsize=130, color="white", stroke_color="black", stroke_width=2, font=font_path, weight="bold")
-            clips[i].add_text(f"『{story_title}』", position="center", fontsize=170, color="white", stroke_color="black", stroke_width=4, font=font_path, weight="bold")
-        elif i == 1: # 動画説明
-            clips.append(Movie_maker(duration=(duration_sec + 2.5))) # 前口上とタイトルのClipを作成
-            clips[i].add_image(img_gb_path, position=(0, 0), resize_ratio_x=1, resize_ratio_y=1)
-            clips[i].add_image(img_zunda_path, position=(1250, 400), resize_ratio_x=1.2, resize_ratio_y=1.2)
-            clips[i].add_text("「語りのずんだ」へようこそなのだ。", start_time=0, end_time=3.5, position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=font_path)
-            clips[i].add_text("この動画では、僕があなたにいろんな物語を読み聞かせるのだ。", start_time=3.5, end_time=11, position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=font_path)
-            clips[i].add_text("今回の物語はこれなのだ。", start_time=11, position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=font_path)
-        elif i == 2: # 物語タイトル
-            clips.append(Movie_maker(duration=(duration_sec + 1.5))) # 前口上とタイトルのClipを作成
-            clips[i].add_image(img_gb_path, position=(0, 0), resize_ratio_x=1, resize_ratio_y=1)
-            clips[i].add_image(img_zunda_path, position=(1250, 400), resize_ratio_x=1.2, resize_ratio_y=1.2)
-            clips[i].add_text(text, position="center", fontsize=100, color="white", stroke_color="black", stroke_width=2, font=font_path)
-
-        elif i == n_voices-1: # エンディング
-            clips.append(Movie_maker(duration=(duration_sec + 1.5))) # 前口上とタイトルのClipを作成
-            clips[i].add_image(img_gb_path, position=(0, 0), resize_ratio_x=1, resize_ratio_y=1)
-            clips[i].add_image(img_zunda_path, position=(1250, 400), resize_ratio_x=1.2, resize_ratio_y=1.2)
-        else: # 物語本分
-            text = split_text_by_length(text, 36)
-            clips.append(Movie_maker(duration=(duration_sec + 1))) # 物語のClipを作成
-            clips[i].add_image(img_gb_path, position=(0, 0), resize_ratio_x=1, resize_ratio_y=1)
-            clips[i].add_image(img_zunda_path, position=(1250, 400), resize_ratio_x=1.2, resize_ratio_y=1.2)
-            clips[i].add_text(text, position="center", fontsize=50, color="white", stroke_color="black", stroke_width=1, font=font_path)
-        if i!=0:
-            clips[i].add_audio(voice_path[i-1]) # 音声を追加
-    
-    # クリップを連結
-    for i in range(1, len(clips)):
-        clips[0].concatenate_clips(clips[i].get_clip())
-        
-    # クリップをエクスポート（GPUを使用）
-    clips[0].export_clip(save_path, remove_temp=True,
-                        codec="h264_nvenc",
-                        fps=10,
-                        ffmpeg_params=[
-                            "-preset", "fast",  # 'p1'から'fast'に変更
-                            "-crf", "23",
-                            "-b:v", "5M",     # ビットレートを指定
-                            "-maxrate", "10M", # 最大ビットレートを指定
-                            "-bufsize", "10M", # バッファサイズを指定
-                            "-tune", "fastdecode", # 高速デコードを有効化
-                            "-rc-lookahead", "20"  # ルックアヘッドバッファを小さく
-                        ])
+        # タイムラインのマニフェストを保存し、前回から内容が変わったスライドを数える
+        timeline = Timeline(resolve_encoder(**VIDEO_SETTINGS))
+        for slide in slides:
+            timeline.add_slide(slide["kind"], slide["text"], slide["voice"], slide["duration"], slide_recipe(slide))
+        manifest_path = os.path.splitext(save_path)[0] + ".timeline.json"
+        changed = timeline.changed_slides(Timeline.load(manifest_path))
+        timeline.save(manifest_path)
+        print(f"内容が変わったスライド: {len(changed)}/{len(slides)}枚")
+
+        # 全スライドの音声を1本にまとめたトラックをスライドごとに書き出し、映像に付ける
+        with metrics.timer("movie.narration"):
+            audio_path = os.path.join(segment_dir, "narration.wav")
+            write_narration_track(audio_path, [(slide["voice"], slide["duration"]) for slide in slides])
+        if renderer == "ffmpeg":
+            with metrics.timer("movie.render_slideshow", slides=len(slides)):
+                render_subtitled_movie(slides, save_path, audio_path)
+        else: # 映像はストリームコピーで連結する
+            with metrics.timer("movie.join", segments=len(slides)):
+                Movie_maker.join_segments([slide["segment"] for slide in slides], save_path, audio_path=audio_path,
+                                          duration=sum(slide["duration"] for slide in slides))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        shutil.rmtree(segment_dir, ignore_errors=True)
 
 if __name__ == "__main__":
     main()
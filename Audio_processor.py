@@ -0,0 +1,266 @@
+"""
+音声ファイルをNumPy配列としてまとめて扱う機能を提供します。
+
+@author: Yuta Tanimura
+"""
+import os
+import struct
+import wave
+
+import numpy as np
+
+SILENCE_WINDOW = 0.01 # 無音かどうかを判定する区間の長さ（秒）
+
+
+def read_wav_info(path):
+    """
+    WAVファイルのヘッダーだけを読み込み、形式と長さを返します。音声データはデコードしません。
+
+    Args:
+        path (str): WAVファイルのパス
+
+    Returns:
+        dict: sample_rate, channels, sample_width, data_offset, n_frames, durationを持つ辞書
+    """
+    with open(path, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError(f"WAVファイルではありません。 > {path}")
+        info = {}
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"WAVファイルにdataチャンクがありません。 > {path}")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                audio_format, channels, sample_rate, _, _, bits = struct.unpack("<HHIIHH", f.read(16))
+                if audio_format != 1 or bits != 16:
+                    raise ValueError(f"16bitのリニアPCM以外のWAVファイルには対応していません。 > {path}")
+                info.update(sample_rate=sample_rate, channels=channels, sample_width=bits // 8)
+                f.seek(chunk_size - 16 + chunk_size % 2, 1)
+            elif chunk_id == b"data":
+                info["data_offset"] = f.tell()
+                info["n_frames"] = chunk_size // (info["channels"] * info["sample_width"])
+                info["duration"] = info["n_frames"] / info["sample_rate"]
+                return info
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+
+def load_wav(path, info=None):
+    """
+    WAVファイルの音声データをメモリマップで読み込みます。
+
+    Args:
+        path (str): WAVファイルのパス
+        info (dict, optional): read_wav_infoの結果. Defaults to None（ここで読み込む）.
+
+    Returns:
+        np.memmap: 音声データ（int16, サンプル数×チャンネル数）
+    """
+    if info is None:
+        info = read_wav_info(path)
+    if info["n_frames"] == 0:
+        return np.zeros((0, info["channels"]), dtype="<i2")
+    return np.memmap(path, dtype="<i2", mode="r", offset=info["data_offset"], shape=(info["n_frames"], info["channels"]))
+
+
+def write_wav(path, samples, sample_rate):
+    """
+    音声データを16bitのWAVファイルとして書き出します。
+
+    Args:
+        path (str): 出力先のパス
+        samples (np.ndarray): 音声データ（float, -1〜1, サンプル数×チャンネル数）
+        sample_rate (int): サンプリングレート
+    """
+    pcm = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+
+
+def build_narration_track(entries):
+    """
+    スライドごとの音声を、各スライドの先頭に配置した1本の音声トラックを作成します。
+    各WAVはヘッダーから長さを求めたうえで1回だけ読み込み、あらかじめ確保した配列に書き込みます。
+    スライドの長さより音声が長い場合は、スライドの長さで切り詰めます。
+
+    Args:
+        entries (list): (WAVファイルのパスまたはNone, スライドの長さ)のリスト
+
+    Returns:
+        tuple: (音声データ（float32, サンプル数×チャンネル数）, サンプリングレート)
+    """
+    infos, sample_rate, channels, starts = _narration_layout(entries)
+    track = np.zeros((starts[-1], channels), dtype=np.float32)
+    for (path, _), info, start, end in zip(entries, infos, starts[:-1], starts[1:]):
+        if info is None:
+            continue
+        samples = load_wav(path, info)
+        n = min(len(samples), end - start)
+        track[start:start + n] = samples[:n] / 32768 # チャンネル数が少ない場合はブロードキャストされる
+        del samples
+    return track, sample_rate
+
+
+def write_narration_track(path, entries):
+    """
+    build_narration_trackと同じ音声トラックを、スライドごとにWAVファイルへ書き出します。
+    トラック全体を配列にしないので、物語が長くてもメモリ使用量は1枚のスライドの音声の分だけです。
+
+    Args:
+        path (str): 出力先のパス
+        entries (list): (WAVファイルのパスまたはNone, スライドの長さ)のリスト
+
+    Returns:
+        int: サンプリングレート
+    """
+    infos, sample_rate, channels, starts = _narration_layout(entries)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for (wav_path, _), info, start, end in zip(entries, infos, starts[:-1], starts[1:]):
+            block = np.zeros((end - start, channels), dtype="<i2")
+            if info is not None:
+                samples = load_wav(wav_path, info)
+                n = min(len(samples), end - start)
+                block[:n] = samples[:n] # 16bitのまま書き写す（チャンネル数が少ない場合はブロードキャストされる）
+                del samples
+            f.writeframes(block.tobytes())
+    return sample_rate
+
+
+def _narration_layout(entries):
+    """
+    音声トラックの情報と、スライドの開始位置（サンプル単位）を求めます。
+
+    Args:
+        entries (list): (WAVファイルのパスまたはNone, スライドの長さ)のリスト
+
+    Returns:
+        tuple: (WAVファイルの情報のリスト, サンプリングレート, チャンネル数, スライドの開始位置のリスト（末尾はトラックの長さ）)
+    """
+    infos = [read_wav_info(path) if path is not None else None for path, _ in entries]
+    known = [info for info in infos if info is not None]
+    if not known:
+        raise ValueError("音声ファイルが1つもありません。")
+    sample_rate = known[0]["sample_rate"]
+    channels = max(info["channels"] for info in known)
+    if any(info["sample_rate"] != sample_rate for info in known):
+        raise ValueError("サンプリングレートの異なる音声ファイルは連結できません。")
+
+    # スライドの開始位置をサンプル単位で求める（丸め誤差が積み重ならないよう、累積時間から計算する）
+    starts = [0]
+    elapsed = 0
+    for _, duration in entries:
+        elapsed += duration
+        starts.append(round(elapsed * sample_rate))
+    return infos, sample_rate, channels, starts
+
+
+def resample(samples, src_rate, dst_rate):
+    """
+    音声データをFFTで帯域制限してリサンプリングします。
+
+    Args:
+        samples (np.ndarray): 音声データ（float32, サンプル数×チャンネル数）
+        src_rate (int): 元のサンプリングレート
+        dst_rate (int): 変換後のサンプリングレート
+
+    Returns:
+        np.ndarray: 変換後の音声データ（float32, サンプル数×チャンネル数）
+    """
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    n = len(samples)
+    m = round(n * dst_rate / src_rate)
+    return (np.fft.irfft(np.fft.rfft(samples, axis=0), n=m, axis=0) * (m / n)).astype(np.float32)
+
+
+def process_voices(paths, output_paths, sample_rate=None, silence_threshold_db=-40, silence_floor_dbfs=-60, target_dbfs=-20, peak_dbfs=-1, padding=0.05):
+    """
+    複数のWAVファイルをまとめて読み込み、前後の無音の切り詰め、音量の正規化、リサンプリングを行って書き出します。
+    区間（SILENCE_WINDOW）ごとの大きさとピークは1ファイルずつ求めて、あらかじめ確保した配列に書き込み、無音の判定と音量の計算は全ファイル分を一度に行います。
+    一度にメモリに置く音声は1ファイル分だけです。
+    リサンプリングは切り詰めた後の音声に1回だけ行います（元のサンプリングレートが揃っていない場合は、先に揃えます）。
+
+    Args:
+        paths (list): 元のWAVファイルのパスのリスト
+        output_paths (list): 書き出し先のパスのリスト（元のファイルは変更しません）
+        sample_rate (int, optional): 変換後のサンプリングレート. Defaults to None（最初のファイルのサンプリングレート）.
+        silence_threshold_db (float, optional): ファイルの中で一番大きい区間からこのdB以上小さい区間を無音とみなします. Defaults to -40.
+        silence_floor_dbfs (float, optional): この音量（dBFS）より小さい区間は常に無音とみなします（無音だけのファイルのノイズを持ち上げないため）. Defaults to -60.
+        target_dbfs (float, optional): 声のある区間の平均の音量（dBFS）. Defaults to -20.
+        peak_dbfs (float, optional): 正規化した後のピークの上限（dBFS）. Defaults to -1.
+        padding (float, optional): 切り詰めた後に前後に残す無音の長さ（秒）. Defaults to 0.05.
+
+    Returns:
+        list: 書き出した音声の長さ（秒）のリスト
+    """
+    if not paths:
+        return []
+    infos = [read_wav_info(path) for path in paths]
+    channels = infos[0]["channels"]
+    if any(info["channels"] != channels for info in infos):
+        raise ValueError("チャンネル数の異なる音声ファイルはまとめて処理できません。")
+    if sample_rate is None:
+        sample_rate = infos[0]["sample_rate"]
+    source_rates = {info["sample_rate"] for info in infos}
+    source_rate = source_rates.pop() if len(source_rates) == 1 else sample_rate
+    load = lambda path, info: resample(load_wav(path, info) / np.float32(32768), info["sample_rate"], source_rate)
+
+    # ヘッダーから各ファイルの区間の数を求めて、全ファイル分の区間の大きさとピークの配列を確保する
+    window = max(1, round(source_rate * SILENCE_WINDOW))
+    lengths = [info["n_frames"] if info["sample_rate"] == source_rate else round(info["n_frames"] * source_rate / info["sample_rate"]) for info in infos]
+    n_windows = np.array([-(-length // window) for length in lengths], dtype=np.int64)
+    has_audio = n_windows > 0
+    offsets = np.concatenate([[0], np.cumsum(n_windows)])
+    power = np.zeros(offsets[-1], dtype=np.float32)
+    peak = np.zeros(offsets[-1], dtype=np.float32)
+    for path, info, offset, count in zip(paths, infos, offsets[:-1], n_windows):
+        if count == 0:
+            continue
+        # 1ファイルだけを区間の長さの倍数に揃え、区間ごとの平均の大きさとピークを求める
+        blocks = np.zeros((count * window, channels), dtype=np.float32)
+        voice = load(path, info)
+        blocks[:len(voice)] = voice
+        del voice
+        blocks = blocks.reshape(count, window * channels)
+        power[offset:offset + count] = np.mean(blocks ** 2, axis=1)
+        peak[offset:offset + count] = np.max(np.abs(blocks), axis=1)
+        del blocks
+
+    # ファイルごとに、一番大きい区間を基準にして声のある最初と最後の区間、声のある区間の平均の大きさを求める
+    first = np.zeros(len(paths), dtype=np.int64)
+    last = n_windows - 1
+    gains = np.ones(len(paths), dtype=np.float32)
+    if has_audio.any():
+        starts = offsets[:-1][has_audio]
+        loudest = np.maximum.reduceat(power, starts)
+        voiced = power > np.repeat(loudest * 10 ** (silence_threshold_db / 10), n_windows[has_audio])
+        voiced &= power > 10 ** (silence_floor_dbfs / 10)
+        index = np.arange(len(power))
+        found = np.add.reduceat(voiced, starts) > 0
+        first[has_audio] = np.where(found, np.minimum.reduceat(np.where(voiced, index, len(power)), starts) - starts, 0)
+        last[has_audio] = np.where(found, np.maximum.reduceat(np.where(voiced, index, -1), starts) - starts, n_windows[has_audio] - 1)
+        mean_power = np.add.reduceat(np.where(voiced, power, 0), starts) / np.maximum(np.add.reduceat(voiced, starts), 1)
+        max_peak = np.maximum.reduceat(peak, starts)
+        gain = np.where(mean_power > 0, np.sqrt(10 ** (target_dbfs / 10) / np.maximum(mean_power, 1e-12)), 1)
+        gain = np.minimum(gain, np.where(max_peak > 0, 10 ** (peak_dbfs / 20) / np.maximum(max_peak, 1e-12), 1)) # ピークが上限を超えないようにする
+        gains[has_audio] = gain
+
+    durations = []
+    pad = round(padding * source_rate)
+    for path, info, output_path, start, end, gain in zip(paths, infos, output_paths, first, last, gains):
+        voice = load(path, info)
+        voice = resample(voice[max(0, start * window - pad):min(len(voice), (end + 1) * window + pad)] * gain, source_rate, sample_rate)
+        # 書き出し途中のファイルが残らないよう、一時ファイルに書いてから置き換える
+        temp_path = output_path + ".tmp"
+        write_wav(temp_path, voice.reshape(-1, channels), sample_rate)
+        os.replace(temp_path, output_path)
+        durations.append(len(voice) / sample_rate)
+    return durations
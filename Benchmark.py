@@ -0,0 +1,257 @@
+"""
+OpenAI API、VOICEVOXエンジン、GPUを使わずに、動画生成の処理をオフラインで計測するベンチマークです。
+ChatGPTの代わりに合成した物語を返すFake_ChatGPTを、VOICEVOXの代わりに決まったWAVを返すローカルのサーバーを使い、
+エンコードはCPUで行います。物語の行数ごとに、段階ごとの処理時間とメモリ使用量を表示します。
+
+使い方:
+    python Benchmark.py --lines 10 100 500 --workers 2 --output benchmark.json
+
+@author: Yuta Tanimura
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import AI_youtuber
+import Metrics
+import VoiceVox
+from Audio_processor import build_narration_track, read_wav_info
+from Movie_maker import Movie_maker
+from Story_queue import Story_queue
+from VoiceVox_stub import start_stub_voicevox
+
+# CPUでのエンコード設定（静止画向けに調整したプロファイル）
+CPU_VIDEO_SETTINGS = {
+    "profile": "libx264_still",
+    "fps": 10,
+}
+
+# 合成する物語の部品
+KANJI_PHRASES = ["ずんだもんは森の奥へ歩いていきました。", "小さな川のそばで、古い地図を見つけました。", "夜空には星がきらきらと輝いていました。",
+                 "村の人たちは、不思議な音に耳をすませました。", "風が吹いて、木の葉がやさしく揺れました。", "ふたりは顔を見合わせて、静かに笑いました。"]
+KANA_PHRASES = ["ずんだもんは、もりのおくへ、あるいていきました。", "ちいさなかわのそばで、ふるいちずを、みつけました。", "よぞらには、ほしが、きらきらと、かがやいていました。",
+                "むらのひとたちは、ふしぎなおとに、みみをすませました。", "かぜがふいて、このはが、やさしくゆれました。", "ふたりは、かおをみあわせて、しずかにわらいました。"]
+
+# ベンチマークで登録するユーザー辞書
+USER_DICT = {"ずんだもん": {"pronunciation": "ズンダモン", "accent_type": 1}, "地図": {"pronunciation": "チズ", "accent_type": 1}}
+
+def synthetic_story(n_lines, seed=0):
+    """
+    指定した行数の物語を合成します。同じ行数と乱数のシードからは、同じ物語ができます。
+
+    Args:
+        n_lines (int): 物語の行数（タイトルを含む）
+        seed (int, optional): 乱数のシード. Defaults to 0.
+
+    Returns:
+        tuple: (通常バージョンの行のリスト, ひらがなとカタカナのバージョンの行のリスト)
+    """
+    rng = random.Random(seed)
+    kanji_lines, kana_lines = ["ずんだもんと星の地図"], ["ずんだもんと、ほしのちず"]
+    for _ in range(n_lines - 1):
+        i = rng.randrange(len(KANJI_PHRASES))
+        kanji_lines.append(KANJI_PHRASES[i])
+        kana_lines.append(KANA_PHRASES[i])
+    return kanji_lines, kana_lines
+
+class Fake_ChatGPT:
+    # 合成する物語の行数。run_benchmarkが設定します
+    n_lines = 10
+
+    def __init__(self, api_key, model, init_prompt="", n_memorise=10, base_url=None):
+        """
+        ChatGPTの代わりに、合成した物語を返すインスタンスを作成します。引数はChatGPTと同じで、使用しません。
+
+        Methods:
+            send_message(message:str, image_path:str=None, response_format:dict=None) -> str:
+                物語を1回で返します。
+            send_message_stream(message:str, image_path:str=None, response_format:dict=None) -> Iterator[str]:
+                物語を断片ごとに返します。
+        """
+        self.model = model
+
+    def _story_text(self, message):
+        """
+        物語を{kanji, kana}の組の配列のJSONとして返します。
+        """
+        kanji_lines, kana_lines = synthetic_story(self.n_lines)
+        lines = [{"kanji": kanji, "kana": kana} for kanji, kana in zip(kanji_lines, kana_lines)]
+        return json.dumps({"lines": lines}, ensure_ascii=False)
+
+    def send_message(self, message, image_path=None, response_format=None):
+        return self._story_text(message)
+
+    def send_message_stream(self, message, image_path=None, response_format=None):
+        text = self._story_text(message)
+        for i in range(0, len(text), 16): # APIの断片と同じくらいの長さで返す
+            yield text[i:i+16]
+
+def _prepare_workdir(workdir, font_path):
+    """
+    動画の素材と設定ファイルを、作業フォルダに用意します。
+    """
+    for folder in ["resources/text", "resources/voice", "resources/output", "resources/image", "fonts", "keys"]:
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+    shutil.copy(font_path, os.path.join(workdir, AI_youtuber.FONT_PATH))
+    Image.new("RGB", (1920, 1080), (40, 60, 90)).save(os.path.join(workdir, AI_youtuber.IMG_BG_PATH))
+    Image.new("RGB", (1920, 1080), (90, 60, 40)).save(os.path.join(workdir, AI_youtuber.IMG_TITLE_BG_PATH))
+    zunda = Image.new("RGBA", (1920, 1080), (0, 0, 0, 0))
+    ImageDraw.Draw(zunda).ellipse([500, 100, 1400, 1000], fill=(120, 200, 80, 255))
+    zunda.save(os.path.join(workdir, AI_youtuber.IMG_ZUNDA_PATH))
+    with open(os.path.join(workdir, "keys/ChatGPT_params.json"), "w") as f:
+        json.dump({"api_key": "benchmark", "model": "fake"}, f)
+    os.makedirs(os.path.dirname(os.path.join(workdir, VoiceVox.USER_DICT_PATH)), exist_ok=True)
+    with open(os.path.join(workdir, VoiceVox.USER_DICT_PATH), "w", encoding="utf-8") as f:
+        json.dump(USER_DICT, f, ensure_ascii=False)
+
+def _measure(results, name, func):
+    """
+    1つの段階の処理時間と、終わった時点のピークメモリ使用量を記録します。
+    """
+    start = time.perf_counter()
+    value = func()
+    results[name] = {"sec": round(time.perf_counter() - start, 3), "peak_rss_mb": _to_mb(Metrics.peak_rss())}
+    print(f"  {name}: {results[name]['sec']:.2f}秒")
+    return value
+
+def _to_mb(n_bytes):
+    return None if n_bytes is None else round(n_bytes / 1024 / 1024, 1)
+
+def _reset_voice_cache():
+    """
+    音声キャッシュを空にします。段階ごとに、キャッシュに当たらない状態からボイスを生成させるために使います。
+    """
+    shutil.rmtree(VoiceVox.CACHE_DIR, ignore_errors=True)
+    VoiceVox._voice_cache = None
+
+def _queue_story(voice_dir):
+    """
+    ジョブがキューの物語を使う場合と同じく、ユーザー辞書を登録し、キューに入れた物語を取り出して、
+    /multi_synthesisでまとめてボイスを生成します。
+    """
+    assert VoiceVox.sync_user_dict() is not None, "ユーザー辞書を登録できませんでした。"
+    queue = Story_queue()
+    queue.put(AI_youtuber.create_story())
+    story = queue.pop()
+    os.makedirs(voice_dir, exist_ok=True)
+    voice_paths = VoiceVox.generate_voices_batch(story["kana"], speaker=22, speed=0.75, out_dir=voice_dir, start_index=10)
+    assert None not in voice_paths, "ボイスを生成できませんでした。"
+
+def _export_timeline(save_path):
+    """
+    create_movieと同じスライドを1本のタイムラインに連結し、export_clipで書き出します。
+    ボイスもcreate_movieと同じく後処理したもの（無音の切り詰め、音量の正規化、リサンプリング）を使います。
+    """
+    slides = []
+    for i in range(len(os.listdir("resources/text"))):
+        with open(f"resources/text/{i}.txt", "r", encoding="utf-8") as f:
+            slides.append(f.read())
+    slides = AI_youtuber.plan_slides(slides, [f"resources/voice/{i + 10}.wav" for i in range(len(slides))])
+    AI_youtuber.process_slide_voices([slide for slide in slides if slide["reading"] is None], AI_youtuber.AUDIO_SETTINGS)
+    slides = [AI_youtuber.prepare_slide_voice(slide, audio_settings=AI_youtuber.AUDIO_SETTINGS) for slide in slides]
+    movie = Movie_maker.concatenate_many([AI_youtuber.build_slide(slide) for slide in slides])
+    movie.set_audio_track(*build_narration_track([(slide["voice"], slide["duration"]) for slide in slides]))
+    movie.export_clip(save_path, still=True, **CPU_VIDEO_SETTINGS)
+
+def run_benchmark(n_lines, font_path, workers=1, tts_latency=0.0, export_clip=True, keep_workdir=False):
+    """
+    合成した物語で、キューの物語のボイスの生成、物語とボイスのストリーミング生成、create_movie、export_clipを順に実行し、段階ごとに計測します。
+
+    Args:
+        n_lines (int): 物語の行数
+        font_path (str): 字幕に使うフォントのパス
+        workers (int, optional): 並列に描画・エンコードするワーカーの数. Defaults to 1.
+        tts_latency (float, optional): VOICEVOXの代わりのサーバーの1リクエストあたりの待ち時間（秒）. Defaults to 0.0.
+        export_clip (bool, optional): export_clipでの書き出しも計測します. Defaults to True.
+        keep_workdir (bool, optional): 作業フォルダを削除せずに残します. Defaults to False.
+
+    Returns:
+        dict: 段階ごとの処理時間とメモリ使用量、計測結果の集計
+    """
+    font_path = os.path.abspath(font_path)
+    workdir = tempfile.mkdtemp(prefix=f"benchmark_{n_lines}_")
+    cwd = os.getcwd()
+    server = start_stub_voicevox(tts_latency)
+    original = (AI_youtuber.ChatGPT, AI_youtuber.VIDEO_SETTINGS)
+    AI_youtuber.ChatGPT, AI_youtuber.VIDEO_SETTINGS = Fake_ChatGPT, CPU_VIDEO_SETTINGS
+    Fake_ChatGPT.n_lines = n_lines
+    VoiceVox._voice_cache = None # 作業フォルダのキャッシュを使う
+    user_dict_version = VoiceVox._user_dict_version
+    results = {"lines": n_lines, "workers": workers, "stages": {}}
+    try:
+        _prepare_workdir(workdir, font_path)
+        os.chdir(workdir)
+        metrics = Metrics.start_run("metrics")
+        print(f"{n_lines}行の物語で計測しています... > {workdir}")
+
+        def create_story():
+            kanji_lines, _, voice_paths = AI_youtuber.create_story_stream(voice_dir="resources/voice", speaker=22, speed=0.75, start_index=10)
+            assert None not in voice_paths, "ボイスを生成できませんでした。"
+            for i, line in enumerate(kanji_lines):
+                with open(f"resources/text/{i}.txt", "w", encoding="utf-8") as f:
+                    f.write(line)
+        _measure(results["stages"], "queue_story_and_voice", lambda: _queue_story("resources/queue/voice"))
+        _reset_voice_cache() # ストリーミング生成でも、すべての行をエンジンで合成させる
+        _measure(results["stages"], "story_and_voice", create_story)
+        _measure(results["stages"], "create_movie", lambda: AI_youtuber.create_movie("resources/output/create_movie.mp4", workers=workers))
+        if export_clip:
+            _measure(results["stages"], "export_clip", lambda: _export_timeline("resources/output/export_clip.mp4"))
+        results["voice_sec"] = round(sum(read_wav_info(f"resources/voice/{i + 10}.wav")["duration"] for i in range(n_lines)), 1)
+        results["metrics"] = Metrics.end_run()
+    finally:
+        os.chdir(cwd)
+        AI_youtuber.ChatGPT, AI_youtuber.VIDEO_SETTINGS = original
+        VoiceVox._voice_cache, VoiceVox._user_dict_version = None, user_dict_version
+        server.shutdown()
+        server.server_close()
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def print_report(all_results):
+    """
+    行数ごとの計測結果を表にして表示します。
+    """
+    stages = ["queue_story_and_voice", "story_and_voice", "create_movie", "export_clip"]
+    print("\n" + "行数".ljust(8) + "".join(stage.rjust(18) for stage in stages) + "ピークメモリ(MB)".rjust(18))
+    for results in all_results:
+        row = str(results["lines"]).ljust(8)
+        for stage in stages:
+            row += (f"{results['stages'][stage]['sec']:.2f}秒" if stage in results["stages"] else "-").rjust(18)
+        row += str(results["metrics"]["peak_rss"] and _to_mb(results["metrics"]["peak_rss"])).rjust(18)
+        print(row)
+    for results in all_results:
+        print(f"\n[{results['lines']}行] 処理ごとの合計時間")
+        for name, total in sorted(results["metrics"]["timers"].items(), key=lambda item: -item[1]["sec"]):
+            print(f"  {name.ljust(20)} {total['sec']:8.2f}秒 ({total['n']}回, 最大{total['max_sec']:.2f}秒)")
+
+def main():
+    parser = argparse.ArgumentParser(description="動画生成の処理をオフラインで計測します。")
+    parser.add_argument("--lines", type=int, nargs="+", default=[10, 100, 500], help="物語の行数（複数指定可）")
+    parser.add_argument("--workers", type=int, default=1, help="並列に描画・エンコードするワーカーの数")
+    parser.add_argument("--font", default=AI_youtuber.FONT_PATH, help="字幕に使うフォントのパス")
+    parser.add_argument("--tts-latency", type=float, default=0.0, help="VOICEVOXの代わりのサーバーの1リクエストあたりの待ち時間（秒）")
+    parser.add_argument("--skip-export-clip", action="store_true", help="export_clipでの書き出しを計測しません")
+    parser.add_argument("--keep-workdir", action="store_true", help="作業フォルダを削除せずに残します")
+    parser.add_argument("--output", help="計測結果を保存するJSONファイルのパス")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.font):
+        print(f"[Error]: フォントが見つかりません。--fontで指定してください。 > {args.font}")
+        return
+    all_results = [run_benchmark(n_lines, args.font, workers=args.workers, tts_latency=args.tts_latency,
+                                 export_clip=not args.skip_export_clip, keep_workdir=args.keep_workdir) for n_lines in args.lines]
+    print_report(all_results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(all_results, f, ensure_ascii=False, indent=2)
+        print(f"計測結果を保存しました。 > {args.output}")
+
+if __name__ == "__main__":
+    main()
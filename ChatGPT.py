@@ -4,14 +4,131 @@
 @author: Yuta Tanimura
 """
 
+import asyncio
 import base64
 import json
+import random
+import threading
+import time
 
-from openai import OpenAI
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
+
+from Metrics import get_metrics
+
+
+# まとめて送るリクエストの設定
+MAX_CONCURRENCY = 4 # 同時に送るリクエストの数
+MAX_RETRIES = 6 # レート制限（429）や一時的なエラーのときにリトライする回数
+MAX_BACKOFF = 60 # リトライまでの待ち時間の上限（秒）
+
+_clients = {} # (api_key, base_url)ごとのクライアント。接続をインスタンスの間で使い回す
+_async_clients = {} # (api_key, base_url)ごとの(イベントループ, 非同期のクライアント)
+_clients_lock = threading.Lock()
+
+
+def _get_client(api_key, base_url=None):
+    """
+    APIキーとURLごとに1つだけ作成したクライアントを返します。インスタンスを作り直しても接続を使い回します。
+    """
+    with _clients_lock:
+        key = (api_key, base_url)
+        if key not in _clients:
+            _clients[key] = OpenAI(api_key=api_key, base_url=base_url)
+        return _clients[key]
+
+
+def _get_async_client(api_key, base_url=None):
+    """
+    実行中のイベントループで使う非同期のクライアントを、APIキーとURLごとに1つだけ作成して返します。
+    同じイベントループの中では接続を使い回します。リトライはsend_messages_asyncで行うので、クライアントのリトライは無効にします。
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        key = (api_key, base_url)
+        if key not in _async_clients or _async_clients[key][0] is not loop:
+            _async_clients[key] = (loop, AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0))
+        return _async_clients[key][1]
+
+
+async def close_async_clients():
+    """
+    実行中のイベントループで作成した非同期のクライアントを閉じます。イベントループを終える前に呼び出します。
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        keys = [key for key, (client_loop, _) in _async_clients.items() if client_loop is loop]
+        clients = [_async_clients.pop(key)[1] for key in keys]
+    for client in clients:
+        await client.close()
+
+
+def _format_kwargs(response_format):
+    """
+    回答の形式を指定した場合だけ、リクエストにresponse_formatを含めます。
+    """
+    return {} if response_format is None else {"response_format": response_format}
+
+
+def _retry_after(error, attempt):
+    """
+    リトライまでの待ち時間（秒）を返します。Retry-Afterヘッダーがあればその値を、なければ指数バックオフの値を使います。
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(MAX_BACKOFF, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+    return min(MAX_BACKOFF, 2 ** attempt + random.random())
+
+
+def split_json_items(chunks):
+    """
+    ストリーミングで届くJSONの断片をつなぎ、最初の配列の要素が1つ完成するたびに返します。
+    {"lines": [...]}のように配列がオブジェクトの中にあっても構いません。配列の前の部分は読み飛ばします。
+
+    Args:
+        chunks (iterable): JSONの断片
+
+    Yields:
+        object: 完成した配列の要素
+
+    Raises:
+        ValueError: 配列が閉じる前に断片が終わった場合（接続が途中で切れた場合や、要素として解釈できない部分がある場合）
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    in_array = False
+    for chunk in chunks:
+        buffer += chunk
+        if not in_array:
+            start = buffer.find("[")
+            if start < 0:
+                continue
+            buffer, in_array = buffer[start + 1:], True
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+            if buffer == "" or buffer[0] == "]":
+                break
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except ValueError:
+                break # 要素がまだ届き終わっていない
+            if end == len(buffer) and isinstance(item, (int, float)) and not isinstance(item, bool):
+                break # 数値は続きが届くまで完成したかわからないので、区切り（,か]）が届くまで待つ
+            buffer = buffer[end:]
+            yield item
+        if buffer.startswith("]"):
+            # 残りの断片も読み切り、send_message_streamが会話履歴への追加や接続の後片付けを終えられるようにする
+            for _ in chunks:
+                pass
+            return
+    # 途中で途切れた回答を、完成した配列として扱わない
+    raise ValueError("JSONの配列が閉じる前に回答が終わりました。")
 
 
 class ChatGPT:
-    def __init__(self, api_key:str, model:str, init_prompt:str="", n_memorise:int=1):
+    def __init__(self, api_key:str, model:str, init_prompt:str="", n_memorise:int=1, base_url:str=None):
         """
         ChatGPTを使用するためのインスタンスを作成します。
 
@@ -20,11 +137,20 @@ class ChatGPT:
             model (str): 使用するモデル
             init_prompt (str, optional): 初期プロンプト. Defaults to "".
             n_memorise (int, optional): 記憶するメッセージの数. Defaults to 1.
+            base_url (str, optional): APIのURL. Defaults to None（OpenAIのAPI）.
         Methods:
-            send_message(message:str, image_path:str=None) -> str:
+            send_message(message:str, image_path:str=None, response_format:dict=None) -> str:
                 ChatGPTにメッセージを送信します。返答文を返します。
+            send_message_stream(message:str, image_path:str=None, response_format:dict=None) -> Iterator[str]:
+                ChatGPTにメッセージを送信します。返答文を届いた順に断片ごとに返します。
+            send_messages_async(messages:list, max_concurrency:int, requests_per_minute:float, response_format:dict) -> list:
+                複数のメッセージを非同期で並列に送信します。返答文のリストを返します（コルーチン）。
+            send_messages_batch(messages:list, max_concurrency:int, requests_per_minute:float, response_format:dict) -> list:
+                send_messages_asyncを同期的に実行します。
         """
-        self.client = OpenAI(api_key=api_key)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.client = _get_client(api_key, base_url)
         self.model = model
         self.conversation_history = [{"role": "system", "content": init_prompt}]
         self.n_memorise = n_memorise
@@ -42,18 +168,17 @@ class ChatGPT:
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode('utf-8')
         
-    def send_message(self, message:str, image_path:str=None) -> str:
+    def _build_messages(self, message:str, image_path:str=None) -> list:
         """
-        ChatGPTにメッセージを送信します。
+        会話の履歴を含めて、送信するメッセージのリストを作成します。
 
         Args:
             message (str): 送信するメッセージ
             image_path (str): 画像のパス。形式はJPGである必要があります。
 
         Returns:
-            str: ChatGPTからの回答
+            list: 送信するメッセージのリスト
         """
-        
         # 会話の履歴を含めてメッセージを構築
         if image_path is not None:
             image64 = self._convert_img2base64(image_path)
@@ -73,14 +198,48 @@ class ChatGPT:
             
         if len(self.conversation_history) > self.n_memorise:
             self.conversation_history.pop(0)
+        return messages
+
+    def _record_usage(self, sec, usage, **fields):
+        """
+        ChatGPTへのリクエストの時間とトークン数を記録します。
+
+        Args:
+            sec (float): リクエストにかかった時間
+            usage (openai.types.CompletionUsage): トークン数（取得できない場合はNone）
+            **fields: 一緒に記録する値
+        """
+        if usage is not None:
+            fields["prompt_tokens"] = usage.prompt_tokens
+            fields["completion_tokens"] = usage.completion_tokens
+            get_metrics().count("llm.prompt_tokens", usage.prompt_tokens)
+            get_metrics().count("llm.completion_tokens", usage.completion_tokens)
+        get_metrics().record("llm.request", sec=sec, model=self.model, **fields)
+
+    def send_message(self, message:str, image_path:str=None, response_format:dict=None) -> str:
+        """
+        ChatGPTにメッセージを送信します。
+
+        Args:
+            message (str): 送信するメッセージ
+            image_path (str): 画像のパス。形式はJPGである必要があります。
+            response_format (dict, optional): 回答の形式（{"type": "json_schema", ...}など）. Defaults to None.
+
+        Returns:
+            str: ChatGPTからの回答
+        """
+        messages = self._build_messages(message, image_path)
 
         # ChatGPTにリクエストを送信
+        start = time.perf_counter()
         try:
-            response = self.client.chat.completions.create(model=self.model, messages=messages)
+            response = self.client.chat.completions.create(model=self.model, messages=messages, **_format_kwargs(response_format))
         except Exception as e:
             print("[Error]: ChatGPTへのリクエストに失敗しました．")
             print(e)
+            get_metrics().count("llm.error")
             return ""
+        self._record_usage(time.perf_counter() - start, getattr(response, "usage", None))
         # 応答を取得
         response_text = response.choices[0].message.content
 
@@ -89,7 +248,141 @@ class ChatGPT:
         self.conversation_history.append({"role": "assistant", "content": response_text})
 
         return response_text
-    
+
+    def send_message_stream(self, message:str, image_path:str=None, response_format:dict=None):
+        """
+        ChatGPTにメッセージを送信し、回答を届いた順に断片ごとに返します。
+        回答をすべて受け取ると、会話履歴に追加します。
+
+        Args:
+            message (str): 送信するメッセージ
+            image_path (str): 画像のパス。形式はJPGである必要があります。
+            response_format (dict, optional): 回答の形式（{"type": "json_schema", ...}など）. Defaults to None.
+
+        Yields:
+            str: ChatGPTからの回答の断片
+
+        Raises:
+            ConnectionError: リクエストに失敗した場合や、回答が途中で途切れた場合
+        """
+        messages = self._build_messages(message, image_path)
+
+        # ChatGPTにリクエストを送信
+        chunks = []
+        finish_reason = None
+        usage = None
+        first_token_sec = None
+        start = time.perf_counter()
+        try:
+            stream = self.client.chat.completions.create(model=self.model, messages=messages, stream=True,
+                                                         stream_options={"include_usage": True}, **_format_kwargs(response_format))
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage # トークン数は最後の断片で届く
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if first_token_sec is None:
+                    first_token_sec = time.perf_counter() - start
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunks[-1]
+            if finish_reason != "stop":
+                # 終了の合図なしにストリームが閉じた場合や、トークン数の上限（length）で打ち切られた場合
+                raise ConnectionError(f"回答が完了しませんでした。 (finish_reason: {finish_reason})")
+        except Exception as e:
+            print("[Error]: ChatGPTへのリクエストに失敗しました．")
+            print(e)
+            get_metrics().count("llm.error")
+            # 途中までの回答を完成した回答として扱わないよう、呼び出し元に伝える
+            raise ConnectionError(f"ChatGPTからの回答が途中で途切れました。 > {e}") from e
+        self._record_usage(time.perf_counter() - start, usage, first_token_sec=first_token_sec, chunks=len(chunks))
+
+        # 今回のユーザーのプロンプトとChatGPTの応答を会話履歴に追加
+        self.conversation_history.append({"role": "user", "content": message})
+        self.conversation_history.append({"role": "assistant", "content": "".join(chunks)})
+
+    async def send_messages_async(self, messages:list, max_concurrency:int=MAX_CONCURRENCY, requests_per_minute:float=None,
+                                  response_format:dict=None) -> list:
+        """
+        複数のメッセージをChatGPTに非同期で並列に送信します。メッセージは互いに独立していて、会話履歴には追加しません。
+        レート制限（429）や一時的なエラーのときは、Retry-Afterまたは指数バックオフで待ってからリトライします。
+
+        Args:
+            messages (list): 送信するメッセージのリスト
+            max_concurrency (int, optional): 同時に送るリクエストの数. Defaults to MAX_CONCURRENCY.
+            requests_per_minute (float, optional): 1分あたりに送るリクエストの数の上限. Defaults to None（制限なし）.
+            response_format (dict, optional): 回答の形式（{"type": "json_schema", ...}など）. Defaults to None.
+
+        Returns:
+            list: メッセージの順番どおりの回答のリスト。失敗したメッセージは""になります。
+        """
+        client = _get_async_client(self.api_key, self.base_url)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        interval = 60 / requests_per_minute if requests_per_minute else 0
+        rate_lock = asyncio.Lock()
+        next_start = [0.0] # 次のリクエストを送ってよい時刻
+
+        async def wait_for_rate_limit():
+            async with rate_lock:
+                delay = next_start[0] - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_start[0] = max(next_start[0], time.monotonic()) + interval
+
+        async def send(message):
+            async with semaphore:
+                for attempt in range(MAX_RETRIES + 1):
+                    await wait_for_rate_limit()
+                    start = time.perf_counter()
+                    try:
+                        response = await client.chat.completions.create(model=self.model, messages=self.conversation_history[:1] + [
+                            {"role": "user", "content": message}], **_format_kwargs(response_format))
+                    except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+                        get_metrics().count("llm.rate_limited" if isinstance(e, RateLimitError) else "llm.retry")
+                        if attempt == MAX_RETRIES:
+                            print(f"[Error]: ChatGPTへのリクエストのリトライ回数が上限に達しました． > {e}")
+                            break
+                        delay = _retry_after(e, attempt)
+                        if isinstance(e, RateLimitError):
+                            # レート制限のときは、ほかのリクエストも待たせる
+                            next_start[0] = max(next_start[0], time.monotonic() + delay)
+                        await asyncio.sleep(delay)
+                        continue
+                    except Exception as e:
+                        print("[Error]: ChatGPTへのリクエストに失敗しました．")
+                        print(e)
+                        break
+                    self._record_usage(time.perf_counter() - start, getattr(response, "usage", None), attempt=attempt, batch=True)
+                    return response.choices[0].message.content or ""
+                get_metrics().count("llm.error")
+                return ""
+
+        return list(await asyncio.gather(*(send(message) for message in messages)))
+
+    def send_messages_batch(self, messages:list, max_concurrency:int=MAX_CONCURRENCY, requests_per_minute:float=None,
+                            response_format:dict=None) -> list:
+        """
+        send_messages_asyncを同期的に実行します。イベントループの外から呼び出します。
+        実行のために作ったイベントループは終わるので、そのループの非同期のクライアントも閉じます。
+
+        Args:
+            messages (list): 送信するメッセージのリスト
+            max_concurrency (int, optional): 同時に送るリクエストの数. Defaults to MAX_CONCURRENCY.
+            requests_per_minute (float, optional): 1分あたりに送るリクエストの数の上限. Defaults to None（制限なし）.
+            response_format (dict, optional): 回答の形式（{"type": "json_schema", ...}など）. Defaults to None.
+
+        Returns:
+            list: メッセージの順番どおりの回答のリスト
+        """
+        async def run():
+            try:
+                return await self.send_messages_async(messages, max_concurrency, requests_per_minute, response_format)
+            finally:
+                await close_async_clients()
+
+        return asyncio.run(run())
+
 if __name__ == "__main__":
     with open("keys/ChatGPT_params.json", "r") as f:
         params = json.load(f)
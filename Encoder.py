@@ -0,0 +1,230 @@
+"""
+動画のエンコーダーの設定（プロファイル）を選ぶ機能を提供します。
+ffmpegで使えるエンコーダーを調べ、実際に1フレームだけエンコードして動くプロファイルだけを候補にし、
+候補の中から一番速いプロファイルをホストごとに選んで保存します。
+
+@author: Yuta Tanimura
+"""
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+
+from moviepy.config import get_setting
+
+# エンコーダーのプロファイル。fpsはプロファイルに向いたフレームレートで、呼び出し側で指定がない場合に使います
+ENCODER_PROFILES = {
+    # NVIDIAのGPU
+    "nvenc": {"codec": "h264_nvenc", "fps": 10,
+              "ffmpeg_params": ["-preset", "p4", "-rc", "vbr", "-cq", "23", "-b:v", "5M", "-maxrate", "10M", "-bufsize", "10M", "-g", "600"]},
+    # IntelのGPU
+    "qsv": {"codec": "h264_qsv", "fps": 10,
+            "ffmpeg_params": ["-preset", "faster", "-global_quality", "23", "-g", "600"]},
+    # AMDのGPU
+    "amf": {"codec": "h264_amf", "fps": 10,
+            "ffmpeg_params": ["-quality", "speed", "-rc", "cqp", "-qp_i", "23", "-qp_p", "23", "-g", "600"]},
+    # CPU。静止画が続くスライドショー向けに、stillimageで調整し、キーフレームの間隔を長くする
+    "libx264_still": {"codec": "libx264", "fps": 10,
+                      "ffmpeg_params": ["-preset", "veryfast", "-tune", "stillimage", "-crf", "23", "-g", "600", "-bf", "3"]},
+}
+# ベンチマークをしない場合に選ぶ順番
+PROFILE_PRIORITY = ["nvenc", "qsv", "amf", "libx264_still"]
+FALLBACK_PROFILE = "libx264_still"
+PROFILE_CACHE_PATH = "resources/param/encoder_profile.json"
+BENCHMARK_SECONDS = 30 # ベンチマークでエンコードする動画の長さ（秒）
+
+_encoders = None
+_probe_results = {} # (codec, fps, ffmpeg_params)ごとの試し書きの結果
+_selected_profile = None
+_lock = threading.Lock()
+
+def _ffmpeg(args, timeout=None):
+    """
+    ffmpegを実行し、結果を返します。
+    """
+    command = [get_setting("FFMPEG_BINARY"), "-hide_banner", "-y", "-loglevel", "error"] + args
+    return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+
+def available_encoders():
+    """
+    ffmpegで使える映像のエンコーダーの名前を返します。
+
+    Returns:
+        set: エンコーダーの名前の集合
+    """
+    global _encoders
+    if _encoders is None:
+        result = _ffmpeg(["-encoders"])
+        encoders = set()
+        for line in result.stdout.decode("utf-8", errors="replace").splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].startswith("V") and len(fields[0]) == 6: # 例: " V....D libx264 ..."
+                encoders.add(fields[1])
+        _encoders = encoders
+    return _encoders
+
+def get_profile(name):
+    """
+    プロファイルの設定を返します。
+
+    Args:
+        name (str): プロファイルの名前
+
+    Returns:
+        dict: codec, fps, ffmpeg_paramsをもつ辞書（呼び出し側で変更しても構いません）
+    """
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f"不明なエンコーダーのプロファイルです。 > {name}")
+    profile = ENCODER_PROFILES[name]
+    return {"codec": profile["codec"], "fps": profile["fps"], "ffmpeg_params": list(profile["ffmpeg_params"])}
+
+def probe_encoder(codec, fps=10, ffmpeg_params=None):
+    """
+    エンコーダーで1フレームだけエンコードして、このホストで使えるかを調べます。
+    ffmpegにエンコーダーが含まれていても、GPUやドライバーがない場合は失敗します。結果はプロセスの中で使い回します。
+
+    Args:
+        codec (str): 映像のコーデック
+        fps (float, optional): フレームレート. Defaults to 10.
+        ffmpeg_params (list, optional): ffmpegに追加で渡す引数. Defaults to None.
+
+    Returns:
+        bool: 使える場合はTrue
+    """
+    key = (codec, fps, tuple(ffmpeg_params or []))
+    if key not in _probe_results:
+        ok = False
+        if codec in available_encoders():
+            try:
+                result = _ffmpeg(["-f", "lavfi", "-i", f"color=c=black:s=256x256:r={fps}", "-frames:v", "1",
+                                  "-c:v", codec, "-pix_fmt", "yuv420p"] + list(ffmpeg_params or []) + ["-f", "null", "-"], timeout=60)
+                ok = result.returncode == 0
+            except subprocess.TimeoutExpired:
+                pass
+        _probe_results[key] = ok
+    return _probe_results[key]
+
+def probe_profile(name):
+    """
+    プロファイルがこのホストで使えるかを調べます。
+
+    Args:
+        name (str): プロファイルの名前
+
+    Returns:
+        bool: 使える場合はTrue
+    """
+    profile = get_profile(name)
+    return probe_encoder(profile["codec"], profile["fps"], profile["ffmpeg_params"])
+
+def benchmark_profile(name, seconds=BENCHMARK_SECONDS):
+    """
+    スライドショーに近い映像（1秒ごとに変わる1920x1080の画像）をエンコードし、1秒あたりのフレーム数を計測します。
+
+    Args:
+        name (str): プロファイルの名前
+        seconds (float, optional): エンコードする動画の長さ（秒）. Defaults to BENCHMARK_SECONDS.
+
+    Returns:
+        float: 1秒あたりにエンコードしたフレーム数（失敗した場合はNone）
+    """
+    profile = get_profile(name)
+    n_frames = int(seconds * profile["fps"])
+    start = time.perf_counter()
+    try:
+        result = _ffmpeg(["-f", "lavfi", "-i", f"testsrc2=s=1920x1080:r=1,fps={profile['fps']}", "-frames:v", str(n_frames),
+                          "-c:v", profile["codec"], "-pix_fmt", "yuv420p"] + profile["ffmpeg_params"] + ["-f", "null", "-"], timeout=600)
+    except subprocess.TimeoutExpired:
+        return None
+    if result.returncode != 0:
+        return None
+    return n_frames / (time.perf_counter() - start)
+
+def _host_id():
+    """
+    プロファイルの選択結果を保存するときの、ホストとffmpegの組み合わせを表す文字列を返します。
+    """
+    return f"{platform.node()}|{get_setting('FFMPEG_BINARY')}"
+
+def select_profile(benchmark=True, cache_path=PROFILE_CACHE_PATH, refresh=False):
+    """
+    このホストで使えるプロファイルの中から、使うプロファイルを選びます。
+    選んだ結果はホストごとにcache_pathに保存し、次回からは調べ直さずに使います。
+
+    Args:
+        benchmark (bool, optional): Trueの場合は使えるプロファイルをすべて計測して一番速いものを、
+            Falseの場合はPROFILE_PRIORITYの順で最初に使えるものを選びます. Defaults to True.
+        cache_path (str, optional): 選択結果の保存先. Defaults to PROFILE_CACHE_PATH.
+        refresh (bool, optional): 保存した結果を使わずに調べ直します. Defaults to False.
+
+    Returns:
+        str: プロファイルの名前
+    """
+    global _selected_profile
+    with _lock:
+        if _selected_profile is not None and not refresh:
+            return _selected_profile
+        cache = {}
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    cache = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[Error]: エンコーダーの選択結果を読み込めませんでした。 > {e}")
+        entry = cache.get(_host_id())
+        if entry is not None and not refresh and entry.get("profile") in ENCODER_PROFILES:
+            _selected_profile = entry["profile"]
+            return _selected_profile
+
+        print("使えるエンコーダーを調べています...")
+        usable = [name for name in PROFILE_PRIORITY if probe_profile(name)]
+        results = {}
+        if not usable:
+            print(f"[Error]: 使えるエンコーダーが見つかりませんでした。{FALLBACK_PROFILE}を使います。")
+            selected = FALLBACK_PROFILE
+        elif benchmark and len(usable) > 1:
+            for name in usable:
+                results[name] = benchmark_profile(name)
+                print(f"  {name}: {results[name] or 0:.1f}fps")
+            measured = [name for name in usable if results[name] is not None]
+            selected = max(measured, key=lambda name: results[name]) if measured else usable[0]
+        else:
+            selected = usable[0]
+        print(f"エンコーダーのプロファイルに{selected}を使います。")
+
+        cache[_host_id()] = {"profile": selected, "usable": usable, "fps": results}
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        _selected_profile = selected
+        return _selected_profile
+
+def resolve_encoder(profile=None, codec=None, fps=None, ffmpeg_params=None):
+    """
+    プロファイルとエンコードの引数から、実際に使うcodec, fps, ffmpeg_paramsを決めます。
+    codecを直接指定した場合でも、そのエンコーダーで試し書きができないときは自動で選んだプロファイルに切り替えます。
+
+    Args:
+        profile (str, optional): プロファイルの名前。"auto"の場合はselect_profileで選びます. Defaults to None.
+        codec (str, optional): 映像のコーデック. Defaults to None.
+        fps (float, optional): フレームレート. Defaults to None（プロファイルのフレームレート）.
+        ffmpeg_params (list, optional): ffmpegに追加で渡す引数. Defaults to None.
+
+    Returns:
+        dict: codec, fps, ffmpeg_paramsをもつ辞書。profileもcodecも指定しない場合はNone
+    """
+    if codec is not None and profile is None:
+        if probe_encoder(codec, fps or 10, ffmpeg_params):
+            return {"codec": codec, "fps": fps, "ffmpeg_params": ffmpeg_params}
+        print(f"[Error]: エンコーダー{codec}が使えないため、自動で選んだエンコーダーを使います。")
+        profile = "auto"
+    if profile is None:
+        return None
+    settings = get_profile(select_profile() if profile == "auto" else profile)
+    if fps is not None:
+        settings["fps"] = fps
+    if ffmpeg_params is not None and codec is not None and codec == settings["codec"]:
+        settings["ffmpeg_params"] = ffmpeg_params # 同じエンコーダー向けの引数だけを引き継ぐ
+    return settings
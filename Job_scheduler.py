@@ -0,0 +1,546 @@
+"""
+チャンネルごとのcron形式のスケジュールで動画生成のジョブを登録し、SQLiteのキューから並列に実行する機能を提供します。
+ジョブごとに作業フォルダを分け、LLM・TTS・描画・アップロードなどの段階ごとに同時に実行できる数を制限します。
+作業フォルダには完了した段階を記録するジャーナルを置くので、失敗したジョブや中断したジョブは最後に完了した段階から再開できます。
+
+@author: Yuta Tanimura
+"""
+import json
+import os
+import sqlite3
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+DB_PATH = "resources/param/jobs.sqlite3"
+JOBS_DIR = "resources/jobs"
+MAX_ATTEMPTS = 3 # 失敗したジョブを実行する回数の上限
+RETRY_DELAY = 600 # 失敗したジョブを再実行するまでの待ち時間（秒）
+MAX_WAIT = 60 # 次のスケジュールまでの待ち時間の上限（秒）
+JOURNAL_NAME = "journal.json" # 作業フォルダに置くジャーナルのファイル名
+
+class Cron_schedule:
+    # フィールドごとの値の範囲（分, 時, 日, 月, 曜日）
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expression):
+        """
+        cron形式（分 時 日 月 曜日）のスケジュールを作成します。
+        各フィールドには「*」「*/n」「a-b」「a-b/n」「a,b,c」を使えます。曜日は0が日曜日です（7も日曜日として扱います）。
+
+        Args:
+            expression (str): cron形式のスケジュール（例: "0 7 * * *"）
+        Methods:
+            matches(dt):
+                日時がスケジュールに一致するかを返します。
+            next_after(dt):
+                dtより後で、スケジュールに一致する最初の日時を返します。
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron形式のスケジュールは5つのフィールドが必要です。 > {expression}")
+        self.expression = expression
+        self.fields = [self._parse_field(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+        self.fields[4] = {0 if value == 7 else value for value in self.fields[4]}
+        # 日と曜日の両方を指定した場合は、cronと同じくどちらかに一致すればよい
+        self.day_restricted = fields[2] != "*"
+        self.weekday_restricted = fields[4] != "*"
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        """
+        1つのフィールドを、一致する値の集合に変換します。
+        """
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = map(int, part.split("-"))
+            else:
+                start = end = int(part)
+                if step != 1:
+                    end = high
+            if start < low or end > (7 if high == 6 else high) or start > end or step < 1:
+                raise ValueError(f"cron形式のフィールドの値が範囲外です。 > {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, dt):
+        """
+        日時がスケジュールに一致するかを返します（秒は無視します）。
+        """
+        return dt.minute in self.fields[0] and dt.hour in self.fields[1] and self._day_matches(dt)
+
+    def next_after(self, dt):
+        """
+        dtより後で、スケジュールに一致する最初の日時を返します。
+
+        Args:
+            dt (datetime): 基準の日時
+
+        Returns:
+            datetime: 一致する日時（4年以内に一致しない場合はNone）
+        """
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 4)
+        minutes, hours = self.fields[0], self.fields[1]
+        while t < limit:
+            if not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1) # 一致しない日は飛ばす
+                continue
+            if t.hour not in hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            if t.minute in minutes:
+                return t
+            t += timedelta(minutes=1)
+        return None
+
+    def _day_matches(self, dt):
+        """
+        日付（月, 日, 曜日）だけがスケジュールに一致するかを返します。
+        """
+        days, months, weekdays = self.fields[2], self.fields[3], self.fields[4]
+        if dt.month not in months:
+            return False
+        day_ok = dt.day in days
+        weekday_ok = (dt.weekday() + 1) % 7 in weekdays # Pythonの月曜日=0を、cronの日曜日=0に合わせる
+        if self.day_restricted and self.weekday_restricted:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+class Job_queue:
+    def __init__(self, db_path=DB_PATH):
+        """
+        SQLiteに保存するジョブのキューを作成します。プロセスが止まってもジョブは失われません。
+
+        Args:
+            db_path (str, optional): データベースのパス. Defaults to DB_PATH.
+        Methods:
+            add(channel, scheduled_at):
+                ジョブを登録します。
+            claim():
+                実行できるジョブを1つ取り出し、実行中にします。
+            finish(job_id, result):
+                ジョブを完了にします。
+            fail(job_id, error, max_attempts, retry_delay):
+                ジョブを失敗にします。回数が上限に満たない場合は、待ち時間のあとに再実行します。
+            recover():
+                前回のプロセスで実行中のまま止まったジョブを、待機中に戻します。
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    stage TEXT,
+                    scheduled_at TEXT NOT NULL,
+                    not_before TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    work_dir TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, not_before)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS schedules (
+                    channel TEXT PRIMARY KEY,
+                    last_scheduled_at TEXT NOT NULL
+                )""")
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def add(self, channel, scheduled_at):
+        """
+        ジョブを登録します。
+
+        Args:
+            channel (str): チャンネルの名前
+            scheduled_at (datetime): ジョブを実行する日時
+
+        Returns:
+            int: ジョブのID
+        """
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (channel, scheduled_at, not_before, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (channel, scheduled_at.isoformat(timespec="seconds"), scheduled_at.isoformat(timespec="seconds"), now, now))
+            return cursor.lastrowid
+
+    def claim(self, channels=None):
+        """
+        実行できる時刻になった待機中のジョブを、予定の早い順に1つ取り出し、実行中にします。
+
+        Args:
+            channels (set, optional): 取り出してよいチャンネル. Defaults to None（すべて）.
+
+        Returns:
+            dict: ジョブ（ない場合はNone）
+        """
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT * FROM jobs WHERE status = 'pending' AND not_before <= ? ORDER BY not_before, id", (now,)).fetchall()
+                row = next((row for row in rows if channels is None or row["channel"] in channels), None)
+                if row is not None:
+                    self.connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                                            (now, row["id"]))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = dict(row)
+        job["status"], job["attempts"] = "running", job["attempts"] + 1
+        return job
+
+    def update(self, job_id, **fields):
+        """
+        ジョブの項目（stage, work_dirなど）を更新します。
+        """
+        fields["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def finish(self, job_id, result=None):
+        """
+        ジョブを完了にします。
+
+        Args:
+            job_id (int): ジョブのID
+            result (str, optional): 結果（動画のIDなど）. Defaults to None.
+        """
+        self.update(job_id, status="done", stage=None, result=result, error=None)
+
+    def fail(self, job_id, error, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        """
+        ジョブを失敗にします。実行回数が上限に満たない場合は、retry_delay秒後に再実行する待機中に戻します。
+
+        Args:
+            job_id (int): ジョブのID
+            error (str): エラーの内容
+            max_attempts (int, optional): 実行回数の上限. Defaults to MAX_ATTEMPTS.
+            retry_delay (float, optional): 再実行までの待ち時間（秒）. Defaults to RETRY_DELAY.
+
+        Returns:
+            bool: 再実行する場合はTrue
+        """
+        attempts = self._execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,))[0]["attempts"]
+        if attempts < max_attempts:
+            not_before = (datetime.now() + timedelta(seconds=retry_delay)).isoformat(timespec="seconds")
+            self.update(job_id, status="pending", error=error, not_before=not_before)
+            return True
+        self.update(job_id, status="failed", error=error)
+        return False
+
+    def recover(self):
+        """
+        前回のプロセスで実行中のまま止まったジョブを、待機中に戻します。
+
+        Returns:
+            int: 戻したジョブの数
+        """
+        rows = self._execute("SELECT id FROM jobs WHERE status = 'running'")
+        for row in rows:
+            self.update(row["id"], status="pending")
+        return len(rows)
+
+    def counts(self):
+        """
+        状態ごとのジョブの数を返します。
+        """
+        return {row["status"]: row["n"] for row in self._execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+
+    def last_scheduled(self, channel):
+        """
+        チャンネルのジョブを最後に登録した予定の日時を返します。
+
+        Returns:
+            datetime: 最後に登録した日時（まだない場合はNone）
+        """
+        rows = self._execute("SELECT last_scheduled_at FROM schedules WHERE channel = ?", (channel,))
+        return datetime.fromisoformat(rows[0]["last_scheduled_at"]) if rows else None
+
+    def set_last_scheduled(self, channel, scheduled_at):
+        self._execute("INSERT INTO schedules (channel, last_scheduled_at) VALUES (?, ?) "
+                      "ON CONFLICT(channel) DO UPDATE SET last_scheduled_at = excluded.last_scheduled_at",
+                      (channel, scheduled_at.isoformat(timespec="seconds")))
+
+class Job_journal:
+    def __init__(self, work_dir):
+        """
+        ジョブの作業フォルダに、完了した段階（物語・ボイス・動画・アップロードなど）を記録するジャーナルを作成します。
+        記録するたびにファイルを置き換えて保存するので、プロセスが途中で止まっても最後に完了した段階までは残ります。
+
+        Args:
+            work_dir (str): ジョブの作業フォルダ
+        Methods:
+            done(stage, unit=None) -> bool:
+                段階（またはその中の単位）が完了しているかを返します。
+            get(stage, unit=None) -> dict:
+                完了したときに記録した内容を返します。
+            mark(stage, unit=None, **data):
+                段階（またはその中の単位）を完了として記録します。
+            clear(stage):
+                段階とその中の単位の記録を消します。
+        """
+        self.path = os.path.join(work_dir, JOURNAL_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[Error]: ジャーナルを読み込めませんでした。最初から実行します。 > {e}")
+
+    @staticmethod
+    def _key(stage, unit):
+        return stage if unit is None else f"{stage}/{unit}"
+
+    def done(self, stage, unit=None):
+        """
+        段階（またはその中の単位）が完了しているかを返します。
+
+        Args:
+            stage (str): 段階の名前
+            unit (optional): 段階の中の単位（行の番号など）. Defaults to None.
+
+        Returns:
+            bool: 完了している場合はTrue
+        """
+        with self.lock:
+            return self._key(stage, unit) in self.entries
+
+    def get(self, stage, unit=None):
+        """
+        段階（またはその中の単位）が完了したときに記録した内容を返します。
+
+        Args:
+            stage (str): 段階の名前
+            unit (optional): 段階の中の単位. Defaults to None.
+
+        Returns:
+            dict: 記録した内容（完了していない場合は空の辞書）
+        """
+        with self.lock:
+            return dict(self.entries.get(self._key(stage, unit), {}))
+
+    def mark(self, stage, unit=None, **data):
+        """
+        段階（またはその中の単位）を完了として記録し、ジャーナルを保存します。
+
+        Args:
+            stage (str): 段階の名前
+            unit (optional): 段階の中の単位. Defaults to None.
+            **data: 一緒に記録する内容（JSONに変換できる値）
+        """
+        with self.lock:
+            self.entries[self._key(stage, unit)] = {**data, "finished_at": datetime.now().isoformat(timespec="seconds")}
+            self._save()
+
+    def clear(self, stage):
+        """
+        段階とその中の単位の記録を消し、ジャーナルを保存します。やり直した段階の古い記録が残らないようにします。
+
+        Args:
+            stage (str): 段階の名前
+        """
+        with self.lock:
+            self.entries = {key: value for key, value in self.entries.items() if key != stage and not key.startswith(stage + "/")}
+            self._save()
+
+    def _save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+class Job_scheduler:
+    def __init__(self, channels, run_job, stage_limits=None, max_jobs=2, db_path=DB_PATH, jobs_dir=JOBS_DIR):
+        """
+        チャンネルのスケジュールに従ってジョブを登録し、並列に実行するスケジューラーを作成します。
+
+        Args:
+            channels (list): チャンネルの設定の辞書のリスト。name（名前）とcron（スケジュール）が必要です。
+            run_job (callable): ジョブを実行する関数。run_job(job, channel, scheduler)の形で呼び出され、結果の文字列を返します。
+                例外を送出した場合はジョブを失敗とし、回数の上限まで再実行します。
+            stage_limits (dict, optional): 段階の名前ごとの同時に実行できる数. Defaults to None（制限なし）.
+            max_jobs (int, optional): 同時に実行するジョブの数. Defaults to 2.
+            db_path (str, optional): ジョブのキューのデータベースのパス. Defaults to DB_PATH.
+            jobs_dir (str, optional): ジョブごとの作業フォルダを作るフォルダ. Defaults to JOBS_DIR.
+        Methods:
+            stage(name, job):
+                withで囲んだ処理を段階として実行します。同時に実行できる数を超える場合は待機します。
+            schedule_due(now):
+                スケジュールの時刻になったジョブを登録します。
+            run_forever():
+                ジョブの登録と実行を繰り返します。
+            run_pending():
+                実行できるジョブをすべて実行して戻ります。
+        """
+        self.channels = {channel["name"]: channel for channel in channels}
+        self.schedules = {channel["name"]: Cron_schedule(channel["cron"]) for channel in channels}
+        self.run_job = run_job
+        self.stage_limits = dict(stage_limits or {})
+        self.semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in self.stage_limits.items()}
+        self.max_jobs = max_jobs
+        self.jobs_dir = jobs_dir
+        self.queue = Job_queue(db_path)
+        self.running = {} # ジョブのID → スレッド
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+    @contextmanager
+    def stage(self, name, job=None):
+        """
+        withで囲んだ処理を段階として実行します。同時に実行している数がstage_limitsに達している場合は、空くまで待機します。
+
+        Args:
+            name (str): 段階の名前（"llm", "render", "upload"など）
+            job (dict, optional): 実行中のジョブ。指定すると、キューに現在の段階を記録します. Defaults to None.
+        """
+        semaphore = self.semaphores.get(name)
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            if job is not None:
+                self.queue.update(job["id"], stage=name)
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def schedule_due(self, now=None):
+        """
+        チャンネルごとに、前回登録した日時から現在までにスケジュールの時刻になったジョブを登録します。
+        初めてのチャンネルは、直近1日の間にスケジュールの時刻があればすぐに登録します。
+        プロセスが止まっていた間の分は、最新の1件だけ登録します。
+
+        Args:
+            now (datetime, optional): 現在の日時. Defaults to None（datetime.now()）.
+
+        Returns:
+            list: 登録したジョブのIDのリスト
+        """
+        now = now or datetime.now()
+        job_ids = []
+        for name, schedule in self.schedules.items():
+            last = self.queue.last_scheduled(name)
+            if last is None:
+                last = now - timedelta(days=1)
+            due = None
+            t = schedule.next_after(last)
+            while t is not None and t <= now:
+                due = t
+                t = schedule.next_after(t)
+            if due is not None:
+                job_ids.append(self.queue.add(name, due))
+                self.queue.set_last_scheduled(name, due)
+                print(f"ジョブを登録しました。（チャンネル: {name}, 予定: {due:%Y-%m-%d %H:%M}）")
+        return job_ids
+
+    def next_wakeup(self, now=None):
+        """
+        次にスケジュールの時刻になるまでの秒数を返します（MAX_WAITを上限とします）。
+        """
+        now = now or datetime.now()
+        times = [t for t in (schedule.next_after(now) for schedule in self.schedules.values()) if t is not None]
+        if not times:
+            return MAX_WAIT
+        return max(1.0, min(MAX_WAIT, (min(times) - now).total_seconds()))
+
+    def _start_jobs(self):
+        """
+        同時に実行するジョブの数に空きがある限り、キューからジョブを取り出して実行を始めます。
+        """
+        with self.lock:
+            while len(self.running) < self.max_jobs:
+                job = self.queue.claim(channels=set(self.channels))
+                if job is None:
+                    return
+                job["work_dir"] = job["work_dir"] or os.path.join(self.jobs_dir, str(job["id"]))
+                self.queue.update(job["id"], work_dir=job["work_dir"])
+                thread = threading.Thread(target=self._run, args=(job,), name=f"job-{job['id']}", daemon=True)
+                self.running[job["id"]] = thread
+                thread.start()
+
+    def _run(self, job):
+        """
+        1つのジョブを実行し、結果をキューに記録します。
+        """
+        channel = self.channels[job["channel"]]
+        print(f"ジョブ{job['id']}を開始します。（チャンネル: {job['channel']}, {job['attempts']}回目）")
+        try:
+            os.makedirs(job["work_dir"], exist_ok=True)
+            result = self.run_job(job, channel, self)
+            self.queue.finish(job["id"], result)
+            print(f"ジョブ{job['id']}が完了しました。")
+        except Exception as e:
+            traceback.print_exc()
+            retry = self.queue.fail(job["id"], f"{type(e).__name__}: {e}", max_attempts=channel.get("max_attempts", MAX_ATTEMPTS))
+            print(f"[Error]: ジョブ{job['id']}が失敗しました。{'あとで再実行します。' if retry else '再実行の回数が上限に達しました。'} > {e}")
+        finally:
+            with self.lock:
+                self.running.pop(job["id"], None)
+            self.wakeup.set()
+
+    def run_pending(self):
+        """
+        今実行できるジョブをすべて実行し、実行中のジョブが終わるまで待ってから戻ります。
+        """
+        self.queue.recover()
+        while True:
+            self._start_jobs()
+            with self.lock:
+                threads = list(self.running.values())
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def run_forever(self):
+        """
+        スケジュールの時刻になったジョブの登録と、キューにあるジョブの実行を、stopが呼ばれるまで繰り返します。
+        """
+        recovered = self.queue.recover()
+        if recovered:
+            print(f"前回実行中のまま止まったジョブを{recovered}件再開します。")
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            self.schedule_due()
+            self._start_jobs()
+            # 次のスケジュールの時刻か、ジョブが終わるまで待つ
+            self.wakeup.wait(self.next_wakeup())
+        with self.lock:
+            threads = list(self.running.values())
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        """
+        run_foreverを止めます。実行中のジョブは最後まで実行されます。
+        """
+        self.stopped.set()
+        self.wakeup.set()
@@ -0,0 +1,478 @@
+"""
+処理時間やリソースの使用量を計測し、実行ごと・ジョブごとにJSONLファイルへ記録する機能を提供します。
+
+@author: Yuta Tanimura
+"""
+import contextvars
+import cProfile
+import gc
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_DIR = "resources/metrics"
+PROFILE_ENV = "AI_YOUTUBER_PROFILE" # 1にするとcProfileで実行全体をプロファイルする
+MEMORY_BUDGET = 2 * 1024 ** 3 # 動画の描画中のメモリ使用量の予算（バイト）
+MEMORY_SAMPLE_INTERVAL = 0.2 # メモリ使用量を測る間隔（秒）
+
+_metrics = None
+_metrics_lock = threading.Lock()
+_job_metrics = contextvars.ContextVar("job_metrics", default=None) # 実行中のジョブの計測（start_jobで設定）
+_memory_budget = None
+_memory_budget_lock = threading.Lock()
+
+def _process_memory_counters():
+    """
+    Windowsでプロセスのメモリ使用量のカウンターを返します。取得できない場合はNoneを返します。
+    """
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters
+
+def peak_rss():
+    """
+    プロセスのピークメモリ使用量（バイト）を返します。取得できない場合はNoneを返します。
+    """
+    if sys.platform == "win32":
+        counters = _process_memory_counters()
+        return counters.PeakWorkingSetSize if counters is not None else None
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024 # Linuxではキロバイト単位
+
+def current_rss():
+    """
+    プロセスの現在のメモリ使用量（バイト）を返します。取得できない場合はNoneを返します。
+    """
+    if sys.platform == "win32":
+        counters = _process_memory_counters()
+        return counters.WorkingSetSize if counters is not None else None
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def open_handles():
+    """
+    プロセスが開いているファイル（Windowsではハンドル）の数を返します。取得できない場合はNoneを返します。
+    """
+    if sys.platform == "win32":
+        import ctypes
+        count = ctypes.c_ulong()
+        if not ctypes.windll.kernel32.GetProcessHandleCount(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(count)):
+            return None
+        return count.value
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(fd_dir):
+            return len(os.listdir(fd_dir))
+    return None
+
+class Metrics:
+    def __init__(self, path=None, parent=None):
+        """
+        計測結果を記録するためのインスタンスを作成します。
+        pathを指定すると、計測した値を1件ずつJSONLファイルに追記します。指定しない場合は集計だけを行います。
+        parentを指定すると、記録した値とカウンターをparentにも記録します（ジョブの計測を実行全体の集計に含めるため）。
+
+        Args:
+            path (str, optional): 計測結果のJSONLファイルのパス. Defaults to None.
+            parent (Metrics, optional): 同じ値を記録する親の計測. Defaults to None.
+        Methods:
+            timer(name, **fields):
+                withで囲んだ処理の時間を計測します。
+            record(name, **fields):
+                計測した値を1件記録します。
+            count(name, value):
+                カウンターを加算します。
+            profile(name):
+                環境変数で有効にした場合、withで囲んだ処理をcProfileでプロファイルします。
+            summary():
+                名前ごとの集計を返します。
+            close():
+                集計とリソースの使用量を書き出します。
+        """
+        self.path = path
+        self.parent = parent
+        self.started_at = time.time()
+        self.totals = {} # 名前ごとの{"n": 回数, "sec": 合計時間, "max_sec": 最大時間}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.profilers = None # プロファイル中に、ほかのスレッドで有効にしたプロファイラー
+        self.file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+
+    @contextmanager
+    def timer(self, name, **fields):
+        """
+        withで囲んだ処理の時間を計測し、secとして記録します。
+        yieldした辞書に値を追加すると、同じ行に記録されます。
+
+        Args:
+            name (str): 計測する処理の名前（"tts.synthesize"など）
+            **fields: 一緒に記録する値
+        """
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(name, sec=time.perf_counter() - start, **fields)
+
+    def record(self, name, **fields):
+        """
+        計測した値を1件記録します。secを含む場合は名前ごとの合計時間に加算します。
+
+        Args:
+            name (str): 計測した処理の名前
+            **fields: 記録する値
+        """
+        with self.lock:
+            if "sec" in fields:
+                total = self.totals.setdefault(name, {"n": 0, "sec": 0.0, "max_sec": 0.0})
+                total["n"] += 1
+                total["sec"] += fields["sec"]
+                total["max_sec"] = max(total["max_sec"], fields["sec"])
+            self._write({"time": round(time.time() - self.started_at, 6), "name": name, **fields})
+        if self.parent is not None:
+            self.parent.record(name, **fields)
+
+    def count(self, name, value=1):
+        """
+        カウンターを加算します。
+
+        Args:
+            name (str): カウンターの名前（"tts.cache_hit"など）
+            value (int, optional): 加算する値. Defaults to 1.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.parent is not None:
+            self.parent.count(name, value)
+
+    @contextmanager
+    def profile(self, name=None):
+        """
+        環境変数AI_YOUTUBER_PROFILEが1のとき、withで囲んだ処理をcProfileでプロファイルし、
+        計測結果のファイルの横に.profファイルとして保存します。
+        cProfileはスレッドごとに計測するので、bindで計測を引き継いだワーカーのスレッドもそれぞれプロファイルし、1つのファイルにまとめます。
+        bindを通さずに作ったスレッドと、Python 3.12以降で同時に有効にできなかったスレッドは計測されません。
+        Python 3.12以降でほかのジョブをプロファイル中の場合は、このジョブはプロファイルせずに実行します。
+
+        Args:
+            name (str, optional): ファイル名の末尾に付ける名前（並列に実行するジョブを区別します）. Defaults to None.
+        """
+        if os.environ.get(PROFILE_ENV) != "1":
+            yield None
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12以降では、プロセス全体で同時に1つのプロファイラーしか有効にできない
+            print(f"[Error]: ほかのプロファイルが実行中のため、プロファイルしません。 > {e}")
+            yield None
+            return
+        with self.lock:
+            self.profilers = []
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            with self.lock:
+                profilers, self.profilers = self.profilers, None
+            stats = pstats.Stats(profiler)
+            for thread_profiler in profilers:
+                stats.add(thread_profiler)
+            profile_path = os.path.splitext(self.path or "profile")[0] + (f"_{name}" if name else "") + ".prof"
+            stats.dump_stats(profile_path)
+            print(f"プロファイルを保存しました。 > {profile_path}")
+
+    def _thread_profiler(self):
+        """
+        プロファイル中であれば、呼び出したスレッドのプロファイラーを有効にして返します。プロファイル中でなければNoneを返します。
+        """
+        with self.lock:
+            if self.profilers is None:
+                return None
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                return None # Python 3.12以降では、ほかのプロファイラーが有効な間は有効にできない
+            self.profilers.append(profiler)
+            return profiler
+
+    def summary(self):
+        """
+        名前ごとの集計、カウンター、リソースの使用量を返します。
+
+        Returns:
+            dict: 集計結果
+        """
+        with self.lock:
+            return {"total_sec": round(time.time() - self.started_at, 6),
+                    "timers": {name: dict(total) for name, total in self.totals.items()},
+                    "counters": dict(self.counters),
+                    "peak_rss": peak_rss(),
+                    "open_handles": open_handles()}
+
+    def close(self):
+        """
+        集計とリソースの使用量を最後の1行として書き出し、ファイルを閉じます。
+        """
+        summary = self.summary()
+        with self.lock:
+            self._write({"time": summary["total_sec"], "name": "summary", **summary})
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _write(self, event):
+        """
+        1件の記録をJSONLファイルに追記します。lockを取得した状態で呼び出します。
+        """
+        if self.file is None:
+            return
+        self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+class Memory_budget:
+    def __init__(self, max_bytes=MEMORY_BUDGET, interval=MEMORY_SAMPLE_INTERVAL):
+        """
+        プロセスのメモリ使用量の予算を管理します。
+        reserveで囲んだ処理は、メモリ使用量が予算を超えている場合、まず解放できるメモリ（キャッシュなど）を解放します。
+        それでも超えている間は、実行中のほかの処理が終わるのを待ってから始まります。
+        待つのは並列に実行している処理があるとき（workersが2以上のとき）だけです。
+        実行中の処理がなければ予算を超えていても始まるので、処理が止まることはありません。
+
+        Args:
+            max_bytes (int, optional): メモリ使用量の予算（バイト）。Noneの場合は制限しません. Defaults to MEMORY_BUDGET.
+            interval (float, optional): メモリ使用量を測る間隔（秒）. Defaults to MEMORY_SAMPLE_INTERVAL.
+        Methods:
+            reserve(release=None):
+                メモリ使用量が予算を超えていればメモリを解放し、予算に収まるまで待ってから、withで囲んだ処理を実行します。
+            monitor() -> dict:
+                withで囲んだ間のピークメモリ使用量と、開いているファイルの数の最大値を計測します。
+        """
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.in_flight = 0
+        self.waits = 0 # 予算を超えていたために待った回数
+        self.releases = 0 # 予算を超えていたためにメモリを解放した回数
+        self.condition = threading.Condition()
+
+    def _over_budget(self):
+        if self.max_bytes is None:
+            return False
+        rss = current_rss()
+        return rss is not None and rss > self.max_bytes
+
+    @contextmanager
+    def reserve(self, release=None):
+        """
+        メモリ使用量が予算に収まるか、実行中のほかの処理がなくなるまで待ってから、withで囲んだ処理を実行します。
+        予算を超えている場合は、待つ前にreleaseを呼び出してガベージコレクションを行います。
+
+        Args:
+            release (callable, optional): 予算を超えているときに呼び出す、キャッシュなどを解放する関数. Defaults to None.
+        """
+        with self.condition:
+            if self._over_budget():
+                self.releases += 1
+                if release is not None:
+                    release()
+                gc.collect() # 描画し終えたスライドのフレームバッファを回収する
+            if self.in_flight > 0 and self._over_budget():
+                self.waits += 1
+                while self.in_flight > 0 and self._over_budget():
+                    self.condition.wait(timeout=self.interval)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def monitor(self):
+        """
+        withで囲んだ間、一定の間隔でメモリ使用量と開いているファイルの数を測り、最大値を記録します。
+
+        Yields:
+            dict: peak_rss（ピークメモリ使用量）, peak_handles（開いているファイルの数の最大値）, budget（予算）,
+                waits（予算を超えて待った回数）, releases（予算を超えてメモリを解放した回数）
+        """
+        usage = {"peak_rss": None, "peak_handles": None, "budget": self.max_bytes, "waits": 0, "releases": 0}
+        waits, releases = self.waits, self.releases
+        stop = threading.Event()
+
+        def sample():
+            for key, value in (("peak_rss", current_rss()), ("peak_handles", open_handles())):
+                if value is not None and (usage[key] is None or value > usage[key]):
+                    usage[key] = value
+
+        def run():
+            while not stop.wait(self.interval):
+                sample()
+
+        sample()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            yield usage
+        finally:
+            stop.set()
+            thread.join()
+            sample()
+            usage["waits"] = self.waits - waits
+            usage["releases"] = self.releases - releases
+
+def get_memory_budget():
+    """
+    プロセス全体で共有するメモリ使用量の予算を返します。並列に実行するジョブの描画は、同じ予算を分け合います。
+
+    Returns:
+        Memory_budget: メモリ使用量の予算
+    """
+    global _memory_budget
+    with _memory_budget_lock:
+        if _memory_budget is None:
+            _memory_budget = Memory_budget()
+        return _memory_budget
+
+def set_memory_budget(max_bytes):
+    """
+    プロセス全体で共有するメモリ使用量の予算を変更します。
+
+    Args:
+        max_bytes (int): メモリ使用量の予算（バイト）。Noneの場合は制限しません
+    """
+    budget = get_memory_budget()
+    with budget.condition:
+        budget.max_bytes = max_bytes
+        budget.condition.notify_all()
+
+def get_metrics():
+    """
+    現在の実行の計測結果を記録するインスタンスを返します。start_runを呼ぶ前は、集計だけを行います。
+    start_jobの中（とbindで引き継いだスレッド）では、そのジョブの計測を返します。
+
+    Returns:
+        Metrics: 計測結果を記録するインスタンス
+    """
+    job_metrics = _job_metrics.get()
+    if job_metrics is not None:
+        return job_metrics
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
+
+def start_run(metrics_dir=METRICS_DIR):
+    """
+    新しい実行の計測を始めます。計測結果はmetrics_dirにrun_日時.jsonlとして保存されます。
+    start_jobで囲んだジョブの計測結果は、run_日時_job番号.jsonlにも保存されます。
+
+    Args:
+        metrics_dir (str, optional): 計測結果の保存先のフォルダ. Defaults to METRICS_DIR.
+
+    Returns:
+        Metrics: 計測結果を記録するインスタンス
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is not None:
+            _metrics.close()
+        _metrics = Metrics(os.path.join(metrics_dir, f"run_{datetime.now().strftime('%Y%m%d%H%M%S')}.jsonl"))
+        return _metrics
+
+@contextmanager
+def start_job(job_id):
+    """
+    withで囲んだ間、ジョブの計測結果を実行の計測結果とは別のファイル（run_日時_job番号.jsonl）に記録します。
+    記録した値は実行全体の集計にも含まれます。start_runを呼ぶ前は、集計だけを行います。
+
+    Args:
+        job_id: ジョブのID
+
+    Yields:
+        Metrics: ジョブの計測結果を記録するインスタンス
+    """
+    with _metrics_lock:
+        run = _metrics
+    if run is None:
+        run = get_metrics()
+    path = f"{os.path.splitext(run.path)[0]}_job{job_id}.jsonl" if run.path is not None else None
+    metrics = Metrics(path, parent=run)
+    token = _job_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _job_metrics.reset(token)
+        metrics.close()
+
+def bind(func):
+    """
+    呼び出したスレッドのジョブの計測を、ほかのスレッドで実行する関数に引き継ぎます。
+    ジョブをプロファイル中であれば、そのスレッドもプロファイルします。
+
+    Args:
+        func (callable): ほかのスレッドで実行する関数
+
+    Returns:
+        callable: ジョブの計測を引き継いでfuncを実行する関数（ジョブの外ではfuncそのもの）
+    """
+    metrics = _job_metrics.get()
+    if metrics is None:
+        return func
+
+    def run(*args, **kwargs):
+        token = _job_metrics.set(metrics)
+        profiler = metrics._thread_profiler()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            _job_metrics.reset(token)
+    return run
+
+def end_run():
+    """
+    実行の計測を終え、集計を書き出します。
+
+    Returns:
+        dict: 集計結果
+    """
+    global _metrics
+    with _metrics_lock:
+        metrics, _metrics = _metrics, None
+    if metrics is None:
+        return None
+    summary = metrics.summary()
+    metrics.close()
+    return summary
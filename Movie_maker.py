@@ -3,16 +3,233 @@
 
 @author: Yuta Tanimura
 """
+import bisect
+import inspect
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
 import numpy as np
-from moviepy.audio.AudioClip import CompositeAudioClip
+from moviepy.audio.AudioClip import (AudioArrayClip, AudioClip,
+                                     CompositeAudioClip)
 from moviepy.audio.io.AudioFileClip import AudioFileClip
-from moviepy.editor import (ColorClip, ImageClip, TextClip, VideoFileClip,
-                            concatenate_videoclips)
-from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
-from moviepy.video.io.bindings import mplfig_to_npimage
-from moviepy.video.VideoClip import ColorClip
+from moviepy.config import get_setting
+from moviepy.editor import VideoFileClip, concatenate_videoclips
+from moviepy.video.VideoClip import VideoClip
 from PIL import Image, ImageDraw
-from pydub import AudioSegment
+
+from Audio_processor import write_wav
+from Encoder import resolve_encoder
+from Text_renderer import render_text
+from Timeline import file_fingerprint
+
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 ** 2 # デコードした画像のキャッシュの最大サイズ（バイト）
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+class Image_cache:
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        """
+        デコードしてリサイズした画像を、(パス, 更新時刻, ファイルサイズ, リサイズ後のサイズ)をキーにしてメモリに保持するキャッシュを作成します。
+        同じ画像を使うスライドは、読み取り専用の同じNumPy配列（RGBA, uint8）を共有します。
+        最大サイズを超えると、最後に使われた時刻が古いものから削除します。
+
+        Args:
+            max_bytes (int, optional): キャッシュの最大サイズ（バイト）. Defaults to IMAGE_CACHE_MAX_BYTES.
+        Methods:
+            get(image_path, size) -> np.ndarray:
+                リサイズした画像を返します。
+            clear():
+                キャッシュした画像をすべて解放します。
+        """
+        self.max_bytes = max_bytes
+        self.images = {} # 挿入順が最終使用時刻の古い順
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, image_path, size):
+        """
+        画像をデコードしてリサイズした配列を返します。同じ画像（更新時刻とファイルサイズも同じ）をすでに読み込んでいれば、それを返します。
+
+        Args:
+            image_path (str): 画像のパス
+            size (tuple): リサイズ後のサイズ（幅, 高さ）
+
+        Returns:
+            np.ndarray: 読み取り専用の画像の配列（高さ×幅×4, uint8）
+        """
+        fingerprint = file_fingerprint(image_path)
+        if fingerprint is None:
+            raise FileNotFoundError(f"画像が見つかりません。 > {image_path}")
+        key = (*fingerprint, tuple(size))
+        with self.lock:
+            if key in self.images:
+                self.hits += 1
+                image = self.images.pop(key)
+                self.images[key] = image # 最近使ったものとして末尾に移動
+                return image
+            self.misses += 1
+
+        with Image.open(image_path) as img:
+            image = np.array(img.convert("RGBA").resize(tuple(size), Image.LANCZOS))
+        image.setflags(write=False)
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = image
+                self.total_bytes += image.nbytes
+                while self.total_bytes > self.max_bytes and len(self.images) > 1:
+                    self.total_bytes -= self.images.pop(next(iter(self.images))).nbytes
+            return self.images[key]
+
+    def clear(self):
+        """
+        キャッシュした画像をすべて解放します。使用中のスライドが参照している画像は、そのスライドが解放されるまで残ります。
+        """
+        with self.lock:
+            self.images.clear()
+            self.total_bytes = 0
+
+def get_image_cache():
+    """
+    プロセス全体で共有する画像のキャッシュを返します。
+
+    Returns:
+        Image_cache: 画像のキャッシュ
+    """
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = Image_cache()
+        return _image_cache
+
+
+class Layer:
+    def __init__(self, rgb=None, alpha=None, clip=None, position=(0, 0), start_time=0, end_time=None, frame_size=(1920, 1080)):
+        """
+        Movie_makerで合成するレイヤーを作成します。
+        静止したレイヤーは、画面内に見えている部分だけを乗算済みアルファのNumPy配列として保持します。
+
+        Args:
+            rgb (np.ndarray, optional): レイヤーの画像（高さ×幅×3）. 動画レイヤーの場合はNone.\n
+            alpha (np.ndarray or float, optional): 不透明度（0-1。uint8の配列の場合は0-255）. Defaults to None（不透明）.\n
+            clip (VideoClip, optional): 動画レイヤーのクリップ. Defaults to None.\n
+            position (str or tuple, optional): レイヤーの位置. Defaults to (0, 0).\n
+            start_time (float, optional): レイヤーの開始時間. Defaults to 0.\n
+            end_time (float, optional): レイヤーの終了時間. Defaults to None（終わりなし）.\n
+            frame_size (tuple, optional): 合成先のフレームのサイズ. Defaults to (1920, 1080).
+        """
+        self.clip = clip
+        self.start_time = start_time
+        self.end_time = end_time if end_time is not None else float("inf")
+        self.frame_size = frame_size
+        if clip is not None:
+            self.x, self.y = resolve_position(position, clip.size, frame_size)
+            return
+
+        # 画面外の部分を切り捨て、乗算済みアルファの形で保持する
+        self.x, self.y = resolve_position(position, (rgb.shape[1], rgb.shape[0]), frame_size)
+        region, self.x, self.y = self._visible_region(rgb.shape[1], rgb.shape[0])
+        rgb = rgb[region].astype(np.float32)
+        if alpha is None or np.isscalar(alpha):
+            alpha = 1.0 if alpha is None else float(alpha)
+            self.color = rgb * alpha
+            self.inv_alpha = None if alpha >= 1 else 1.0 - alpha
+        else:
+            # 画面内の部分だけを切り出してから変換する（画像全体の浮動小数点の配列を作らない）
+            alpha = np.asarray(alpha)[region][..., np.newaxis]
+            alpha = alpha * np.float32(1 / 255) if alpha.dtype == np.uint8 else alpha.astype(np.float32)
+            self.color = rgb * alpha
+            self.inv_alpha = None if alpha.size == 0 or alpha.min() >= 1 else 1.0 - alpha
+
+    def _visible_region(self, width, height):
+        """
+        レイヤーのうち、フレーム内に見えている範囲を求めます。
+
+        Args:
+            width (int): レイヤーの横幅
+            height (int): レイヤーの縦幅
+
+        Returns:
+            tuple: (レイヤー側のスライス, 切り取り後のx座標, 切り取り後のy座標)
+        """
+        left, top = max(0, -self.x), max(0, -self.y)
+        right = max(left, min(width, self.frame_size[0] - self.x))
+        bottom = max(top, min(height, self.frame_size[1] - self.y))
+        return (slice(top, bottom), slice(left, right)), self.x + left, self.y + top
+
+    def is_visible(self, t):
+        """
+        指定した時刻にレイヤーが表示されているかどうかを返します。
+        """
+        return self.start_time <= t < self.end_time
+
+    def blend(self, frame, t):
+        """
+        レイヤーをフレームに合成します。レイヤーが覆う範囲だけを更新します。
+
+        Args:
+            frame (np.ndarray): 合成先のフレーム（float32, 高さ×幅×3）
+            t (float): クリップ内の時刻
+        """
+        if self.clip is None:
+            color, inv_alpha, x, y = self.color, self.inv_alpha, self.x, self.y
+        else:
+            rgb = self.clip.get_frame(t - self.start_time)
+            region, x, y = self._visible_region(rgb.shape[1], rgb.shape[0])
+            color = rgb[region].astype(np.float32)
+            inv_alpha = None
+            if self.clip.mask is not None:
+                alpha = self.clip.mask.get_frame(t - self.start_time)[region][..., np.newaxis]
+                color *= alpha
+                inv_alpha = 1.0 - alpha
+        target = frame[y:y + color.shape[0], x:x + color.shape[1]]
+        if inv_alpha is None:
+            target[...] = color
+        else:
+            target *= inv_alpha
+            target += color
+
+
+def _run_ffmpeg(args):
+    """
+    ffmpegを実行します。失敗した場合はエラーの内容を表示して例外を送出します。
+
+    Args:
+        args (list): ffmpegに渡す引数（最後が出力先）
+    """
+    command = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error"] + args
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(result.stderr.decode("utf-8", errors="replace"))
+        raise RuntimeError(f"ffmpegによる書き出しに失敗しました。 > {args[-1]}")
+
+
+def resolve_position(position, layer_size, frame_size):
+    """
+    moviepyと同じ書式の位置指定を、左上の座標に変換します。
+
+    Args:
+        position (str or tuple): 位置. "center"や(x, y)、("center", y)などを指定できます。
+        layer_size (tuple): レイヤーのサイズ
+        frame_size (tuple): フレームのサイズ
+
+    Returns:
+        tuple: 左上の座標(x, y)
+    """
+    if isinstance(position, str):
+        position = (position, position)
+    x, y = position
+    if isinstance(x, str):
+        x = {"left": 0, "center": (frame_size[0] - layer_size[0]) / 2, "right": frame_size[0] - layer_size[0]}[x]
+    if isinstance(y, str):
+        y = {"top": 0, "center": (frame_size[1] - layer_size[1]) / 2, "bottom": frame_size[1] - layer_size[1]}[y]
+    return int(x), int(y)
 
 
 class Movie_maker:
@@ -38,31 +255,268 @@ class Movie_maker:
                 クリップを取得します。\n
             concatenate_clips(clip): 
                 このクリップに、引数のクリップを連結します。\n
+            concatenate_many(clips): 
+                複数のクリップを1本のタイムラインに連結します。\n
+            encode_segment(output_path, codec=None, fps=None, ffmpeg_params=None, profile=None): 
+                クリップの映像だけを、連結可能なセグメントとしてエンコードします。\n
+            join_segments(segment_paths, output_path, audio_path=None): 
+                セグメントをストリームコピーで1本の動画に連結します。\n
             add_image(image_path, position="center", start_time=0, end_time=1, resize_ratio_x=1, resize_ratio_y=1): 
                 画像を追加します。\n
             add_audio(audio_path, start_time=0, end_time=None): 
                 音声をクリップの指定した時点に追加します。\n
+            set_audio_track(samples, sample_rate): 
+                クリップ全体の音声を1本の音声トラックで置き換えます。\n
             add_video(video_path, position="center", start_time=0, end_time=None, resize_ratio_x=1, resize_ratio_y=1): 
                 動画を追加します。\n
             add_rectangle(position=(0, 0), size=(100, 100), color=(255, 255, 255), alpha=255, start_time=0, end_time=None): 
                 矩形を追加します。\n
             add_circle(position=(0, 0), radius=50, color=(255, 255, 255), start_time=0, end_time=None): 
                 円を追加します。\n
+            close(): 
+                レイヤーと音声の読み込みを解放します。\n
         """
-        self.clip = ColorClip(size=size, color=bg_color, duration=duration).set_fps(fps)
+        self.size = size
+        self.bg_color = bg_color
         self.duration = duration
+        self.layers = [] # 合成するレイヤーのリスト（下から順）
+        self.slides = None # concatenate_manyで連結したスライドのリスト
+        self.audio_track = None # set_audio_trackで設定した(音声データ, サンプリングレート)
+        self.offsets = [0, duration] # 各スライドの開始時刻（最後は全体の長さ）
+        self._frame_cache = {} # 表示中のレイヤーの組み合わせごとの合成結果
+        self.clip = VideoClip(make_frame=self._make_frame, duration=duration).set_fps(fps)
+        self.keyframes = {0, duration} # 画面の内容が変化する時刻
+        self.is_static = True # 動画レイヤーを含まない（静止画の連続で表せる）かどうか
 
-    def export_clip(self, output_path, **kwargs):
+    def export_clip(self, output_path, still=False, profile=None, **kwargs):
         """
         クリップをエクスポートして、動画として保存します。
         
         Args:
-            clip (VideoFileClip): エクスポートするクリップ
-            output_path (str): エクスポートするパス
+            output_path (str): エクスポートするパス\n
+            still (bool, optional): Trueの場合、encode_segmentとjoin_segmentsで書き出します（create_movieと同じ書き出し方法です）。
+                動画レイヤーを含むクリップでは通常の書き出しになります. Defaults to False.\n
+            profile (str, optional): エンコーダーのプロファイルの名前（Encoder.ENCODER_PROFILES）。
+                "auto"の場合はこのホストで一番速いプロファイルを選びます. Defaults to None.\n
+            **kwargs: write_videofileに渡す引数（codec, fps, ffmpeg_paramsなど）。
+                codecのエンコーダーが使えない場合は、自動で選んだプロファイルに切り替えます。
         """
         print("クリップをエクスポートしています...")
-        self.clip.write_videofile(output_path, audio=True, **kwargs)
+        settings = resolve_encoder(profile, kwargs.pop("codec", None), kwargs.pop("fps", None), kwargs.pop("ffmpeg_params", None))
+        if settings is not None:
+            kwargs.update({key: value for key, value in settings.items() if value is not None})
+        if still and self.is_static:
+            self._export_still(output_path, **kwargs)
+        else:
+            if still:
+                print("Movie_maker.export_clip: 動画レイヤーを含むため、通常の書き出しを行います。")
+            self.clip.write_videofile(output_path, audio=True, **kwargs)
         print(f"クリップをエクスポートしました。 > {output_path}")
+
+    def _still_spans(self, fps):
+        """
+        画面の内容が変化しない区間の一覧を、フレーム境界に揃えて返します。
+
+        Args:
+            fps (float): 書き出しのフレームレート
+
+        Returns:
+            list: (開始時間, 長さ)のリスト
+        """
+        frames = sorted({round(t * fps) for t in self.keyframes if 0 <= t <= self.duration})
+        return [(a / fps, (b - a) / fps) for a, b in zip(frames[:-1], frames[1:])]
+
+    def _render_chunk(self, temp_dir, index, spans, fps, video_params):
+        """
+        区間ごとに静止画を1枚描画し、映像だけをエンコードします。encode_segmentから呼び出します。
+
+        Args:
+            temp_dir (str): 一時ファイルを置くフォルダ
+            index (int): チャンクの番号
+            spans (list): (開始時間, 長さ)のリスト
+            fps (float): 書き出しのフレームレート
+            video_params (list): 映像のエンコードに使用するffmpegの引数
+
+        Returns:
+            str: エンコードした映像のパス
+        """
+        if not spans:
+            raise ValueError(f"Movie_maker._render_chunk: 描画する区間がありません。 > chunk_{index}")
+        list_path = os.path.join(temp_dir, f"chunk_{index}.txt")
+        previous = None
+        with open(list_path, "w", encoding="utf-8") as f:
+            # 画像のタイムスタンプがフレーム境界からずれないよう、書き出しと同じフレームレートで読み込ませる
+            f.write("ffconcat version 1.0\n")
+            for start, length in spans:
+                slide, t = self._locate(start + length / 2)
+                if previous is not None and previous is not slide:
+                    previous._frame_cache.clear() # 描画し終えたスライドの合成結果を解放する
+                previous = slide
+                frame_path = f"{index}_{round(start * fps)}.png"
+                Image.fromarray(slide.clip.get_frame(t)).save(os.path.join(temp_dir, frame_path), compress_level=1)
+                f.write(f"file '{frame_path}'\noption framerate {fps}\nduration {length:.6f}\n")
+            f.write(f"file '{frame_path}'\noption framerate {fps}\n") # 最後の画像の長さを反映させるため、もう一度指定する
+        if previous is not None:
+            previous._frame_cache.clear()
+
+        chunk_path = os.path.join(temp_dir, f"chunk_{index}.mp4")
+        _run_ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path] + video_params
+                    + ["-an", "-frames:v", str(round(sum(length for _, length in spans) * fps)), chunk_path])
+        return chunk_path
+
+    def _export_still(self, output_path, codec="libx264", fps=None, ffmpeg_params=None, audio_codec="aac", audio_fps=44100, remove_temp=True, **kwargs):
+        """
+        映像をencode_segmentで1つのセグメントとしてエンコードし、join_segmentsで音声を付けて動画にします。
+        create_movieのスライドごとの書き出しと同じ処理なので、処理時間はフレーム数ではなく区間の数に比例します。
+
+        Args:
+            output_path (str): エクスポートするパス\n
+            codec (str, optional): 映像のコーデック. Defaults to "libx264".\n
+            fps (float, optional): フレームレート. Defaults to None（クリップのフレームレート）.\n
+            ffmpeg_params (list, optional): ffmpegに追加で渡す引数. Defaults to None.\n
+            audio_codec (str, optional): 音声のコーデック. Defaults to "aac".\n
+            audio_fps (int, optional): 音声のサンプリングレート. Defaults to 44100.\n
+            remove_temp (bool, optional): 一時ファイルを削除するかどうか. Defaults to True.
+        """
+        # write_videofile専用の引数（presetなど）はここでは使用しない
+        temp_dir = tempfile.mkdtemp(prefix="still_", dir=os.path.dirname(os.path.abspath(output_path)))
+        try:
+            segment_path = os.path.join(temp_dir, "video.mp4")
+            self.encode_segment(segment_path, codec=codec, fps=fps, ffmpeg_params=ffmpeg_params)
+
+            audio_path = None
+            if self.clip.audio is not None:
+                audio_path = os.path.join(temp_dir, "audio.wav")
+                if self.audio_track is not None:
+                    write_wav(audio_path, *self.audio_track) # 作成済みの音声トラックはそのまま書き出す
+                else:
+                    self.clip.audio.write_audiofile(audio_path, fps=audio_fps, codec="pcm_s16le", logger=None)
+            self.join_segments([segment_path], output_path, audio_path=audio_path, audio_codec=audio_codec, audio_fps=audio_fps, duration=self.duration)
+        finally:
+            if remove_temp:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def encode_segment(self, output_path, codec=None, fps=None, ffmpeg_params=None, profile=None):
+        """
+        クリップの映像だけを1つのセグメントとしてエンコードします。
+        同じ設定でエンコードしたセグメントは、join_segmentsで再エンコードせずに連結できます。
+        静止画で表せるクリップは区間ごとに1枚だけ描画し、描画した合成結果はエンコード後に解放します。
+
+        Args:
+            output_path (str): セグメントの保存先\n
+            codec (str, optional): 映像のコーデック。使えない場合は自動で選んだプロファイルに切り替えます. Defaults to None（libx264）.\n
+            fps (float, optional): フレームレート. Defaults to None（クリップのフレームレート）.\n
+            ffmpeg_params (list, optional): ffmpegに追加で渡す引数. Defaults to None.\n
+            profile (str, optional): エンコーダーのプロファイルの名前。"auto"の場合は自動で選びます. Defaults to None.
+        """
+        settings = resolve_encoder(profile, codec, fps, ffmpeg_params) or {"codec": "libx264", "fps": fps, "ffmpeg_params": ffmpeg_params}
+        codec, ffmpeg_params = settings["codec"], settings["ffmpeg_params"]
+        fps = settings["fps"] or self.clip.fps
+        if not self.is_static:
+            self.clip.write_videofile(output_path, audio=False, codec=codec, fps=fps, ffmpeg_params=ffmpeg_params, logger=None)
+            return
+        temp_dir = tempfile.mkdtemp(prefix="segment_", dir=os.path.dirname(os.path.abspath(output_path)))
+        try:
+            video_params = ["-c:v", codec, "-r", str(fps), "-pix_fmt", "yuv420p"] + list(ffmpeg_params or [])
+            os.replace(self._render_chunk(temp_dir, 0, self._still_spans(fps), fps, video_params), output_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @staticmethod
+    def join_segments(segment_paths, output_path, audio_path=None, audio_codec="aac", audio_fps=44100, duration=None):
+        """
+        同じ設定でエンコードしたセグメントを、ストリームコピーで1本の動画に連結します。
+
+        Args:
+            segment_paths (list): セグメントのパスのリスト（再生順）\n
+            output_path (str): 動画の保存先\n
+            audio_path (str, optional): 動画に付ける音声ファイルのパス. Defaults to None.\n
+            audio_codec (str, optional): 音声のコーデック. Defaults to "aac".\n
+            audio_fps (int, optional): 音声のサンプリングレート. Defaults to 44100.\n
+            duration (float, optional): 動画の長さ. Defaults to None（セグメントの合計）.
+        """
+        list_fd, list_path = tempfile.mkstemp(prefix="segments_", suffix=".txt", dir=os.path.dirname(os.path.abspath(output_path)))
+        try:
+            with os.fdopen(list_fd, "w", encoding="utf-8") as f:
+                for segment_path in segment_paths:
+                    escaped = os.path.abspath(segment_path).replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+            command = ["-f", "concat", "-safe", "0", "-i", list_path]
+            if audio_path is not None:
+                command += ["-i", audio_path, "-c:a", audio_codec, "-ar", str(audio_fps)]
+            if duration is not None:
+                command += ["-t", f"{duration:.6f}"]
+            _run_ffmpeg(command + ["-c:v", "copy", output_path])
+        finally:
+            os.remove(list_path)
+
+    def _locate(self, t):
+        """
+        時刻tを表示するスライドと、スライド内の時刻を返します。
+
+        Returns:
+            tuple: (Movie_maker, スライド内の時刻)
+        """
+        if self.slides is None:
+            return self, t
+        i = self._find_slide(t)
+        return self.slides[i], t - self.offsets[i]
+
+    def _make_frame(self, t):
+        """
+        レイヤーを1回だけ合成して、時刻tのフレームを作成します。
+        動くレイヤーが表示されていない場合は、表示中のレイヤーの組み合わせごとに結果を使い回します。
+
+        Args:
+            t (float): クリップ内の時刻
+
+        Returns:
+            np.ndarray: フレーム（uint8, 高さ×幅×3）
+        """
+        active = tuple(i for i, layer in enumerate(self.layers) if layer.is_visible(t))
+        is_moving = any(self.layers[i].clip is not None for i in active)
+        if not is_moving and active in self._frame_cache:
+            return self._frame_cache[active]
+
+        frame = np.empty((self.size[1], self.size[0], 3), dtype=np.float32)
+        frame[...] = self.bg_color
+        for i in active:
+            self.layers[i].blend(frame, t)
+        frame = (frame + 0.5).astype(np.uint8)
+        if not is_moving:
+            frame.setflags(write=False)
+            self._frame_cache[active] = frame
+        return frame
+
+    def close(self):
+        """
+        レイヤー、合成結果のキャッシュ、音声の読み込みを解放します。
+        クリップは自分自身のメソッドを参照しているため、closeを呼ばないとガベージコレクションが動くまでメモリが解放されません。
+        """
+        for layer in self.layers:
+            if layer.clip is not None:
+                layer.clip.close()
+        self.layers = []
+        self._frame_cache.clear()
+        self.slides = None
+        self.audio_track = None
+        if self.clip is not None:
+            self.clip.close()
+            self.clip = None
+
+    def _add_layer(self, layer):
+        """
+        レイヤーを一番上に追加し、表示が切り替わる時刻を記録します。
+
+        Args:
+            layer (Layer): 追加するレイヤー
+        """
+        self.layers.append(layer)
+        self._frame_cache.clear()
+        self.keyframes.add(layer.start_time)
+        self.keyframes.add(min(layer.end_time, self.duration))
+        if layer.clip is not None:
+            self.is_static = False
         
     def add_text(self, text, fontsize=50, color="white", position="center", start_time=0, end_time=None, stroke_color=None, stroke_width=None, font="fonts/MSGOTHIC.TTC", weight="normal"):
         """
@@ -84,20 +538,17 @@ class Movie_maker:
             print("Movie_maker.add_text: テキストが空なので、テキストは追加されません。")
             return
         if end_time is None:
-            end_time = self.clip.duration
-        else:
-            end_time = end_time
+            end_time = self.duration
 
-        if stroke_color is not None and stroke_width is not None:
-            text_clip = TextClip(text, fontsize=fontsize, color=color, font=font, stroke_color=stroke_color, stroke_width=stroke_width)
-        else:
-            text_clip = TextClip(text, fontsize=fontsize, color=color, font=font, weight=weight)
-        text_clip = text_clip.set_position(position).set_start(start_time).set_end(end_time)
-        self.clip = CompositeVideoClip([self.clip, text_clip])
+        # テキストの描画はPillowで行い、同じテキストの描画結果は使い回す
+        rgba = render_text(text, fontsize=fontsize, color=color, font=font, stroke_color=stroke_color, stroke_width=stroke_width, weight=weight)
+        rgb, alpha = rgba[..., :3], rgba[..., 3] / 255
+        self._add_layer(Layer(rgb, alpha, position=position, start_time=start_time, end_time=end_time, frame_size=self.size))
         
     def add_image(self, image_path, end_time=None, position="center", start_time=0, resize_ratio_x=1, resize_ratio_y=1):
         """
         画像を追加します。透過PNGの場合は背景を透過して表示します。
+        デコードとリサイズの結果はプロセス全体の画像のキャッシュで共有するので、同じ画像を何枚のスライドに追加しても読み込みは1回です。
         
         Args:
             image_path (str): 追加する画像のパス\n
@@ -107,15 +558,10 @@ class Movie_maker:
             resize_ratio_x (float, optional): 画像の横幅のリサイズ比率. Defaults to 1.\n
             resize_ratio_y (float, optional): 画像の縦幅のリサイズ比率. Defaults to 1.
         """
-        image_clip = ImageClip(image_path)
-        image_clip = image_clip.resize(width=self.clip.size[0]*resize_ratio_x, height=self.clip.size[1]*resize_ratio_y)
-        image_clip = image_clip.set_position(position)
-        image_clip = image_clip.set_start(start_time)
-        if end_time is not None:
-            image_clip = image_clip.set_end(end_time)
-        else:
-            image_clip = image_clip.set_end(self.clip.duration)
-        self.clip = CompositeVideoClip([self.clip, image_clip])
+        if end_time is None:
+            end_time = self.duration
+        img_array = get_image_cache().get(image_path, (round(self.size[0]*resize_ratio_x), round(self.size[1]*resize_ratio_y)))
+        self._add_layer(Layer(img_array[..., :3], img_array[..., 3], position=position, start_time=start_time, end_time=end_time, frame_size=self.size))
         
     def add_audio(self, audio_path, start_time=0, end_time=None):
         """
@@ -130,7 +576,7 @@ class Movie_maker:
         
         # クリップの終了時間を設定
         if end_time is None:
-            end_time = self.clip.duration
+            end_time = self.duration
 
         # 音声をクリップの長さに合わせてトリミング
         audio = audio.subclip(0, min(audio.duration, end_time - start_time))
@@ -148,6 +594,18 @@ class Movie_maker:
         # 新しい音声をクリップに設定
         self.clip = self.clip.set_audio(new_audio)
         
+    def set_audio_track(self, samples, sample_rate):
+        """
+        クリップ全体の音声を、作成済みの1本の音声トラックで置き換えます。
+        スライドごとに音声ファイルを開く代わりに、Audio_processor.build_narration_trackの結果を設定します。
+
+        Args:
+            samples (np.ndarray): 音声データ（float, -1〜1, サンプル数×チャンネル数）\n
+            sample_rate (int): サンプリングレート
+        """
+        self.audio_track = (samples, sample_rate)
+        self.clip = self.clip.set_audio(AudioArrayClip(samples, fps=sample_rate))
+
     def add_video(self, video_path, position="center", start_time=0, end_time=None, resize_ratio_x=1, resize_ratio_y=1):
         """
         動画を追加します。
@@ -161,14 +619,17 @@ class Movie_maker:
             resize_ratio_y (float, optional): 動画の縦幅のリサイズ比率. Defaults to 1.
         """
         video_clip = VideoFileClip(video_path)
-        video_clip = video_clip.resize(width=self.clip.size[0]*resize_ratio_x, height=self.clip.size[1]*resize_ratio_y)
-        video_clip = video_clip.set_position(position)
-        video_clip = video_clip.set_start(start_time)
-        if end_time is not None:
-            video_clip = video_clip.set_end(end_time)
-        else:
-            video_clip = video_clip.set_end(self.clip.duration)
-        self.clip = CompositeVideoClip([self.clip, video_clip])
+        video_clip = video_clip.resize(width=self.size[0]*resize_ratio_x, height=self.size[1]*resize_ratio_y)
+        if end_time is None:
+            end_time = self.duration
+        self._add_layer(Layer(clip=video_clip, position=position, start_time=start_time, end_time=end_time, frame_size=self.size))
+
+        # 動画の音声も合成する
+        if video_clip.audio is not None:
+            audio = video_clip.audio.subclip(0, min(video_clip.audio.duration, end_time - start_time)).set_start(start_time)
+            if self.clip.audio is not None:
+                audio = CompositeAudioClip([self.clip.audio, audio])
+            self.clip = self.clip.set_audio(audio)
     
     def add_rectangle(self, position=(0, 0), size=(100, 100), color=(255, 255, 255), alpha=255, start_time=0, end_time=None):
         """
@@ -182,25 +643,12 @@ class Movie_maker:
             start_time (float, optional): 矩形の開始時間. Defaults to 0.\n
             end_time (float, optional): 矩形の終了時間. Defaults to None（クリップの終わりまで）.
         """
-        # 透明な背景の画像を作成
-        img = Image.new('RGBA', size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(img)
-        
-        # 矩形を描画（colorにアルファ値を追加）
-        draw.rectangle([0, 0, size[0], size[1]], fill=color + (alpha,))
-        
-        # PIL ImageをNumPy配列に変換
-        img_array = np.array(img)
-        
-        # ImageClipを作成
-        rectangle_clip = ImageClip(img_array)
-        rectangle_clip = rectangle_clip.set_position(position)
-        rectangle_clip = rectangle_clip.set_start(start_time)
-        if end_time is not None:
-            rectangle_clip = rectangle_clip.set_end(end_time)
-        else:
-            rectangle_clip = rectangle_clip.set_end(self.clip.duration)
-        self.clip = CompositeVideoClip([self.clip, rectangle_clip])
+        if end_time is None:
+            end_time = self.duration
+        # 単色なので、不透明度は配列ではなく1つの値で持つ
+        rgb = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        rgb[...] = color
+        self._add_layer(Layer(rgb, alpha / 255, position=position, start_time=start_time, end_time=end_time, frame_size=self.size))
         
     def add_circle(self, position=(0, 0), radius=50, color=(255, 255, 255), start_time=0, end_time=None):
         """
@@ -213,29 +661,18 @@ class Movie_maker:
             start_time (float, optional): 円の開始時間. Defaults to 0.\n
             end_time (float, optional): 円の終了時間. Defaults to None（クリップの終わりまで）.
         """
-        # 透明な背景の画像を作成
-        img = Image.new('RGBA', self.clip.size, (0, 0, 0, 0))
+        if end_time is None:
+            end_time = self.duration
+        # 円を囲む範囲だけの透明な画像を作成
+        img = Image.new('RGBA', (2*radius + 1, 2*radius + 1), (0, 0, 0, 0))
         draw = ImageDraw.Draw(img)
         
         # 円を描画
-        draw.ellipse([position[0]-radius, position[1]-radius,
-                    position[0]+radius, position[1]+radius],
-                    fill=color + (255,))  # アルファ値255を追加
+        draw.ellipse([0, 0, 2*radius, 2*radius], fill=color + (255,))  # アルファ値255を追加
         
         # PIL ImageをNumPy配列に変換
         img_array = np.array(img)
-        
-        # ImageClipを作成
-        circle_clip = ImageClip(img_array)
-        circle_clip = circle_clip.set_duration(end_time - start_time)
-        circle_clip = circle_clip.set_start(start_time)
-        if end_time is not None:
-            circle_clip = circle_clip.set_end(end_time)
-        else:
-            circle_clip = circle_clip.set_end(self.clip.duration)
-        
-        # 既存のクリップに円を合成
-        self.clip = CompositeVideoClip([self.clip, circle_clip])
+        self._add_layer(Layer(img_array[..., :3], img_array[..., 3] / 255, position=(position[0]-radius, position[1]-radius), start_time=start_time, end_time=end_time, frame_size=self.size))
         
     def get_clip(self):
         """
@@ -251,10 +688,128 @@ class Movie_maker:
         このクリップに、引数のクリップを後ろに連結します。
 
         Args:
-            clip (moviepy.video.io.VideoFileClip): 連結するクリップ
+            clip (Movie_maker or moviepy.video.io.VideoFileClip): 連結するクリップ。
+                Movie_makerを渡すと、静止画での書き出しに必要な情報も引き継がれます。
         """
+        if isinstance(clip, Movie_maker):
+            self.keyframes |= {self.duration + t for t in clip.keyframes}
+            self.is_static = self.is_static and clip.is_static
+            clip = clip.get_clip()
+        else:
+            self.keyframes.add(self.duration + clip.duration)
+            self.is_static = False # 中身が分からないクリップは静止画として扱わない
         self.clip = concatenate_videoclips([self.clip, clip])
-        
+        self.duration = self.clip.duration
+        self.offsets.append(self.duration)
+
+    @classmethod
+    def concatenate_many(cls, clips):
+        """
+        複数のクリップを、入れ子にせず1本のタイムラインとして連結します。
+        各クリップの開始時刻の表を持ち、時刻からクリップを二分探索で引くため、
+        クリップの数が増えても1フレームあたりの処理時間は変わりません。
+
+        Args:
+            clips (list): 連結するMovie_makerのリスト
+
+        Returns:
+            Movie_maker: 連結されたクリップをもったMovie_makerインスタンス
+        """
+        offsets = [0]
+        for clip in clips:
+            offsets.append(offsets[-1] + clip.duration)
+        timeline = cls(duration=offsets[-1], size=clips[0].size, fps=clips[0].clip.fps)
+        timeline.slides = clips
+        timeline.offsets = offsets
+        timeline.keyframes = {offset + t for clip, offset in zip(clips, offsets) for t in clip.keyframes}
+        timeline.is_static = all(clip.is_static for clip in clips)
+        timeline._current_slide = 0
+        timeline.clip = VideoClip(make_frame=timeline._make_timeline_frame, duration=timeline.duration).set_fps(timeline.clip.fps)
+        if any(clip.clip.audio is not None for clip in clips):
+            timeline.clip = timeline.clip.set_audio(AudioClip(make_frame=timeline._make_timeline_audio, duration=timeline.duration))
+        return timeline
+
+    def _find_slide(self, t):
+        """
+        時刻tを含むクリップの番号を二分探索で求めます。
+        """
+        return min(max(bisect.bisect_right(self.offsets, t) - 1, 0), len(self.slides) - 1)
+
+    def _make_timeline_frame(self, t):
+        """
+        連結したタイムラインの、時刻tのフレームを作成します。
+        """
+        i = self._find_slide(t)
+        if i != self._current_slide:
+            # 表示し終えたクリップの合成結果はもう使わないので解放する
+            self.slides[self._current_slide]._frame_cache.clear()
+            self._current_slide = i
+        return self.slides[i].clip.get_frame(t - self.offsets[i])
+
+    def _make_timeline_audio(self, t):
+        """
+        連結したタイムラインの、時刻tの音声を作成します。tは配列でも構いません。
+        """
+        t = np.asarray(t)
+        is_scalar = t.ndim == 0
+        t = np.atleast_1d(t)
+        sound = np.zeros((len(t), 2))
+        index = np.searchsorted(self.offsets, t, side="right") - 1
+        for i in np.unique(index):
+            if not 0 <= i < len(self.slides) or self.slides[i].clip.audio is None:
+                continue
+            audio = self.slides[i].clip.audio
+            local_t = t - self.offsets[i]
+            mask = (index == i) & (local_t < (audio.duration if audio.duration is not None else np.inf))
+            if mask.any():
+                sound[mask] = audio.get_frame(local_t[mask]).reshape(int(mask.sum()), -1)
+        return sound[0] if is_scalar else sound
+
+
+class Recipe_recorder:
+    def __init__(self, duration, **kwargs):
+        """
+        Movie_makerの代わりに使い、描画せずにレイヤーを追加する呼び出しだけを記録します。
+        クリップを構成する関数（AI_youtuber.build_slideなど）に渡すと、実際に追加されるレイヤーの構成が分かるので、
+        セグメントのキャッシュのキーに使えます。引数は既定値も含めて記録します。
+
+        Args:
+            duration (float): クリップの長さ
+
+            **kwargs: Movie_makerに渡す残りの引数（bg_color, size, fps）
+        Methods:
+            recipe():
+                記録したクリップの設定とレイヤーの構成を返します。
+        """
+        self.duration = duration
+        self.settings = self._bind("__init__", (duration,), kwargs)
+        self.layers = []
+
+    def _bind(self, name, args, kwargs):
+        """
+        Movie_makerのメソッドの引数を、既定値も含めて名前ごとの辞書にします。
+        """
+        arguments = inspect.signature(getattr(Movie_maker, name)).bind(None, *args, **kwargs)
+        arguments.apply_defaults()
+        return {key: value for key, value in arguments.arguments.items() if key != "self"}
+
+    def __getattr__(self, name):
+        if not name.startswith("add_") or not hasattr(Movie_maker, name):
+            raise AttributeError(name)
+        def record(*args, **kwargs):
+            self.layers.append({"method": name, **self._bind(name, args, kwargs)})
+        return record
+
+    def recipe(self):
+        """
+        記録したクリップの設定とレイヤーの構成を返します。
+
+        Returns:
+            dict: settings（Movie_makerの引数）とlayers（追加した順のレイヤーの引数のリスト）をもつ辞書
+        """
+        return {"settings": self.settings, "layers": self.layers}
+
+
 if __name__ == "__main__":
     test_clip = Movie_maker(duration=5, bg_color=(0,0,0), size=(1920, 1080), fps=60)
     test_clip.add_text("ようこそ。語りのずんだなのだ。", position="center", fontsize=50, color="white", start_time=0, end_time=1)
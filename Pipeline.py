@@ -0,0 +1,159 @@
+"""
+処理を段階ごとに並列に流すパイプラインの機能を提供します。
+
+@author: Yuta Tanimura
+"""
+import queue
+import threading
+import time
+
+from Metrics import bind
+
+# キューの空き・要素を待つ間隔（秒）。この間隔でエラーによる停止を確認します
+POLL_INTERVAL = 0.1
+
+
+class _Stop:
+    """
+    段階の終わりを下流に伝えるための目印です。
+    """
+
+
+class Pipeline:
+    def __init__(self, maxsize=8):
+        """
+        段階ごとにワーカーを持つパイプラインを作成します。
+        段階の間は長さに上限のあるキューでつなぐため、下流が詰まると上流は待たされ、処理中の要素の数（メモリ）が一定に保たれます。
+
+        Args:
+            maxsize (int, optional): 段階の間のキューの最大長. Defaults to 8.
+        Methods:
+            add_stage(name, func, workers=1) -> Pipeline:
+                段階を追加します。
+            run(items) -> list:
+                要素をパイプラインに流し、最後の段階の結果を入力の順番どおりに返します。
+        """
+        self.maxsize = maxsize
+        self.stages = []
+        self.stats = {} # 段階ごとの処理数と処理時間
+
+    def add_stage(self, name, func, workers=1):
+        """
+        段階を追加します。段階は追加した順に実行されます。
+
+        Args:
+            name (str): 段階の名前
+            func (callable): 要素を1つ受け取り、次の段階に渡す値を返す関数
+            workers (int, optional): この段階を並列に処理するワーカーの数. Defaults to 1.
+
+        Returns:
+            Pipeline: このパイプライン（続けてadd_stageを呼べます）
+        """
+        self.stages.append((name, func, max(1, workers)))
+        self.stats[name] = {"items": 0, "busy_sec": 0.0, "workers": max(1, workers)}
+        return self
+
+    def _put(self, q, item, stop):
+        """
+        キューに空きができるまで待って要素を入れます。停止した場合はFalseを返します。
+        """
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q, stop):
+        """
+        キューから要素を取り出します。停止した場合は_Stopを返します。
+        """
+        while not stop.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _Stop
+
+    def run(self, items):
+        """
+        要素をパイプラインに流し、すべての段階が終わるまで待ちます。
+        いずれかの段階で例外が発生した場合は、全体を止めてからその例外を送出します。
+
+        Args:
+            items (iterable): 最初の段階に渡す要素。ジェネレーターでも構いません。
+
+        Returns:
+            list: 最後の段階の結果（入力の順番どおり）
+        """
+        stop = threading.Event()
+        errors = []
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in range(len(self.stages) + 1)]
+        remaining = [workers for _, _, workers in self.stages] # 段階ごとの動作中のワーカーの数
+        lock = threading.Lock()
+
+        def fail(e):
+            with lock:
+                errors.append(e)
+            stop.set()
+
+        def feed():
+            try:
+                for index, item in enumerate(items):
+                    if not self._put(queues[0], (index, item), stop):
+                        return
+            except Exception as e:
+                fail(e)
+                return
+            for _ in range(self.stages[0][2]):
+                self._put(queues[0], _Stop, stop)
+
+        def work(stage_index):
+            name, func, _ = self.stages[stage_index]
+            source, target = queues[stage_index], queues[stage_index + 1]
+            while True:
+                entry = self._get(source, stop)
+                if entry is _Stop:
+                    break
+                index, item = entry
+                start = time.perf_counter()
+                try:
+                    result = func(item)
+                except Exception as e:
+                    fail(e)
+                    return
+                with lock:
+                    self.stats[name]["items"] += 1
+                    self.stats[name]["busy_sec"] += time.perf_counter() - start
+                if not self._put(target, (index, result), stop):
+                    return
+            # この段階の最後のワーカーが、次の段階のワーカーの数だけ終わりの目印を送る
+            with lock:
+                remaining[stage_index] -= 1
+                is_last = remaining[stage_index] == 0
+            if is_last:
+                next_workers = self.stages[stage_index + 1][2] if stage_index + 1 < len(self.stages) else 1
+                for _ in range(next_workers):
+                    self._put(target, _Stop, stop)
+
+        # ジョブの中で実行した場合は、ワーカーの計測結果もそのジョブに記録する
+        threads = [threading.Thread(target=bind(feed), daemon=True)]
+        for stage_index, (_, _, workers) in enumerate(self.stages):
+            threads += [threading.Thread(target=bind(work), args=(stage_index,), daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        results = {}
+        while True:
+            entry = self._get(queues[-1], stop)
+            if entry is _Stop:
+                break
+            index, result = entry
+            results[index] = result
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return [results[index] for index in sorted(results)]
@@ -0,0 +1,175 @@
+"""
+生成済みの物語をフォルダに保存しておくキューと、キューが減ったら裏で物語をまとめて生成して補充する機能を提供します。
+動画を作るときは保存済みの物語を取り出すので、LLMの応答を待たずに済みます。
+
+@author: Yuta Tanimura
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, nullcontext
+
+from ChatGPT import close_async_clients
+from Metrics import get_metrics
+
+QUEUE_DIR = "resources/stories"
+TARGET_SIZE = 7 # キューに保存しておく物語の数
+BATCH_SIZE = 3 # 1回に生成する物語の数の上限
+PREFETCH_INTERVAL = 600 # キューの残りを確認する間隔（秒）
+STOP_TIMEOUT = 60 # 補充を止めるときに、生成中の物語とクライアントを閉じるのを待つ時間（秒）
+
+@asynccontextmanager
+async def _enter_in_thread(context):
+    """
+    同期的に待つコンテキストマネージャー（Job_schedulerのstageなど）に、別のスレッドで入ります。
+    空くのを待つ間も、イベントループを止めません。
+    """
+    await asyncio.to_thread(context.__enter__)
+    try:
+        yield
+    except BaseException as e:
+        if not context.__exit__(type(e), e, e.__traceback__):
+            raise
+    else:
+        context.__exit__(None, None, None)
+
+class Story_queue:
+    def __init__(self, queue_dir=QUEUE_DIR, target_size=TARGET_SIZE):
+        """
+        生成済みの物語を1つずつJSONファイルとして保存するキューを作成します。古いものから順に取り出します。
+        取り出すときはファイルの名前を変えてから読むので、複数のジョブが同じ物語を取り出すことはありません。
+
+        Args:
+            queue_dir (str, optional): 物語を保存するフォルダ. Defaults to QUEUE_DIR.
+            target_size (int, optional): 補充するときに目標とする物語の数. Defaults to TARGET_SIZE.
+        Methods:
+            put(story):
+                物語をキューに追加します。
+            pop():
+                一番古い物語を取り出します。
+            fill(generate, validate, batch_size, stage):
+                目標の数に足りない分の物語を生成して追加します（コルーチン）。
+            start_prefetch(generate, validate, batch_size, interval, stage):
+                裏のスレッドで、キューの補充を繰り返します。
+            stop_prefetch(timeout):
+                キューの補充を止めます。
+        """
+        self.queue_dir = queue_dir
+        self.target_size = target_size
+        self.thread = None
+        self.stopped = threading.Event()
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def _files(self):
+        return sorted(f for f in os.listdir(self.queue_dir) if f.endswith(".json"))
+
+    def __len__(self):
+        return len(self._files())
+
+    def put(self, story):
+        """
+        物語をキューに追加します。書きかけのファイルを取り出さないよう、一時ファイルに書いてから名前を変えます。
+
+        Args:
+            story (dict): 物語（JSONに変換できる辞書）
+        """
+        name = f"{time.time_ns():020d}_{uuid.uuid4().hex[:8]}"
+        tmp_path = os.path.join(self.queue_dir, name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(story, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, os.path.join(self.queue_dir, name + ".json"))
+
+    def pop(self):
+        """
+        一番古い物語を取り出し、キューから削除します。
+
+        Returns:
+            dict: 物語（キューが空の場合はNone）
+        """
+        for file in self._files():
+            path = os.path.join(self.queue_dir, file)
+            claimed_path = path + ".taken"
+            try:
+                os.replace(path, claimed_path) # ほかのジョブが先に取り出した場合は失敗する
+            except OSError:
+                continue
+            try:
+                with open(claimed_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except ValueError as e:
+                print(f"[Error]: 保存した物語を読み込めませんでした。 > {file}, {e}")
+            finally:
+                os.remove(claimed_path)
+        return None
+
+    async def fill(self, generate, validate, batch_size=BATCH_SIZE, stage=None):
+        """
+        目標の数に足りない分の物語をまとめて生成し、検証に通ったものをキューに追加します。
+
+        Args:
+            generate (callable): 生成する数を受け取り、生成した結果のリストを返すコルーチン関数
+            validate (callable): 生成した結果を1つ受け取り、物語の辞書（不正な場合はNone）を返す関数
+            batch_size (int, optional): 1回に生成する物語の数の上限. Defaults to BATCH_SIZE.
+            stage (callable, optional): 生成の間withで囲む、同時実行数を制限するコンテキストマネージャーを返す関数. Defaults to None.
+
+        Returns:
+            int: 追加した物語の数
+        """
+        n = min(batch_size, self.target_size - len(self))
+        if n <= 0:
+            return 0
+        # ジョブの物語の生成と同じ同時実行数の制限（Job_schedulerの"llm"）の中で生成する
+        async with _enter_in_thread(stage() if stage is not None else nullcontext()):
+            with get_metrics().timer("story.prefetch", requested=n) as fields:
+                stories = [validate(text) for text in await generate(n)]
+                fields["added"] = sum(story is not None for story in stories)
+        for story in stories:
+            if story is not None:
+                self.put(story)
+        get_metrics().count("story.invalid", n - fields["added"])
+        print(f"物語を{fields['added']}件生成してキューに追加しました。（不正: {n - fields['added']}件, 残り: {len(self)}件）")
+        return fields["added"]
+
+    def start_prefetch(self, generate, validate, batch_size=BATCH_SIZE, interval=PREFETCH_INTERVAL, stage=None):
+        """
+        裏のスレッドで、interval秒ごとにキューを補充します。スレッドの中で1つのイベントループを使い続けるので、
+        LLMのクライアントの接続も使い回されます。補充を止めるときに、このイベントループのクライアントを閉じます。
+
+        Args:
+            generate (callable): 生成する数を受け取り、生成した結果のリストを返すコルーチン関数
+            validate (callable): 生成した結果を1つ受け取り、物語の辞書（不正な場合はNone）を返す関数
+            batch_size (int, optional): 1回に生成する物語の数の上限. Defaults to BATCH_SIZE.
+            interval (float, optional): キューの残りを確認する間隔（秒）. Defaults to PREFETCH_INTERVAL.
+            stage (callable, optional): 生成の間withで囲む、同時実行数を制限するコンテキストマネージャーを返す関数. Defaults to None.
+        """
+        async def prefetch():
+            try:
+                while not self.stopped.is_set():
+                    try:
+                        added = await self.fill(generate, validate, batch_size, stage)
+                    except Exception as e:
+                        print(f"[Error]: 物語の補充に失敗しました。 > {e}")
+                        added = 0
+                    if added == 0 or len(self) >= self.target_size:
+                        # 満杯か生成に失敗した場合は、次の確認まで待つ
+                        await asyncio.get_running_loop().run_in_executor(None, self.stopped.wait, interval)
+            finally:
+                await close_async_clients()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=asyncio.run, args=(prefetch(),), name="story-prefetch", daemon=True)
+        self.thread.start()
+
+    def stop_prefetch(self, timeout=STOP_TIMEOUT):
+        """
+        キューの補充を止めます。生成中の物語は最後まで生成し、LLMのクライアントを閉じてから止まります。
+
+        Args:
+            timeout (float, optional): 止まるのを待つ時間（秒）. Defaults to STOP_TIMEOUT.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -0,0 +1,219 @@
+"""
+字幕をASSファイルに書き出し、背景画像と字幕と音声から、ffmpegの1回の実行で動画を作成する機能を提供します。
+フレームをPythonで合成しないため、背景が変わらず字幕だけが変わる動画を軽く作成できます。
+
+@author: Yuta Tanimura
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+
+from moviepy.config import get_setting
+from PIL import ImageColor
+
+from Encoder import resolve_encoder
+from Text_renderer import load_font, render_text
+
+
+def _ass_color(color, alpha=255):
+    """
+    色をASSの色の書式（&HAABBGGRR、AAは透明度）に変換します。
+
+    Args:
+        color (str or tuple): 色の名前や(R, G, B)
+        alpha (int, optional): 不透明度（0-255）. Defaults to 255.
+    """
+    r, g, b = ImageColor.getrgb(color)[:3] if isinstance(color, str) else color[:3]
+    return f"&H{255 - alpha:02X}{b:02X}{g:02X}{r:02X}"
+
+def _ass_time(t):
+    """
+    秒をASSの時刻の書式（H:MM:SS.cc）に変換します。
+    """
+    centiseconds = int(round(t * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+def _ass_text(text):
+    """
+    テキストをASSのイベントに書ける形にします。改行は\\Nに、特殊文字は全角に置き換えます。
+    """
+    return text.replace("\\", "＼").replace("{", "｛").replace("}", "｝").replace("\r\n", "\n").replace("\n", "\\N")
+
+class Subtitle_track:
+    def __init__(self, size=(1920, 1080)):
+        """
+        ASS形式の字幕を作成するためのインスタンスを作成します。
+
+        Args:
+            size (tuple, optional): 動画のサイズ. Defaults to (1920, 1080).
+        Methods:
+            add_style(name, font, fontsize, color, stroke_color, stroke_width, bold):
+                字幕のスタイルを追加します。
+            add_event(start_time, end_time, text, style, position):
+                字幕を追加します。
+            write(path):
+                字幕をASSファイルに書き出します。
+        """
+        self.size = size
+        self.styles = {} # スタイルの名前ごとの設定
+        self.events = []
+
+    def add_style(self, name, font, fontsize=50, color="white", stroke_color="black", stroke_width=1, bold=False):
+        """
+        字幕のスタイルを追加します。
+
+        Args:
+            name (str): スタイルの名前
+            font (str): フォントのパス
+            fontsize (int, optional): フォントサイズ. Defaults to 50.
+            color (str or tuple, optional): テキストの色. Defaults to "white".
+            stroke_color (str or tuple, optional): テキストの輪郭の色. Defaults to "black".
+            stroke_width (int, optional): テキストの輪郭の幅. Defaults to 1.
+            bold (bool, optional): 太字にします. Defaults to False.
+        """
+        # ASSのフォントサイズは行の高さ（アセント+ディセント）なので、Pillowのフォントサイズと同じ大きさになるよう換算する
+        pil_font = load_font(font, fontsize)
+        ascent, descent = pil_font.getmetrics()
+        self.styles[name] = {"font": font, "family": pil_font.getname()[0], "fontsize": fontsize, "ass_fontsize": ascent + descent,
+                             "color": color, "stroke_color": stroke_color, "stroke_width": stroke_width or 0, "bold": bold}
+
+    def add_event(self, start_time, end_time, text, style, position="center"):
+        """
+        字幕を追加します。
+
+        Args:
+            start_time (float): 字幕の開始時間
+            end_time (float): 字幕の終了時間
+            text (str): 字幕のテキスト（改行を含めることができます）
+            style (str): add_styleで追加したスタイルの名前
+            position (str or tuple, optional): 字幕の位置。"center"または左上の座標(x, y). Defaults to "center".
+        """
+        if text == "":
+            return
+        if position == "center":
+            override = f"{{\\an5\\pos({self.size[0] // 2},{self.size[1] // 2})}}"
+        else:
+            # Movie_makerと同じく左上の座標で指定するので、描画した幅から上端の中央の座標を求める
+            info = self.styles[style]
+            width = render_text(text, fontsize=info["fontsize"], color=info["color"], font=info["font"],
+                                stroke_color=info["stroke_color"], stroke_width=info["stroke_width"],
+                                weight="bold" if info["bold"] else "normal").shape[1]
+            override = f"{{\\an8\\pos({position[0] + width // 2},{position[1]})}}"
+        self.events.append((start_time, end_time, style, override + _ass_text(text)))
+
+    def font_paths(self):
+        """
+        字幕で使うフォントのパスを返します。
+        """
+        return sorted({style["font"] for style in self.styles.values()})
+
+    def write(self, path):
+        """
+        字幕をASSファイルに書き出します。
+
+        Args:
+            path (str): ASSファイルの保存先
+        """
+        lines = ["[Script Info]", "ScriptType: v4.00+", f"PlayResX: {self.size[0]}", f"PlayResY: {self.size[1]}",
+                 "WrapStyle: 2", "ScaledBorderAndShadow: yes", "",
+                 "[V4+ Styles]",
+                 "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, "
+                 "ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding"]
+        for name, style in self.styles.items():
+            lines.append(f"Style: {name},{style['family']},{style['ass_fontsize']},{_ass_color(style['color'])},{_ass_color(style['color'])},"
+                         f"{_ass_color(style['stroke_color'] or 'black')},{_ass_color('black', 0)},{-1 if style['bold'] else 0},0,0,0,"
+                         f"100,100,0,0,1,{style['stroke_width']},0,5,0,0,0,1")
+        lines += ["", "[Events]", "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text"]
+        for start_time, end_time, style, text in sorted(self.events, key=lambda event: event[0]):
+            lines.append(f"Dialogue: 0,{_ass_time(start_time)},{_ass_time(end_time)},{style},,0,0,0,,{text}")
+        with open(path, "w", encoding="utf-8-sig") as f:
+            f.write("\n".join(lines) + "\n")
+
+def _merge_scenes(scenes):
+    """
+    同じレイヤーをもつ連続した場面を1つにまとめます。
+    """
+    segments = []
+    for scene in scenes:
+        if segments and segments[-1]["layers"] == scene["layers"]:
+            segments[-1]["duration"] += scene["duration"]
+        else:
+            segments.append({"layers": scene["layers"], "duration": scene["duration"]})
+    return segments
+
+def _build_filter_graph(segments, size, fps):
+    """
+    場面ごとの背景を作り、連結して字幕を焼き込むフィルターグラフと、入力する画像のリストを作成します。
+    背景は場面ごとに1フレームだけ合成し、そのフレームを繰り返して場面の長さにします。
+    """
+    inputs, graph = [], []
+    for k, segment in enumerate(segments):
+        graph.append(f"color=c=black:s={size[0]}x{size[1]}:r={fps},trim=end_frame=1,format=rgba[s{k}_0]")
+        for j, layer in enumerate(segment["layers"]):
+            current, output = f"[s{k}_{j}]", f"[s{k}_{j + 1}]"
+            x, y = layer["position"]
+            if "image" in layer:
+                inputs.append(layer["image"])
+                graph.append(f"[{len(inputs) - 1}:v]format=rgba,scale={layer['size'][0]}:{layer['size'][1]}:flags=lanczos[i{k}_{j}]")
+                graph.append(f"{current}[i{k}_{j}]overlay=x={x}:y={y}:format=auto{output}")
+            else:
+                r, g, b = layer["color"]
+                graph.append(f"{current}drawbox=x={x}:y={y}:w={layer['size'][0]}:h={layer['size'][1]}:"
+                             f"color=0x{r:02X}{g:02X}{b:02X}@{layer.get('alpha', 255) / 255:.4f}:t=fill{output}")
+        n_frames = round(segment["duration"] * fps)
+        graph.append(f"[s{k}_{len(segment['layers'])}]loop=loop={n_frames - 1}:size=1:start=0,setpts=N/({fps}*TB),setsar=1[v{k}]")
+    graph.append("".join(f"[v{k}]" for k in range(len(segments))) + f"concat=n={len(segments)}:v=1:a=0[bg]")
+    graph.append("[bg]subtitles=filename=subtitles.ass:fontsdir=fonts,format=yuv420p[out]")
+    return inputs, ";\n".join(graph)
+
+def render_slideshow(scenes, subtitles, save_path, audio_path=None, fps=10, profile="auto", audio_codec="aac", audio_fps=44100):
+    """
+    背景の場面と字幕と音声から、ffmpegを1回だけ実行して動画を作成します。
+
+    Args:
+        scenes (list): 場面の辞書のリスト（再生順）。duration（長さ）と、layers（下から順のレイヤーのリスト）をもちます。
+            レイヤーは画像 {"image": パス, "position": (x, y), "size": (幅, 高さ)} か、
+            矩形 {"color": (R, G, B), "alpha": 不透明度, "position": (x, y), "size": (幅, 高さ)} です。
+            同じレイヤーをもつ連続した場面は、1つにまとめて描画します。
+        subtitles (Subtitle_track): 焼き込む字幕
+        save_path (str): 動画の保存先
+        audio_path (str, optional): 動画に付ける音声ファイルのパス. Defaults to None.
+        fps (float, optional): フレームレート. Defaults to 10.
+        profile (str, optional): エンコーダーのプロファイル（Encoder.ENCODER_PROFILES）. Defaults to "auto".
+        audio_codec (str, optional): 音声のコーデック. Defaults to "aac".
+        audio_fps (int, optional): 音声のサンプリングレート. Defaults to 44100.
+    """
+    settings = resolve_encoder(profile, fps=fps)
+    duration = sum(scene["duration"] for scene in scenes)
+    inputs, graph = _build_filter_graph(_merge_scenes(scenes), subtitles.size, settings["fps"])
+
+    # 字幕のファイル名とフォントのフォルダをフィルターに書くため、作業フォルダで相対パスにして実行する
+    work_dir = tempfile.mkdtemp(prefix="subtitles_", dir=os.path.dirname(os.path.abspath(save_path)))
+    try:
+        subtitles.write(os.path.join(work_dir, "subtitles.ass"))
+        os.makedirs(os.path.join(work_dir, "fonts"))
+        for font_path in subtitles.font_paths():
+            shutil.copy(font_path, os.path.join(work_dir, "fonts"))
+        with open(os.path.join(work_dir, "graph.txt"), "w", encoding="utf-8") as f:
+            f.write(graph)
+
+        command = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error"]
+        for image_path in inputs:
+            command += ["-i", os.path.abspath(image_path)]
+        if audio_path is not None:
+            command += ["-i", os.path.abspath(audio_path)]
+        command += ["-filter_complex_script", "graph.txt", "-map", "[out]"]
+        if audio_path is not None:
+            command += ["-map", f"{len(inputs)}:a", "-c:a", audio_codec, "-ar", str(audio_fps)]
+        command += ["-c:v", settings["codec"], "-r", str(settings["fps"])] + list(settings["ffmpeg_params"] or [])
+        command += ["-t", f"{duration:.6f}", os.path.abspath(save_path)]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=work_dir)
+        if result.returncode != 0:
+            print(result.stderr.decode("utf-8", errors="replace"))
+            raise RuntimeError(f"ffmpegによる書き出しに失敗しました。 > {save_path}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,71 @@
+"""
+Pillowを使用してテキストを画像に描画する機能を提供します。
+
+@author: Yuta Tanimura
+"""
+import math
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# 太さごとの、文字と同じ色で重ねる縁取りの幅（フォントサイズに対する比率）
+WEIGHT_RATIOS = {"thin": 0, "light": 0, "normal": 0, "bold": 1 / 30, "black": 1 / 15}
+# 行と行の間の余白（ピクセル）
+LINE_SPACING = 4
+
+
+@lru_cache(maxsize=32)
+def load_font(font_path, fontsize):
+    """
+    フォントを読み込みます。同じフォントとサイズの組み合わせは1回だけ読み込みます。
+
+    Args:
+        font_path (str): フォントのパス
+        fontsize (int): フォントサイズ
+
+    Returns:
+        ImageFont.FreeTypeFont: フォント
+    """
+    return ImageFont.truetype(font_path, fontsize)
+
+
+@lru_cache(maxsize=256)
+def render_text(text, fontsize=50, color="white", font="fonts/MSGOTHIC.TTC", stroke_color=None, stroke_width=None, weight="normal"):
+    """
+    テキストを中央揃えで描画し、RGBAの配列を返します。同じ引数の結果は使い回します。
+
+    Args:
+        text (str): 描画するテキスト。改行を含めることができます。
+        fontsize (int, optional): フォントサイズ. Defaults to 50.
+        color (str or tuple, optional): テキストの色. Defaults to "white".
+        font (str, optional): フォントのパス. Defaults to "fonts/MSGOTHIC.TTC".
+        stroke_color (str or tuple, optional): テキストの輪郭の色. Defaults to None.
+        stroke_width (int, optional): テキストの輪郭の幅. Defaults to None.
+        weight (str, optional): フォントの太さ. normal, bold, light, thin, black. Defaults to "normal".
+            太字は文字と同じ色の縁取りを重ねて表現します。
+
+    Returns:
+        np.ndarray: 描画結果（uint8, 高さ×幅×4）。使い回すため書き込みはできません。
+    """
+    pil_font = load_font(font, fontsize)
+    bold_width = round(fontsize * WEIGHT_RATIOS[weight])
+    outline_width = stroke_width if stroke_color is not None and stroke_width else 0
+    margin = bold_width + outline_width
+
+    # 行の高さはフォントの大きさだけで決め、縁取りの有無で行間が変わらないように1行ずつ描画する
+    ascent, descent = pil_font.getmetrics()
+    line_height = ascent + descent + LINE_SPACING
+    lines = text.split("\n")
+    widths = [math.ceil(pil_font.getlength(line)) for line in lines]
+    img = Image.new("RGBA", (max(widths) + 2 * margin, len(lines) * line_height - LINE_SPACING + 2 * margin), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for i, (line, width) in enumerate(zip(lines, widths)):
+        origin = (margin + (max(widths) - width) / 2, margin + i * line_height) # 中央揃え
+        if outline_width:
+            draw.text(origin, line, font=pil_font, fill=color, anchor="la", stroke_width=bold_width + outline_width, stroke_fill=stroke_color)
+        draw.text(origin, line, font=pil_font, fill=color, anchor="la", stroke_width=bold_width, stroke_fill=color)
+
+    rgba = np.asarray(img)
+    rgba.setflags(write=False)
+    return rgba
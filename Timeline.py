@@ -0,0 +1,266 @@
+"""
+動画のタイムライン（スライドごとのテキスト・音声・長さ・開始時刻・レイヤーの構成）をマニフェストとして記録し、
+スライドの内容のハッシュをキーにして、エンコード済みのセグメントを再利用する機能を提供します。
+1行だけ直して動画を作り直す場合は、内容が変わったスライドだけをエンコードし直し、残りはキャッシュのセグメントを連結します。
+
+@author: Yuta Tanimura
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+MANIFEST_VERSION = 1
+# エンコード済みのセグメントのキャッシュの保存先と最大サイズ（バイト）
+SEGMENT_CACHE_DIR = "resources/cache/segments"
+SEGMENT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+RECIPE_FILE_KEYS = ("image_path", "video_path", "font") # レイヤーの構成のうち、ファイルのパスを表す引数
+
+_segment_cache = None
+_segment_cache_lock = threading.Lock()
+
+def file_fingerprint(path):
+    """
+    ファイルの内容を読まずに、変更を検出するための(パス, 更新時刻, サイズ)を返します。ファイルがない場合はNoneを返します。
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+def file_digest(path):
+    """
+    ファイルの内容のハッシュ（SHA-256の16進数表記）を返します。ファイルがない場合はNoneを返します。
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _file_fingerprints(recipe):
+    """
+    レイヤーの構成に含まれる画像、動画、フォントのファイルの(パス, 更新時刻, サイズ)のリストを返します。
+    ファイルを差し替えるとハッシュが変わります。
+    """
+    return [file_fingerprint(layer[key]) for layer in recipe.get("layers", []) for key in RECIPE_FILE_KEYS if layer.get(key) is not None]
+
+def slide_key(kind, text, duration, recipe, settings=None):
+    """
+    スライドの映像の内容のハッシュを返します。同じハッシュのスライドは、同じセグメントにエンコードされます。
+    音声は映像とは別のトラックにするので、音声の内容は長さ（duration）を通してだけハッシュに含まれます。
+
+    Args:
+        kind (str): スライドの種類
+        text (str): 表示するテキスト
+        duration (float): スライドの長さ
+        recipe (dict): レイヤーの構成（layersに画像やフォントがあれば、ファイルの更新時刻とサイズも含めます）
+        settings (dict, optional): エンコードの設定（codec, fps, ffmpeg_params）. Defaults to None.
+
+    Returns:
+        str: ハッシュ（SHA-256の16進数表記）
+    """
+    content = {"kind": kind, "text": text, "duration": round(duration, 6), "recipe": recipe,
+               "files": _file_fingerprints(recipe), "settings": settings}
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+class Timeline:
+    def __init__(self, settings=None):
+        """
+        動画のタイムラインを作成します。スライドを再生順に追加すると、開始時刻とハッシュが記録されます。
+
+        Args:
+            settings (dict, optional): エンコードの設定（codec, fps, ffmpeg_params）. Defaults to None.
+        Methods:
+            add_slide(kind, text, audio, duration, recipe):
+                スライドを末尾に追加します。
+            changed_slides(previous):
+                前回のタイムラインから内容が変わったスライドの番号を返します。
+            save(path):
+                マニフェストをJSONファイルに保存します。
+            load(path):
+                保存したマニフェストを読み込みます（クラスメソッド）。
+        """
+        self.settings = settings
+        self.slides = []
+
+    @property
+    def duration(self):
+        """
+        タイムライン全体の長さを返します。
+        """
+        return sum(slide["duration"] for slide in self.slides)
+
+    def add_slide(self, kind, text, audio, duration, recipe):
+        """
+        スライドを末尾に追加します。
+
+        Args:
+            kind (str): スライドの種類
+            text (str): 表示するテキスト
+            audio (str): 音声ファイルのパス（ない場合はNone）
+            duration (float): スライドの長さ
+            recipe (dict): レイヤーの構成
+
+        Returns:
+            dict: index, offset（開始時刻）, hash（映像の内容のハッシュ）, audio_hash（音声の内容のハッシュ）を含むスライド
+        """
+        slide = {"index": len(self.slides), "kind": kind, "text": text, "audio": audio, "duration": duration,
+                 "offset": round(self.duration, 6), "recipe": recipe,
+                 "hash": slide_key(kind, text, duration, recipe, self.settings), "audio_hash": file_digest(audio)}
+        self.slides.append(slide)
+        return slide
+
+    def changed_slides(self, previous):
+        """
+        前回のタイムラインと比べて、映像か音声の内容が変わったスライドの番号を返します。
+
+        Args:
+            previous (Timeline): 前回のタイムライン（ない場合はNone）
+
+        Returns:
+            list: 内容が変わった（または新しく増えた）スライドの番号のリスト
+        """
+        old = previous.slides if previous is not None else []
+        return [slide["index"] for slide in self.slides
+                if slide["index"] >= len(old) or (slide["hash"], slide["audio_hash"]) != (old[slide["index"]]["hash"], old[slide["index"]]["audio_hash"])]
+
+    def save(self, path):
+        """
+        マニフェストをJSONファイルに保存します。
+
+        Args:
+            path (str): 保存先のパス
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "settings": self.settings, "duration": self.duration, "slides": self.slides},
+                      f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        保存したマニフェストを読み込みます。
+
+        Args:
+            path (str): マニフェストのパス
+
+        Returns:
+            Timeline: タイムライン。ファイルがない場合や形式が違う場合はNone
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[Error]: タイムラインのマニフェストを読み込めませんでした。 > {e}")
+            return None
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+        timeline = cls(data.get("settings"))
+        timeline.slides = data["slides"]
+        return timeline
+
+def _link_or_copy(src, dst):
+    """
+    ファイルをハードリンクで作成します。できない場合（別のドライブなど）はコピーします。
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class Segment_cache:
+    def __init__(self, cache_dir=SEGMENT_CACHE_DIR, max_bytes=SEGMENT_CACHE_MAX_BYTES):
+        """
+        エンコード済みのセグメントを、スライドの内容のハッシュをキーにしてディスクに保存するキャッシュを作成します。
+        最大サイズを超えると、最後に使われた時刻が古いものから削除します（最終使用時刻はファイルの更新時刻で管理します）。
+
+        Args:
+            cache_dir (str, optional): キャッシュの保存先. Defaults to SEGMENT_CACHE_DIR.
+            max_bytes (int, optional): キャッシュの最大サイズ（バイト）. Defaults to SEGMENT_CACHE_MAX_BYTES.
+        Methods:
+            get(key, output_path) -> bool:
+                キャッシュされたセグメントをoutput_pathに取り出します。
+            put(key, segment_path):
+                セグメントをキャッシュに保存します。
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # 既存のキャッシュを最終使用時刻の古い順に読み込む
+        entries = []
+        for file in os.listdir(cache_dir):
+            if file.endswith(".mp4"):
+                stat = os.stat(os.path.join(cache_dir, file))
+                entries.append((stat.st_mtime, file[:-4], stat.st_size))
+        self.sizes = {key: size for _, key, size in sorted(entries)} # 挿入順が最終使用時刻の古い順
+        self.total_bytes = sum(self.sizes.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".mp4")
+
+    def get(self, key, output_path):
+        """
+        キャッシュされたセグメントをoutput_pathに取り出します（ハードリンクかコピー）。
+
+        Args:
+            key (str): スライドの内容のハッシュ
+            output_path (str): セグメントの出力先
+
+        Returns:
+            bool: キャッシュにあった場合はTrue
+        """
+        with self.lock:
+            if key not in self.sizes:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.sizes[key] = self.sizes.pop(key) # 最近使ったものとして末尾に移動
+            os.utime(self._path(key))
+            _link_or_copy(self._path(key), output_path)
+        return True
+
+    def put(self, key, segment_path):
+        """
+        セグメントをキャッシュに保存し、最大サイズを超えた分を古いものから削除します。segment_pathのファイルはそのまま残ります。
+
+        Args:
+            key (str): スライドの内容のハッシュ
+            segment_path (str): エンコードしたセグメントのパス
+        """
+        temp_path = self._path(key) + f".{threading.get_ident()}.tmp"
+        _link_or_copy(segment_path, temp_path)
+        size = os.path.getsize(temp_path)
+        with self.lock:
+            os.replace(temp_path, self._path(key))
+            self.total_bytes += size - self.sizes.pop(key, 0)
+            self.sizes[key] = size
+            while self.total_bytes > self.max_bytes and len(self.sizes) > 1:
+                old_key = next(iter(self.sizes))
+                self.total_bytes -= self.sizes.pop(old_key)
+                os.remove(self._path(old_key))
+
+def get_segment_cache():
+    """
+    プロセス全体で共有するセグメントのキャッシュを返します。
+
+    Returns:
+        Segment_cache: セグメントのキャッシュ
+    """
+    global _segment_cache
+    with _segment_cache_lock:
+        if _segment_cache is None:
+            _segment_cache = Segment_cache()
+        return _segment_cache
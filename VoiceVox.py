@@ -3,25 +3,367 @@ VoiceVoxエンジンを使用して音声生成を行う機能を提供します
 
 @author: Yuta Tanimura
 """
+import hashlib
+import io
 import json
+import os
+import threading
+import time
+import unicodedata
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import soundfile as sf
+from requests.adapters import HTTPAdapter
+
+from Metrics import bind, get_metrics
 
 # VOICEVOXエンジンのURL（デフォルトのポート番号は50021）
 BASE_URL = "http://localhost:50021"
+# 同時に送るリクエストの最大数
+MAX_WORKERS = 4
+# /multi_synthesisで1回に合成する行の数
+BATCH_SIZE = 16
+# 1リクエストあたりのタイムアウト（秒）
+TIMEOUT = 120
+# 合成済み音声のキャッシュの保存先と最大サイズ（バイト）
+CACHE_DIR = "resources/cache/voice"
+CACHE_MAX_BYTES = 1024 ** 3
+# 読み間違いを直すためのユーザー辞書（{"表記": {"pronunciation": "カタカナの読み", "accent_type": アクセント核の位置}}）
+USER_DICT_PATH = "resources/param/user_dict.json"
+
+_session = None
+_session_lock = threading.Lock()
+_engine_version = None
+_voice_cache = None
+_user_dict_version = None # エンジンに登録したユーザー辞書のハッシュ。読みが変わるのでキャッシュのキーに含める
+_max_concurrency = MAX_WORKERS # プロセス全体でエンジンに同時に送る合成の数
+_engine_semaphore = threading.BoundedSemaphore(_max_concurrency)
+
+
+class Voice_cache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        """
+        合成済みの音声を、テキスト・話者・速さ・エンジンのバージョンのハッシュをキーにしてディスクに保存するキャッシュを作成します。
+        最大サイズを超えると、最後に使われた時刻が古いものから削除します（最終使用時刻はファイルの更新時刻で管理します）。
+
+        Args:
+            cache_dir (str, optional): キャッシュの保存先. Defaults to CACHE_DIR.
+            max_bytes (int, optional): キャッシュの最大サイズ（バイト）. Defaults to CACHE_MAX_BYTES.
+        Methods:
+            make_key(text, speaker, speed, version) -> str:
+                キャッシュのキーを作成します。
+            get(key) -> bytes:
+                キャッシュされた音声を返します。ない場合はNoneを返します。
+            put(key, content):
+                音声をキャッシュに保存します。
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # 既存のキャッシュを最終使用時刻の古い順に読み込む
+        entries = []
+        for file in os.listdir(cache_dir):
+            if file.endswith(".wav"):
+                stat = os.stat(os.path.join(cache_dir, file))
+                entries.append((stat.st_mtime, file[:-4], stat.st_size))
+        self.sizes = {key: size for _, key, size in sorted(entries)} # 挿入順が最終使用時刻の古い順
+        self.total_bytes = sum(self.sizes.values())
+
+    @staticmethod
+    def make_key(text, speaker, speed, version):
+        """
+        キャッシュのキーを作成します。
+
+        Returns:
+            str: キー（SHA-256の16進数表記）
+        """
+        return hashlib.sha256(json.dumps([text, speaker, speed, version], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".wav")
+
+    def get(self, key):
+        """
+        キャッシュされた音声を返します。
+
+        Args:
+            key (str): キャッシュのキー
+
+        Returns:
+            bytes: WAVのバイト列。キャッシュにない場合（読み込む前に削除された場合を含む）はNone
+        """
+        with self.lock:
+            if key not in self.sizes:
+                self.misses += 1
+                return None
+            self.sizes[key] = self.sizes.pop(key) # 最近使ったものとして末尾に移動
+        try:
+            os.utime(self._path(key))
+            with open(self._path(key), "rb") as f:
+                content = f.read()
+        except OSError:
+            # ほかのスレッドのputで追い出されたか、外部から削除された場合はキャッシュにないものとして扱う
+            with self.lock:
+                self.misses += 1
+                if key in self.sizes and not os.path.exists(self._path(key)):
+                    self.total_bytes -= self.sizes.pop(key)
+            return None
+        with self.lock:
+            self.hits += 1
+        return content
+
+    def put(self, key, content):
+        """
+        音声をキャッシュに保存し、最大サイズを超えた分を古いものから削除します。
+
+        Args:
+            key (str): キャッシュのキー
+            content (bytes): WAVのバイト列
+        """
+        temp_path = self._path(key) + f".{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        with self.lock:
+            os.replace(temp_path, self._path(key))
+            self.total_bytes += len(content) - self.sizes.pop(key, 0)
+            self.sizes[key] = len(content)
+            while self.total_bytes > self.max_bytes and len(self.sizes) > 1:
+                old_key = next(iter(self.sizes))
+                self.total_bytes -= self.sizes.pop(old_key)
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass # すでに削除されている
 
 
-def generate_voice(text, speaker=1, output_path="resources/voice/", speed=1.0):
+def get_voice_cache():
+    """
+    プロセス全体で共有する音声キャッシュを返します。
+
+    Returns:
+        Voice_cache: 音声キャッシュ
+    """
+    global _voice_cache
+    with _session_lock:
+        if _voice_cache is None:
+            _voice_cache = Voice_cache()
+        return _voice_cache
+
+
+def _get_engine_version():
+    """
+    VOICEVOXエンジンのバージョンを返します。取得できない場合は"unknown"を返します。
+    """
+    global _engine_version
+    if _engine_version is None:
+        try:
+            response = _get_session().get(f"{BASE_URL}/version", timeout=TIMEOUT)
+            response.raise_for_status()
+            _engine_version = response.json()
+        except (requests.RequestException, ValueError):
+            return "unknown" # 次回また取得を試みる
+    return _engine_version
+
+
+def _cache_version():
+    """
+    キャッシュのキーに含めるバージョン（エンジンのバージョンと、登録したユーザー辞書）を返します。
+    """
+    version = _get_engine_version()
+    return version if _user_dict_version is None else f"{version}|dict:{_user_dict_version}"
+
+
+def _mount_adapter(session):
+    """
+    同時に送るリクエストの数だけ接続を保持するアダプターを、セッションに設定します。
+    プールより多く同時に送ると、あふれた接続はリクエストのたびに作り直されて捨てられます。
+    """
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max(MAX_WORKERS, _max_concurrency)))
+
+
+def _get_session():
+    """
+    VOICEVOXエンジンとの接続を使い回すためのセッションを返します。
+
+    Returns:
+        requests.Session: キープアライブ接続を持つセッション
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _mount_adapter(_session)
+        return _session
+
+
+def set_max_concurrency(n):
+    """
+    プロセス全体でVOICEVOXエンジンに同時に送る音声合成の数を設定します。
+    複数のジョブが並列にボイスを生成しても、エンジンへの負荷はこの数までに抑えられます。
+    作成済みのセッションには、この数に合わせた接続のプールを設定し直します。
+
+    Args:
+        n (int): 同時に送る音声合成の最大数
+    """
+    global _engine_semaphore, _max_concurrency
+    with _session_lock:
+        _max_concurrency = max(1, n)
+        _engine_semaphore = threading.BoundedSemaphore(_max_concurrency)
+        if _session is not None:
+            _mount_adapter(_session)
+
+
+def _audio_query(text, speaker, speed):
+    """
+    音声合成用のクエリを作成し、話す速さを設定して返します。
+    """
+    query_response = _get_session().post(f"{BASE_URL}/audio_query", params={"text": text, "speaker": speaker}, timeout=TIMEOUT)
+    query_response.raise_for_status()
+    query_data = query_response.json()
+    query_data["speedScale"] = speed
+    return query_data
+
+
+def _synthesize(text, speaker, speed):
+    """
+    VOICEVOXで音声を合成し、WAVのバイト列を返します。
+
+    Args:
+        text (str): 音声合成するテキスト
+        speaker (int): 声の種類
+        speed (float): 話す速さ
+
+    Returns:
+        bytes: WAVのバイト列
+    """
+    session = _get_session()
+    with _engine_semaphore, get_metrics().timer("tts.synthesize", chars=len(text), speaker=speaker) as fields:
+        # 音声合成用のクエリを作成し、話す速さを設定
+        query_data = _audio_query(text, speaker, speed)
+        fields["kana"] = query_data.get("kana") # エンジンが解析した読み（読み間違いの確認用）
+
+        # 音声合成を実行
+        synthesis_payload = {"speaker": speaker}
+        synthesis_response = session.post(
+            f"{BASE_URL}/synthesis",
+            headers={"Content-Type": "application/json"},
+            params=synthesis_payload,
+            data=json.dumps(query_data),
+            timeout=TIMEOUT
+        )
+        synthesis_response.raise_for_status()
+        fields["bytes"] = len(synthesis_response.content)
+    return synthesis_response.content
+
+
+def sync_user_dict(path=USER_DICT_PATH):
+    """
+    ローカルのユーザー辞書を、VOICEVOXエンジンのユーザー辞書（/user_dict）に登録します。
+    同じ表記の単語がエンジンにある場合は読みとアクセントを更新し、ない場合は追加します。エンジンにだけある単語は削除しません。
+    登録した辞書のハッシュをキャッシュのキーに含めるので、読みを直した行は次回から合成し直されます。
+
+    Args:
+        path (str, optional): ユーザー辞書のJSONファイルのパス. Defaults to USER_DICT_PATH.
+
+    Returns:
+        int: 追加または更新した単語の数。ファイルがない場合や登録に失敗した場合はNone
+    """
+    global _user_dict_version
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        words = json.load(f)
+    session = _get_session()
+    try:
+        response = session.get(f"{BASE_URL}/user_dict", timeout=TIMEOUT)
+        response.raise_for_status()
+        # エンジンは表記を全角に変換して保存するので、NFKCで正規化して比べる
+        registered = {unicodedata.normalize("NFKC", word["surface"]): (word_uuid, word) for word_uuid, word in response.json().items()}
+        changed = 0
+        for surface, word in words.items():
+            params = {"surface": surface, "pronunciation": word["pronunciation"], "accent_type": word.get("accent_type", 0)}
+            for name in ("word_type", "priority"):
+                if name in word:
+                    params[name] = word[name]
+            word_uuid, current = registered.get(unicodedata.normalize("NFKC", surface), (None, None))
+            if current is None:
+                session.post(f"{BASE_URL}/user_dict_word", params=params, timeout=TIMEOUT).raise_for_status()
+            elif current.get("pronunciation") != params["pronunciation"] or current.get("accent_type") != params["accent_type"]:
+                session.put(f"{BASE_URL}/user_dict_word/{word_uuid}", params=params, timeout=TIMEOUT).raise_for_status()
+            else:
+                continue
+            changed += 1
+    except requests.RequestException as e:
+        print(f"[Error]: ユーザー辞書を登録できませんでした． > {e}")
+        return None
+    _user_dict_version = hashlib.sha256(json.dumps(words, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return changed
+
+
+def _multi_synthesize(texts, speaker, speed):
+    """
+    複数の行のクエリを作成し、/multi_synthesisの1回のリクエストでまとめて音声を合成します。
+    エンジンが返すZIPファイルはメモリ上で展開し、行の順番どおりのWAVのバイト列のリストにします。
+
+    Args:
+        texts (list): 音声合成するテキストのリスト
+        speaker (int): 声の種類
+        speed (float): 話す速さ（クエリごとに設定します）
+
+    Returns:
+        list: 行の順番どおりのWAVのバイト列のリスト
+    """
+    def query(text):
+        with _engine_semaphore:
+            return _audio_query(text, speaker, speed)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        queries = list(executor.map(bind(query), texts))
+    with _engine_semaphore, get_metrics().timer("tts.multi_synthesis", lines=len(texts), chars=sum(map(len, texts)), speaker=speaker) as fields:
+        response = _get_session().post(
+            f"{BASE_URL}/multi_synthesis",
+            headers={"Content-Type": "application/json"},
+            params={"speaker": speaker},
+            data=json.dumps(queries),
+            timeout=TIMEOUT * max(1, len(texts) // MAX_WORKERS)
+        )
+        response.raise_for_status()
+        fields["bytes"] = len(response.content)
+    # ZIPの中のファイル名は、クエリの順番の連番（001.wavなど）
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        names = sorted((name for name in archive.namelist() if name.endswith(".wav")), key=lambda name: int(os.path.splitext(os.path.basename(name))[0]))
+        if len(names) != len(texts):
+            raise ValueError(f"合成した音声の数が行の数と一致しません．（{len(names)}/{len(texts)}）")
+        return [archive.read(name) for name in names]
+
+
+def _is_transient(error):
+    """
+    リトライすれば成功する可能性のあるエラーかどうかを返します。
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return False
+
+
+def generate_voice(text, speaker=1, output_path="resources/voice/", speed=1.0, use_cache=True):
     """
     VOICEVOXで音声を生成します。VOICEVOXのエンジンを立ち上げておく必要があります。
 
     Args:
         text (str): 音声合成するテキスト
         speaker (int, optional): 声の種類. Defaults to 1.
-        output_file (str, optional): 音声ファイルの出力先. Defaults to "output.wav".
+        output_path (str, optional): 音声ファイルの出力先. Defaults to "resources/voice/".
         speed (float, optional): 話す速さ. Defaults to 1.0.
-        style (int, optional): 声の種類. Defaults to 0. 
+        use_cache (bool, optional): 合成済みの音声があればエンジンを使わずに再利用します. Defaults to True.
         
     話者: ずんだもん
     Speaker: 3, 名前: ノーマル
@@ -33,32 +375,151 @@ def generate_voice(text, speaker=1, output_path="resources/voice/", speed=1.0):
     Speaker: 75, 名前: ヘロヘロ
     Speaker: 76, 名前: なみだめ
     """
-    # 音声合成用のクエリを作成
-    query_payload = {"text": text, "speaker": speaker}
+    if use_cache:
+        cache = get_voice_cache()
+        key = cache.make_key(text, speaker, speed, _cache_version())
+        content = cache.get(key)
+        get_metrics().count("tts.cache_hit" if content is not None else "tts.cache_miss")
+        if content is None:
+            content = _synthesize(text, speaker, speed)
+            cache.put(key, content)
+    else:
+        content = _synthesize(text, speaker, speed)
 
-    query_response = requests.post(f"{BASE_URL}/audio_query", params=query_payload)
-    query_data = query_response.json()
+    # 音声データを保存
+    with open(output_path, "wb") as f:
+        f.write(content)
 
 
-    # 話す速さを設定
-    query_data["speedScale"] = speed
+def generate_voice_retry(text, speaker=1, output_path="resources/voice/", speed=1.0, retries=3):
+    """
+    VOICEVOXで音声を生成します。一時的なエラー（接続エラー、タイムアウト、5xx）の場合は指数バックオフでリトライします。
+
+    Args:
+        text (str): 音声合成するテキスト
+        speaker (int, optional): 声の種類. Defaults to 1.
+        output_path (str, optional): 音声ファイルの出力先. Defaults to "resources/voice/".
+        speed (float, optional): 話す速さ. Defaults to 1.0.
+        retries (int, optional): リトライ回数. Defaults to 3.
 
-    # 音声合成を実行
-    synthesis_payload = {"speaker": speaker}
-    synthesis_response = requests.post(
-        f"{BASE_URL}/synthesis",
-        headers={"Content-Type": "application/json"},
-        params=synthesis_payload,
-        data=json.dumps(query_data)
-    )
+    Returns:
+        str: 音声ファイルのパス。生成に失敗した場合はNone
+    """
+    for attempt in range(retries + 1):
+        try:
+            generate_voice(text, speaker=speaker, output_path=output_path, speed=speed)
+            return output_path
+        except requests.RequestException as e:
+            if attempt == retries or not _is_transient(e):
+                print(f"[Error]: ボイス生成に失敗しました．「{text}」 > {output_path}")
+                print(e)
+                return None
+            time.sleep(0.5 * 2 ** attempt) # 指数バックオフ
 
-    # 音声データを保存
-    with open(output_path, "wb") as f:
-        f.write(synthesis_response.content)
+
+def generate_voices(lines, speaker=1, speed=1.0, out_dir="resources/voice/", start_index=0, max_workers=MAX_WORKERS, retries=3, indices=None, on_voice=None):
+    """
+    複数の行の音声を、接続を使い回しながら並列に生成します。
+    一時的なエラー（接続エラー、タイムアウト、5xx）は行ごとにリトライします。
+    indicesを指定した場合は、その行だけを生成します（生成し直す行や、まとめた合成に失敗した行に使います）。
+
+    Args:
+        lines (list): 音声合成するテキストのリスト
+        speaker (int, optional): 声の種類. Defaults to 1.
+        speed (float, optional): 話す速さ. Defaults to 1.0.
+        out_dir (str, optional): 音声ファイルの出力先のフォルダ. Defaults to "resources/voice/".
+        start_index (int, optional): 最初の行のファイル名の番号。i行目は「start_index+i.wav」になります. Defaults to 0.
+        max_workers (int, optional): 同時に送るリクエストの最大数. Defaults to MAX_WORKERS.
+        retries (int, optional): 1行あたりのリトライ回数. Defaults to 3.
+        indices (list, optional): 生成する行の番号のリスト. Defaults to None（すべての行）.
+        on_voice (callable, optional): 1行の音声ファイルを書き出すたびに、(行の番号, パス)を渡して呼ぶ関数. Defaults to None.
+
+    Returns:
+        list: indicesの順番どおりの音声ファイルのパスのリスト。生成に失敗した行はNoneになります。
+    """
+    def generate(i):
+        path = generate_voice_retry(lines[i], speaker=speaker, output_path=os.path.join(out_dir, f"{start_index + i}.wav"), speed=speed, retries=retries)
+        if path is not None and on_voice is not None:
+            on_voice(i, path)
+        return path
+
+    indices = range(len(lines)) if indices is None else indices
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(bind(generate), indices))
+
+
+def generate_voices_batch(lines, speaker=1, speed=1.0, out_dir="resources/voice/", start_index=0, batch_size=BATCH_SIZE, retries=3, on_voice=None):
+    """
+    複数の行の音声を、/multi_synthesisでbatch_size行ずつまとめて生成します。
+    1行ごとに合成のリクエストを送るgenerate_voicesに比べて、短い行が多い物語ではリクエストの回数を減らせます。
+    キャッシュにある行はエンジンを使わず、同じテキストの行は1回だけ合成します。
+    まとめた合成が失敗した場合は、その行だけをgenerate_voicesで1行ずつ並列に生成し直します。
+
+    Args:
+        lines (list): 音声合成するテキストのリスト
+        speaker (int, optional): 声の種類. Defaults to 1.
+        speed (float, optional): 話す速さ. Defaults to 1.0.
+        out_dir (str, optional): 音声ファイルの出力先のフォルダ. Defaults to "resources/voice/".
+        start_index (int, optional): 最初の行のファイル名の番号。i行目は「start_index+i.wav」になります. Defaults to 0.
+        batch_size (int, optional): 1回のリクエストで合成する行の数. Defaults to BATCH_SIZE.
+        retries (int, optional): まとめた合成のリトライ回数. Defaults to 3.
+        on_voice (callable, optional): 1行の音声ファイルを書き出すたびに、(行の番号, パス)を渡して呼ぶ関数. Defaults to None.
+
+    Returns:
+        list: 行の順番どおりの音声ファイルのパスのリスト。生成に失敗した行はNoneになります。
+    """
+    cache = get_voice_cache()
+    version = _cache_version()
+    output_paths = [os.path.join(out_dir, f"{start_index + i}.wav") for i in range(len(lines))]
+    keys = [cache.make_key(text, speaker, speed, version) for text in lines]
+    contents = {} # キャッシュのキー → WAVのバイト列
+    missing = {} # キャッシュのキー → テキスト（同じテキストは1回だけ合成する）
+    for text, key in zip(lines, keys):
+        if key in contents or key in missing:
+            continue
+        content = cache.get(key)
+        get_metrics().count("tts.cache_hit" if content is not None else "tts.cache_miss")
+        if content is not None:
+            contents[key] = content
+        else:
+            missing[key] = text
+
+    missing_keys = list(missing)
+    for block_start in range(0, len(missing_keys), batch_size):
+        block = missing_keys[block_start:block_start + batch_size]
+        for attempt in range(retries + 1):
+            try:
+                for key, content in zip(block, _multi_synthesize([missing[key] for key in block], speaker, speed)):
+                    cache.put(key, content)
+                    contents[key] = content
+                break
+            except (requests.RequestException, zipfile.BadZipFile, ValueError) as e:
+                if attempt < retries and isinstance(e, requests.RequestException) and _is_transient(e):
+                    time.sleep(0.5 * 2 ** attempt) # 指数バックオフ
+                    continue
+                print(f"[Error]: まとめたボイス生成に失敗しました．1行ずつ生成します． > {e}")
+                get_metrics().count("tts.batch_fallback")
+                break
+
+    results = [None] * len(lines)
+    failed = []
+    for i, (key, output_path) in enumerate(zip(keys, output_paths)):
+        if key not in contents:
+            failed.append(i)
+            continue
+        with open(output_path, "wb") as f:
+            f.write(contents[key])
+        results[i] = output_path
+        if on_voice is not None:
+            on_voice(i, output_path)
+    if failed:
+        for i, path in zip(failed, generate_voices(lines, speaker=speaker, speed=speed, out_dir=out_dir, start_index=start_index, indices=failed, on_voice=on_voice)):
+            results[i] = path
+    return results
 
 
 if __name__ == "__main__":
-    generate_voice("こんにちは、ずんだもんなのだ！", speaker=22, output_file="resources/voicevox.wav", speed=1.2)
+    generate_voice("こんにちは、ずんだもんなのだ！", speaker=22, output_path="resources/voicevox.wav", speed=1.2)
     response = requests.get(f"{BASE_URL}/speakers")
     speakers_data = response.json()
 
@@ -66,4 +527,4 @@ if __name__ == "__main__":
     #     print(f"話者: {speaker['name']}")
     #     for style in speaker['styles']:
     #         print(f"  スタイルID: {style['id']}, 名前: {style['name']}")
-    #     print()
\ No newline at end of file
+    #     print()
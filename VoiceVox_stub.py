@@ -0,0 +1,127 @@
+"""
+VOICEVOXエンジンの代わりに、テキストの長さに比例した決まったWAVを返すローカルのHTTPサーバーです。
+ベンチマークとテストで、エンジンを起動せずにVoiceVoxの処理を動かすために使います。
+
+@author: Yuta Tanimura
+"""
+import io
+import json
+import threading
+import time
+import uuid
+import wave
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import VoiceVox
+
+VOICE_SAMPLE_RATE = 24000
+VOICE_SEC_PER_CHAR = 0.12 # 1文字あたりの音声の長さ（話す速さが1のとき）
+
+def _voice_wav(text, speed):
+    """
+    テキストの長さに比例した長さの、決まった音のWAVを作成します。
+    """
+    n_samples = int(len(text) * VOICE_SEC_PER_CHAR / speed * VOICE_SAMPLE_RATE)
+    t = np.arange(n_samples) / VOICE_SAMPLE_RATE
+    samples = (np.sin(2 * np.pi * 220 * t) * 3000).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(VOICE_SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+class Stub_VoiceVox_handler(BaseHTTPRequestHandler):
+    """
+    VOICEVOXエンジンの/version, /audio_query, /synthesis, /multi_synthesis, /user_dictだけを真似るハンドラーです。
+    """
+    protocol_version = "HTTP/1.1"
+    latency = 0.0 # 1リクエストあたりの待ち時間（秒）
+    user_dict = {} # 登録された単語（UUID → 単語）
+    errors = {} # エラーを返すパス → HTTPステータス（エンジンの障害を真似る場合）
+    requests = [] # 受け取ったPOSTの(パス, 合成した行の数)
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _word(self, query):
+        return {"surface": query["surface"][0], "pronunciation": query["pronunciation"][0], "accent_type": int(query["accent_type"][0])}
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/user_dict":
+            with self.lock:
+                self._send(json.dumps(self.user_dict, ensure_ascii=False).encode(), "application/json")
+        else:
+            self._send(json.dumps("benchmark").encode(), "application/json")
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        word_uuid = url.path.rsplit("/", 1)[-1]
+        with self.lock:
+            if not url.path.startswith("/user_dict_word/") or word_uuid not in self.user_dict:
+                self.send_error(404)
+                return
+            self.user_dict[word_uuid] = self._word(parse_qs(url.query))
+        self._send(b"", "application/json")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests.append((url.path, len(json.loads(body)) if url.path == "/multi_synthesis" else 1))
+        if url.path in self.errors:
+            self.send_error(self.errors[url.path])
+        elif url.path == "/audio_query":
+            self._send(json.dumps({"text": query["text"][0], "speedScale": 1.0}).encode(), "application/json")
+        elif url.path == "/synthesis":
+            audio_query = json.loads(body)
+            self._send(_voice_wav(audio_query["text"], audio_query["speedScale"]), "audio/wav")
+        elif url.path == "/multi_synthesis":
+            # エンジンと同じく、クエリの順番の連番のWAVをZIPにまとめて返す
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as archive:
+                for i, audio_query in enumerate(json.loads(body)):
+                    archive.writestr(f"{i + 1:03}.wav", _voice_wav(audio_query["text"], audio_query["speedScale"]))
+            self._send(buffer.getvalue(), "application/zip")
+        elif url.path == "/user_dict_word":
+            word_uuid = str(uuid.uuid4())
+            with self.lock:
+                self.user_dict[word_uuid] = self._word(query)
+            self._send(json.dumps(word_uuid).encode(), "application/json")
+        else:
+            self.send_error(404)
+
+def start_stub_voicevox(latency=0.0):
+    """
+    VOICEVOXエンジンの代わりになるサーバーを空いているポートで起動し、VoiceVox.BASE_URLを向けます。
+
+    Args:
+        latency (float, optional): 1リクエストあたりの待ち時間（秒）. Defaults to 0.0.
+
+    Returns:
+        ThreadingHTTPServer: 起動したサーバー
+    """
+    Stub_VoiceVox_handler.latency = latency
+    Stub_VoiceVox_handler.user_dict = {}
+    Stub_VoiceVox_handler.errors = {}
+    Stub_VoiceVox_handler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Stub_VoiceVox_handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    VoiceVox.BASE_URL = f"http://127.0.0.1:{server.server_port}"
+    return server
@@ -3,33 +3,47 @@ Youtubeに動画をアップロードする機能を提供します。
 
 @author: Yuta Tanimura
 """
+import json
 import os
 import pickle
+import random
+import socket
+import time
 
+import httplib2
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient import errors  # この行を追加
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
 
+from Metrics import get_metrics
+
+CHUNK_SIZE = 16 * 1024 * 1024 # 1回のリクエストで送るサイズ（256KiBの倍数）
+MAX_RETRIES = 10 # 一時的なエラーで再試行する回数
+MAX_BACKOFF = 64 # 再試行までの待ち時間の上限（秒）
+RETRIABLE_STATUS_CODES = (500, 502, 503, 504) # 再試行するHTTPステータス
+RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, ConnectionError, socket.timeout, TimeoutError) # 再試行する通信エラー
+
 
 class Youtube_uploader:
-    def __init__(self, key_path):
+    def __init__(self, key_path, token_path="token.pickle"):
         """
         Youtubeに動画をアップロードするためのインスタンスを作成します。
 
         Args:
             key_path (str): 認証情報のパス
+            token_path (str, optional): 取得したトークンの保存先。チャンネルごとに分けます. Defaults to "token.pickle".
         Methods:
-            upload_video(video_path, title, description, tags):
-                Youtubeに動画をアップロードします。
+            upload_video(video_path, title, description, tags, chunk_size):
+                Youtubeに動画をアップロードします。中断したアップロードは続きから再開します。
         """
         self.scopes = ["https://www.googleapis.com/auth/youtube.upload"]
         self.credentials = None
         
         # トークンファイルが存在する場合は読み込む
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
+        if os.path.exists(token_path):
+            with open(token_path, 'rb') as token:
                 self.credentials = pickle.load(token)
         
         # 有効な認証情報がない場合は新しく取得する
@@ -42,21 +56,27 @@ class Youtube_uploader:
                 self.credentials = flow.run_local_server(port=0)
             
             # 認証情報を保存
-            with open('token.pickle', 'wb') as token:
+            with open(token_path, 'wb') as token:
                 pickle.dump(self.credentials, token)
 
         # YouTube API クライアントを作成
         self.youtube = build("youtube", "v3", credentials=self.credentials)
 
-    def upload_video(self, video_path, title, description, tags):
+    def upload_video(self, video_path, title, description, tags, chunk_size=CHUNK_SIZE):
         """
-        Youtubeに動画をアップロードします
+        Youtubeに動画をアップロードします。
+        動画はchunk_sizeごとに分けて送り、通信エラーやサーバーエラーのときは待ち時間を倍にしながら続きから再試行します。
+        アップロードのセッションは動画の横のファイルに保存するので、プロセスが止まっても次回は続きから再開します。
 
         Args:
             video_path (str): 動画ファイルのパス
             title (str): 動画のタイトル
             description (str): 動画の説明
             tags (list): 動画のタグ
+            chunk_size (int, optional): 1回のリクエストで送るサイズ（256KiBの倍数）. Defaults to CHUNK_SIZE.
+
+        Returns:
+            str: アップロードした動画のID（失敗した場合はNone）
         """
         # 動画のアップロード
         request_body = {
@@ -72,19 +92,151 @@ class Youtube_uploader:
             }
         }
 
-        media_file = MediaFileUpload(video_path)
+        media_file = MediaFileUpload(video_path, chunksize=chunk_size, resumable=True)
+        request = self.youtube.videos().insert(
+            part='snippet,status',
+            body=request_body,
+            media_body=media_file
+        )
+
+        # 前回中断したアップロードがあれば、そのセッションの続きから再開する
+        session_path = video_path + ".upload.json"
+        file_stat = os.stat(video_path)
+        session = self._load_session(session_path)
+        resume = session is not None and session["size"] == file_stat.st_size and session["mtime"] == file_stat.st_mtime
+        if resume:
+            print("中断したアップロードを再開します。")
+            request.resumable_uri = session["uri"]
+        saved_uri = request.resumable_uri
+
+        response = None
+        retry = 0
+        start_time = time.time()
+        start_progress = 0
+        while response is None:
+            try:
+                if resume:
+                    # 最初のチャンクを送る前に、サーバーが受け取った位置を問い合わせる
+                    start_progress, response = self._query_progress(request, file_stat.st_size)
+                    resume = False
+                    retry = 0
+                    continue
+                status, response = request.next_chunk()
+                retry = 0
+                if status is not None:
+                    self._print_progress(status.resumable_progress, status.total_size, status.resumable_progress - start_progress, time.time() - start_time)
+                continue
+            except errors.HttpError as e:
+                if e.resp.status in (404, 410) and request.resumable_uri is not None:
+                    # セッションが期限切れなので、最初からやり直す
+                    print("アップロードのセッションが無効になったため、最初からアップロードします。")
+                    self._remove_session(session_path)
+                    request.resumable_uri = None
+                    request.resumable_progress = 0
+                    start_progress = 0
+                    resume = False
+                    continue
+                if e.resp.status not in RETRIABLE_STATUS_CODES:
+                    print(f"エラーが発生しました: {e}")
+                    return None
+                error = e
+            except RETRIABLE_EXCEPTIONS as e:
+                error = e
+            finally:
+                if request.resumable_uri not in (None, saved_uri) and response is None:
+                    self._save_session(session_path, request.resumable_uri, file_stat)
+                    saved_uri = request.resumable_uri
+
+            retry += 1
+            get_metrics().count("upload.retry")
+            if retry > MAX_RETRIES:
+                print(f"エラーが発生しました。再試行の回数が上限に達しました: {error}")
+                return None
+            wait = min(2 ** retry + random.random(), MAX_BACKOFF)
+            print(f"[Error]: アップロード中にエラーが発生しました。{wait:.1f}秒後に再試行します。({retry}/{MAX_RETRIES}) {error}")
+            time.sleep(wait)
+
+        self._remove_session(session_path)
+        elapsed = time.time() - start_time
+        sent = file_stat.st_size - start_progress
+        get_metrics().record("upload.video", sec=elapsed, bytes=sent, mb_per_sec=sent / elapsed / 1024 / 1024 if elapsed > 0 else None)
+        print(f"動画がアップロードされました。Video ID: {response['id']}（{elapsed:.1f}秒）")
+        return response['id']
+
+    def _print_progress(self, progress, total, sent, elapsed):
+        """
+        アップロードの進捗とスループットを表示します。
+
+        Args:
+            progress (int): 送信済みのバイト数
+            total (int): 動画のバイト数
+            sent (int): このプロセスで送信したバイト数
+            elapsed (float): アップロードを始めてからの経過時間（秒）
+        """
+        throughput = sent / elapsed / 1024 / 1024 if elapsed > 0 else 0
+        print(f"アップロード中... {progress / total * 100:.1f}% ({progress / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f}MB, {throughput:.2f}MB/s)")
+
+    def _query_progress(self, request, total_size):
+        """
+        中断したアップロードのセッションに、サーバーが受け取った位置を問い合わせます。
+        本文が空のPUTにContent-Range: bytes */<動画のバイト数>をつけて送ると、受け取った範囲（308）か、完了したアップロードの結果（200, 201）が返ります。
+
+        Args:
+            request (googleapiclient.http.HttpRequest): セッションのURIを設定したアップロードのリクエスト
+            total_size (int): 動画のバイト数
+
+        Returns:
+            tuple: (送信済みのバイト数, アップロードが完了していた場合は動画の情報（それ以外はNone）)
+
+        Raises:
+            googleapiclient.errors.HttpError: セッションが無効な場合（404, 410）やサーバーエラーの場合
+        """
+        headers = {"Content-Range": f"bytes */{total_size}", "Content-Length": "0"}
+        resp, content = request.http.request(request.resumable_uri, "PUT", headers=headers)
+        if resp.status in (200, 201):
+            return total_size, request.postproc(resp, content)
+        if resp.status != 308:
+            raise errors.HttpError(resp, content, uri=request.resumable_uri)
+        # Rangeがない場合は、まだ何も受け取っていない
+        progress = int(resp["range"].split("-")[1]) + 1 if "range" in resp else 0
+        request.resumable_progress = progress
+        if "location" in resp:
+            request.resumable_uri = resp["location"]
+        return progress, None
 
+    def _load_session(self, session_path):
+        """
+        保存したアップロードのセッションを読み込みます。
+
+        Returns:
+            dict: uri, size, mtimeをもつ辞書（セッションがない場合はNone）
+        """
+        if not os.path.exists(session_path):
+            return None
         try:
-            response = self.youtube.videos().insert(
-                part='snippet,status',
-                body=request_body,
-                media_body=media_file
-            ).execute()
-            print(f"動画がアップロードされました。Video ID: {response['id']}")
-        except errors.HttpError as e:  # googleapiclient.errors を errors に変更
-            print(f"エラーが発生しました: {e}")
-            response = None
-            
+            with open(session_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[Error]: アップロードのセッションを読み込めませんでした。 > {e}")
+            return None
+
+    def _save_session(self, session_path, uri, file_stat):
+        """
+        アップロードのセッションを保存します。動画が変わった場合に再開しないよう、サイズと更新日時も保存します。
+        """
+        session = {"uri": uri, "size": file_stat.st_size, "mtime": file_stat.st_mtime}
+        temp_path = session_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(session, f)
+        os.replace(temp_path, session_path)
+
+    def _remove_session(self, session_path):
+        """
+        アップロードのセッションを削除します。
+        """
+        if os.path.exists(session_path):
+            os.remove(session_path)
+
 if __name__ == "__main__":
     uploader = Youtube_uploader("keys/client_secret_170252295818-u0p1ncb82ou8otmkv0q7hvlpc72hq22b.apps.googleusercontent.com.json")
     uploader.upload_video("movie.mp4", "YOUR_VIDEO_TITLE", "YOUR_VIDEO_DESCRIPTION", ["YOUR_VIDEO_TAG1", "YOUR_VIDEO_TAG2"])
\ No newline at end of file
@@ -0,0 +1,29 @@
+"""
+テストからリポジトリ直下のモジュールを読み込めるようにし、テストで共有するフィクスチャを定義します。
+
+@author: Yuta Tanimura
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import VoiceVox
+from VoiceVox_stub import start_stub_voicevox
+
+
+@pytest.fixture
+def stub_voicevox(tmp_path, monkeypatch):
+    """
+    VOICEVOXエンジンの代わりのサーバーを起動し、VoiceVoxの接続先とキャッシュをテスト用に差し替えます。
+    待ち時間やエラーは、返したサーバーのRequestHandlerClassのlatencyとerrorsで設定します。
+    """
+    monkeypatch.setattr(VoiceVox, "BASE_URL", VoiceVox.BASE_URL) # テストのあとに元に戻す
+    monkeypatch.setattr(VoiceVox, "_engine_version", None)
+    monkeypatch.setattr(VoiceVox, "_voice_cache", VoiceVox.Voice_cache(str(tmp_path / "cache")))
+    server = start_stub_voicevox()
+    yield server
+    server.shutdown()
+    server.server_close()
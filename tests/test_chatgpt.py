@@ -0,0 +1,128 @@
+"""
+ChatGPT.split_json_itemsとChatGPT.send_message_streamのテストです。
+send_message_streamは、OpenAIのAPIの代わりにストリーミングで回答を返すスタブのHTTPサーバーを使います。
+
+@author: Yuta Tanimura
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ChatGPT as chatgpt_module
+from ChatGPT import ChatGPT, split_json_items
+
+STORY = {"lines": [{"kanji": "タイトル"}, {"kanji": "「[括弧]」と\"引用\"の行。"}, {"kanji": "最後の行}です]。"}]}
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_items_split_across_chunks(size):
+    text = json.dumps(STORY, ensure_ascii=False)
+    assert list(split_json_items(_chunks(text, size))) == STORY["lines"]
+
+def test_escaped_quotes_and_brackets_in_strings():
+    items = ["a\"]", "[b", "c\\\\", "},{"]
+    text = json.dumps({"lines": items})
+    assert list(split_json_items(_chunks(text, 1))) == items
+
+def test_items_are_yielded_before_the_array_closes():
+    chunks = iter(['{"lines": [{"kanji": "1"}, ', '{"kanji": "2"}'])
+    items = split_json_items(chunks)
+    assert next(items) == {"kanji": "1"}
+    assert next(items) == {"kanji": "2"}
+    with pytest.raises(ValueError):
+        next(items)
+
+def test_rest_of_chunks_is_consumed():
+    consumed = []
+    def chunks():
+        for chunk in ['[1, ', '2]', '}', '']:
+            consumed.append(chunk)
+            yield chunk
+    assert list(split_json_items(chunks())) == [1, 2]
+    assert len(consumed) == 4
+
+def test_number_split_across_chunks():
+    assert list(split_json_items(["[12", "3, 4", "5]"])) == [123, 45]
+
+@pytest.mark.parametrize("chunks", [[], ['{"lines": '], ['{"lines": [{"kanji": "1"}'], ['{"lines": [{"kanji": "1"}, {"kan']])
+def test_unclosed_array_raises(chunks):
+    with pytest.raises(ValueError):
+        list(split_json_items(chunks))
+
+class _Stub_openai_handler(BaseHTTPRequestHandler):
+    """
+    /chat/completionsに、server.textをserver.chunk_size文字ずつのServer-Sent Eventsで返すハンドラーです。
+    ストリーミングでないリクエストには、server.textをまとめて返します。
+    最後にfinish_reasonが"stop"の断片と[DONE]を送ります。server.truncateがTrueの場合は、途中で接続を切ります。
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        if not request.get("stream"):
+            body = json.dumps({"id": "stub", "object": "chat.completion", "created": 0, "model": request["model"],
+                               "choices": [{"index": 0, "message": {"role": "assistant", "content": self.server.text}, "finish_reason": "stop"}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        base = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": request["model"]}
+        text, size = self.server.text, self.server.chunk_size
+        pieces = _chunks(text, size)
+        if self.server.truncate:
+            pieces = pieces[:len(pieces) // 2]
+        for piece in pieces:
+            event = dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        if self.server.truncate:
+            self.wfile.write(b"data: {\"id\": ") # イベントの途中で接続を切る
+        else:
+            event = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            self.wfile.write(f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+        self.close_connection = True
+
+@pytest.fixture
+def stub_openai():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Stub_openai_handler)
+    server.text, server.chunk_size, server.truncate = json.dumps(STORY, ensure_ascii=False), 5, False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _gpt(server):
+    return ChatGPT(api_key="test", model="stub", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1")
+
+def test_stream_yields_items(stub_openai):
+    gpt = _gpt(stub_openai)
+    assert list(split_json_items(gpt.send_message_stream("物語"))) == STORY["lines"]
+    assert gpt.conversation_history[-1]["content"] == stub_openai.text
+
+def test_truncated_stream_raises(stub_openai):
+    stub_openai.truncate = True
+    gpt = _gpt(stub_openai)
+    n_history = len(gpt.conversation_history)
+    with pytest.raises(ConnectionError):
+        list(split_json_items(gpt.send_message_stream("物語")))
+    assert len(gpt.conversation_history) == n_history # 途切れた回答は会話履歴に追加しない
+
+def test_batch_closes_async_clients(stub_openai):
+    gpt = _gpt(stub_openai)
+    assert gpt.send_messages_batch(["1", "2"]) == [stub_openai.text] * 2
+    assert chatgpt_module._async_clients == {} # 終わったイベントループのクライアントは閉じて、残さない
@@ -0,0 +1,66 @@
+"""
+Metrics.Memory_budgetとMetrics.profileのテストです。
+
+@author: Yuta Tanimura
+"""
+import cProfile
+import threading
+
+from Metrics import PROFILE_ENV, Memory_budget, Metrics
+
+
+def test_reserve_blocks_while_over_budget():
+    # 予算を1バイトにして、常に予算を超えている状態にする
+    budget = Memory_budget(max_bytes=1, interval=0.01)
+    held, finish, entered = threading.Event(), threading.Event(), threading.Event()
+
+    def first():
+        with budget.reserve():
+            held.set()
+            finish.wait()
+
+    def second():
+        with budget.reserve():
+            entered.set()
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    threads[0].start()
+    assert held.wait(5)
+    threads[1].start()
+    assert not entered.wait(0.3) # 実行中の処理があり予算を超えているので、始まらずに待つ
+    finish.set()
+    assert entered.wait(5) # 実行中の処理が終わると始まる
+    for thread in threads:
+        thread.join()
+    assert budget.waits == 1
+    assert budget.in_flight == 0
+
+def test_reserve_releases_memory_without_blocking_single_worker():
+    budget = Memory_budget(max_bytes=1, interval=0.01)
+    released = []
+    with budget.reserve(release=lambda: released.append(True)):
+        pass
+    assert released == [True] # 予算を超えているので、始める前に解放する
+    assert budget.waits == 0 # 実行中のほかの処理がなければ待たない
+    assert budget.releases == 1
+
+def test_reserve_without_budget_does_not_release():
+    budget = Memory_budget(max_bytes=None)
+    released = []
+    with budget.reserve(release=lambda: released.append(True)):
+        pass
+    assert released == []
+    assert budget.releases == 0
+
+def test_profile_skips_when_another_profiler_is_active(monkeypatch, tmp_path):
+    def enable(self):
+        raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setenv(PROFILE_ENV, "1")
+    monkeypatch.setattr(cProfile.Profile, "enable", enable)
+    metrics = Metrics(str(tmp_path / "run.jsonl"))
+    with metrics.profile() as profiler:
+        pass
+    assert profiler is None # 有効にできない場合は、プロファイルせずに実行する
+    assert not list(tmp_path.glob("*.prof"))
+    metrics.close()
@@ -0,0 +1,45 @@
+"""
+Story_queue.fillのテストです。
+
+@author: Yuta Tanimura
+"""
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+
+from Story_queue import Story_queue
+
+
+def test_fill_waits_for_stage_without_blocking_loop(tmp_path):
+    queue = Story_queue(str(tmp_path / "stories"), target_size=2)
+    semaphore = threading.BoundedSemaphore(1)
+
+    @contextmanager
+    def stage():
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def generate(n):
+        return [{"lines": [i]} for i in range(n)]
+
+    async def main():
+        ticks = []
+        async def tick():
+            while len(ticks) < 5:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.02)
+        semaphore.acquire() # ほかのジョブが生成中
+        threading.Timer(0.3, semaphore.release).start()
+        added, _ = await asyncio.gather(queue.fill(generate, lambda story: story, stage=stage), tick())
+        return added, ticks
+
+    start = time.perf_counter()
+    added, ticks = asyncio.run(main())
+    assert added == 2
+    assert len(queue) == 2
+    assert ticks[-1] - start < 0.3 # 空くのを待つ間も、ほかのコルーチンが動く
+    assert semaphore.acquire(blocking=False) # 生成のあとに解放している
@@ -0,0 +1,34 @@
+"""
+Movie_maker.Recipe_recorderで記録したレイヤーの構成と、Timeline.slide_keyのテストです。
+
+@author: Yuta Tanimura
+"""
+import os
+
+from Movie_maker import Recipe_recorder
+from Timeline import slide_key
+
+
+def _recipe(font, fontsize=50):
+    clip = Recipe_recorder(duration=2)
+    clip.add_rectangle(position=(0, 0), size=(1920, 1080), color=(0, 0, 0), alpha=150)
+    clip.add_text("本文", position="center", fontsize=fontsize, color="white", stroke_color="black", stroke_width=1, font=font)
+    return clip.recipe()
+
+def test_recipe_records_arguments_with_defaults(tmp_path):
+    recipe = _recipe(str(tmp_path / "font.ttc"))
+    assert recipe["settings"] == {"duration": 2, "bg_color": (0, 0, 0), "size": (1920, 1080), "fps": 60}
+    assert [layer["method"] for layer in recipe["layers"]] == ["add_rectangle", "add_text"]
+    assert recipe["layers"][1]["fontsize"] == 50
+    assert recipe["layers"][1]["weight"] == "normal" # 渡していない引数は既定値で記録する
+
+def test_slide_key_changes_with_text_params_and_font(tmp_path):
+    font = tmp_path / "font.ttc"
+    font.write_bytes(b"font")
+    key = slide_key("story", "本文", 2, _recipe(str(font)))
+    assert slide_key("story", "本文", 2, _recipe(str(font))) == key
+    assert slide_key("story", "本文", 2, _recipe(str(font), fontsize=60)) != key
+
+    font.write_bytes(b"new font") # フォントを差し替える
+    os.utime(font, ns=(0, 0))
+    assert slide_key("story", "本文", 2, _recipe(str(font))) != key
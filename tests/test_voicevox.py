@@ -0,0 +1,83 @@
+"""
+VoiceVox.generate_voicesとVoiceVox.generate_voices_batchのテストです。
+VOICEVOXエンジンの代わりに、conftest.pyのスタブのサーバーを使います。
+
+@author: Yuta Tanimura
+"""
+import time
+import wave
+
+import VoiceVox
+from VoiceVox_stub import VOICE_SAMPLE_RATE, VOICE_SEC_PER_CHAR
+
+LATENCY = 0.05 # スタブのサーバーが1回のリクエストにかかる時間（秒）
+
+
+def _generate(out_dir, lines, max_workers):
+    out_dir.mkdir()
+    start = time.perf_counter()
+    paths = VoiceVox.generate_voices(lines, out_dir=str(out_dir), max_workers=max_workers)
+    return paths, time.perf_counter() - start
+
+def _n_frames(path):
+    with wave.open(path, "rb") as f:
+        return f.getnframes()
+
+def _posts(server, path):
+    return [n for request_path, n in server.RequestHandlerClass.requests if request_path == path]
+
+def test_generate_voices_is_faster_in_parallel(stub_voicevox, tmp_path):
+    stub_voicevox.RequestHandlerClass.latency = LATENCY
+    lines = [f"{i}行目" for i in range(16)]
+    serial_paths, serial = _generate(tmp_path / "serial", lines, max_workers=1)
+    # キャッシュに当たらないよう、テキストを変えて並列に生成する
+    parallel_paths, parallel = _generate(tmp_path / "parallel", [line + "。" for line in lines], max_workers=VoiceVox.MAX_WORKERS)
+
+    assert serial_paths == [str(tmp_path / "serial" / f"{i}.wav") for i in range(len(lines))]
+    assert parallel_paths == [str(tmp_path / "parallel" / f"{i}.wav") for i in range(len(lines))]
+    assert serial >= 2 * len(lines) * LATENCY
+    assert parallel < serial / 2
+
+def test_generate_voices_only_indices(stub_voicevox, tmp_path):
+    lines = ["あ", "い", "う", "え"]
+    out_dir = tmp_path / "voice"
+    out_dir.mkdir()
+    written = []
+    paths = VoiceVox.generate_voices(lines, out_dir=str(out_dir), start_index=10, indices=[1, 3],
+                                     on_voice=lambda i, path: written.append((i, path)))
+    assert paths == [str(out_dir / "11.wav"), str(out_dir / "13.wav")]
+    assert sorted(written) == [(1, str(out_dir / "11.wav")), (3, str(out_dir / "13.wav"))]
+    assert sorted(p.name for p in out_dir.iterdir()) == ["11.wav", "13.wav"]
+
+def test_generate_voices_batch_splits_blocks_in_order(stub_voicevox, tmp_path):
+    # 行ごとに長さを変え、音声の長さで順番を確かめる
+    lines = ["あ" * (i + 1) for i in range(VoiceVox.BATCH_SIZE + 4)]
+    lines.append(lines[0]) # 同じテキストは1回だけ合成する
+    written = []
+    paths = VoiceVox.generate_voices_batch(lines, out_dir=str(tmp_path), start_index=5,
+                                           on_voice=lambda i, path: written.append(i))
+
+    assert paths == [str(tmp_path / f"{5 + i}.wav") for i in range(len(lines))]
+    assert [_n_frames(path) for path in paths] == [int(len(line) * VOICE_SEC_PER_CHAR * VOICE_SAMPLE_RATE) for line in lines]
+    assert sorted(written) == list(range(len(lines)))
+    assert _posts(stub_voicevox, "/multi_synthesis") == [VoiceVox.BATCH_SIZE, 4]
+    assert _posts(stub_voicevox, "/synthesis") == []
+
+def test_generate_voices_batch_falls_back_to_generate_voices(stub_voicevox, tmp_path):
+    stub_voicevox.RequestHandlerClass.errors = {"/multi_synthesis": 400}
+    lines = ["あ" * (i + 1) for i in range(5)]
+    paths = VoiceVox.generate_voices_batch(lines, out_dir=str(tmp_path))
+
+    assert paths == [str(tmp_path / f"{i}.wav") for i in range(len(lines))]
+    assert [_n_frames(path) for path in paths] == [int(len(line) * VOICE_SEC_PER_CHAR * VOICE_SAMPLE_RATE) for line in lines]
+    assert len(_posts(stub_voicevox, "/multi_synthesis")) == 1 # 一時的でないエラーはリトライしない
+    assert len(_posts(stub_voicevox, "/synthesis")) == len(lines)
+
+def test_set_max_concurrency_resizes_connection_pool(stub_voicevox, monkeypatch):
+    monkeypatch.setattr(VoiceVox, "_session", None)
+    monkeypatch.setattr(VoiceVox, "_max_concurrency", VoiceVox._max_concurrency)
+    monkeypatch.setattr(VoiceVox, "_engine_semaphore", VoiceVox._engine_semaphore)
+    session = VoiceVox._get_session()
+    VoiceVox.set_max_concurrency(VoiceVox.MAX_WORKERS * 2)
+    assert VoiceVox._get_session() is session
+    assert session.get_adapter(VoiceVox.BASE_URL)._pool_maxsize == VoiceVox.MAX_WORKERS * 2
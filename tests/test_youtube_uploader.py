@@ -0,0 +1,103 @@
+"""
+Youtube_uploader.upload_videoのテストです。
+YouTubeのAPIの代わりに、再開可能なアップロードのプロトコルを真似るスタブのhttpを使います。
+
+@author: Yuta Tanimura
+"""
+import json
+import os
+
+import httplib2
+import pytest
+from googleapiclient.discovery import build
+
+from Youtube_uploader import Youtube_uploader
+
+CHUNK_SIZE = 256 * 1024
+SESSION_URI = "https://upload.example.com/session/1"
+
+
+class _Stub_upload_http:
+    """
+    再開可能なアップロードを受け付けるスタブのhttpです。
+    errorsに{チャンクの開始位置: [ステータス, ...]}を入れると、その位置のチャンクに先頭から1つずつ返します。
+    """
+    def __init__(self):
+        self.received = b""
+        self.errors = {}
+        self.requests = []
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        self.requests.append((method, uri, headers.get("content-range")))
+        if method == "POST":
+            return httplib2.Response({"status": 200, "location": SESSION_URI}), b""
+        if uri != SESSION_URI:
+            return httplib2.Response({"status": 404}), b"{}"
+        content_range = headers["content-range"]
+        total = int(content_range.split("/")[1])
+        if not content_range.startswith("bytes */"):
+            data = body.read() if hasattr(body, "read") else body
+            start = int(content_range.split(" ")[1].split("-")[0])
+            if self.errors.get(start):
+                return httplib2.Response({"status": self.errors[start].pop(0)}), b"{}"
+            assert start == len(self.received) # 受け取った位置の続きから送られる
+            self.received += data
+        if len(self.received) == total:
+            return httplib2.Response({"status": 200}), json.dumps({"id": "video-id"}).encode("utf-8")
+        if self.received:
+            return httplib2.Response({"status": 308, "range": f"bytes=0-{len(self.received) - 1}"}), b""
+        return httplib2.Response({"status": 308}), b""
+
+@pytest.fixture
+def uploader(monkeypatch):
+    monkeypatch.setattr("Youtube_uploader.time.sleep", lambda sec: None)
+    http = _Stub_upload_http()
+    uploader = Youtube_uploader.__new__(Youtube_uploader) # 認証を省く
+    uploader.youtube = build("youtube", "v3", http=http, developerKey="test", static_discovery=True)
+    uploader.http = http
+    return uploader
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = tmp_path / "movie.mp4"
+    path.write_bytes(os.urandom(CHUNK_SIZE * 2 + 1000))
+    return str(path)
+
+def _puts(http):
+    return [content_range for method, uri, content_range in http.requests if method == "PUT"]
+
+def test_retry_on_server_error(uploader, video_path):
+    uploader.http.errors = {CHUNK_SIZE: [503]}
+    assert uploader.upload_video(video_path, "title", "description", [], chunk_size=CHUNK_SIZE) == "video-id"
+    with open(video_path, "rb") as f:
+        assert uploader.http.received == f.read()
+    assert f"bytes */{os.path.getsize(video_path)}" in _puts(uploader.http) # 503のあとに受け取った位置を問い合わせる
+    assert not os.path.exists(video_path + ".upload.json")
+
+def test_resume_from_saved_session(uploader, video_path):
+    size = os.path.getsize(video_path)
+    # 1回目は2つ目のチャンクを再試行しないエラーにして止める
+    uploader.http.errors = {CHUNK_SIZE: [400]}
+    assert uploader.upload_video(video_path, "title", "description", [], chunk_size=CHUNK_SIZE) is None
+    with open(video_path + ".upload.json", encoding="utf-8") as f:
+        assert json.load(f)["uri"] == SESSION_URI
+
+    # 2回目は保存したセッションの続きから送る
+    uploader.http.requests.clear()
+    assert uploader.upload_video(video_path, "title", "description", [], chunk_size=CHUNK_SIZE) == "video-id"
+    assert [method for method, uri, content_range in uploader.http.requests].count("POST") == 0
+    puts = _puts(uploader.http)
+    assert puts[0] == f"bytes */{size}" # 最初のチャンクの前に問い合わせる
+    assert puts[1].startswith(f"bytes {CHUNK_SIZE}-")
+    with open(video_path, "rb") as f:
+        assert uploader.http.received == f.read()
+    assert not os.path.exists(video_path + ".upload.json")
+
+def test_restart_when_session_expired(uploader, video_path):
+    stat = os.stat(video_path)
+    with open(video_path + ".upload.json", "w", encoding="utf-8") as f:
+        json.dump({"uri": "https://upload.example.com/session/expired", "size": stat.st_size, "mtime": stat.st_mtime}, f)
+    assert uploader.upload_video(video_path, "title", "description", [], chunk_size=CHUNK_SIZE) == "video-id"
+    with open(video_path, "rb") as f:
+        assert uploader.http.received == f.read()